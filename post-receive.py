@@ -11,97 +11,308 @@ $ git config hooks.webhookurl http://saltbot.sample.com/api/webhook
 $ git config hooks.webhooksecret hunter2
 $ cp saltbot/post-receive.py .git/hooks/post-receive
 $ chmod +x .git/hooks/post_receive
+
+All refs in a push are sent in a single signed request. Optionally set
+hooks.webhooktimeout (seconds, default 5). If saltbot can't be reached the
+notification is spooled to saltbot-spool/ in the git directory and a
+background process retries it, so the push itself is never held up for
+more than one attempt. While earlier notifications are spooled, new ones
+are spooled behind them without trying to send them, so they arrive in
+order.
+Notifications saltbot rejects outright (an HTTP 4xx) aren't retried, and
+are moved to saltbot-spool/rejected/ if they were spooled.
 """
 
 import os
 import sys
 import json
+import time
 import hmac
+import uuid
 import getpass
 import hashlib
 import subprocess
 
-from datetime import datetime
-
 try:
-    from urllib.error import URLError
-    from urllib.parse import urlencode
-    from urllib.request import urlopen, Request
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib.parse import urlsplit
 except ImportError:
-    from urllib import urlencode
-    from urllib2 import urlopen, Request, URLError
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    from urlparse import urlsplit
+
+NULL_SHA = "0" * 40
+RETRY_DELAYS = (5, 10, 30, 60, 120, 300, 600)
+
+
+class Rejected(HTTPException):
+    """Saltbot refused the notification, so retrying it won't help."""
+    pass
+
 
-def git(*args):
+def git(*args, **kwargs):
+    """Run git with *args*, writing *input* to it, and return its output."""
     args = ['git'] + list(args)
-    git = subprocess.Popen(args, stdout=subprocess.PIPE)
-    return git.stdout.read().strip()
+    stdin = kwargs.get('input')
+    with open(os.devnull, "w") as devnull:
+        git = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=devnull,
+                               stdin=None if stdin is None
+                               else subprocess.PIPE)
+    if stdin is not None:
+        stdin = stdin.encode('utf-8')
+    return git.communicate(stdin)[0].decode('utf-8', 'replace')
+
+
+def get_config():
+    """Read all hooks.webhook* settings with a single git invocation."""
+    cfg = {}
+    out = git('config', '--get-regexp', r'^hooks\.webhook')
+    for line in out.split("\n"):
+        if line.strip():
+            k, _, v = line.partition(" ")
+            cfg[k.strip()] = v.strip()
+    return cfg
 
-def cfg(k):
-    return git('config', str(k))
 
 def repo_path():
     return os.path.abspath(os.getcwd())
 
-def get_commit(new):
-    commit = {}
-    lines = git('--no-pager', 'show', '-s', '--quiet', new).split("\n")
-    commit['id'] = lines[0].strip().split()[1].strip()
-    author_email = lines[1].strip().split(": ", 1)[1].strip()
-    commit['author'] = author_email.split('<', 1)[0].strip()
-    timestamp = lines[2].strip().split(": ", 1)[1].strip()
-    commit['message'] = "\n".join(l.strip() for l in lines[4:])
-
-    basetime = datetime.strptime(timestamp[:-6], "%a %b %d %H:%M:%S %Y")
-    tzstr = timestamp[-5:]
-    commit['timestamp'] = basetime.strftime("%Y-%m-%dT%H:%M:%S") + tzstr
-    
-    return commit
-
-def make_data(old, new, ref):
-    commit = get_commit(new)
-    data = {
-        "ref": ref,
-        "repository": {
-            "full_name": repo_path(),
-            "url": "#"
-        },
-        "head_commit": {
-            "id": commit['id'],
-            "message": commit['message'],
-            "timestamp": commit['timestamp'],
-            "url": "#",
-            "author": {
-                "username": commit['author']
-            }
-        },
-        "pusher": {
-            "name": getpass.getuser()
+
+def spool_path():
+    return os.path.join(os.environ.get('GIT_DIR', '.'), "saltbot-spool")
+
+
+def get_commits(shas):
+    """Fetch details of every commit in *shas* with a single `git show`."""
+    if not shas:
+        return {}
+    fmt = "%H%x1f%an%x1f%aI%x1f%B%x1e"
+    out = git('--no-pager', 'show', '-s', '--format=' + fmt, *shas)
+    commits = {}
+    for record in out.split("\x1e"):
+        record = record.strip("\n")
+        if not record:
+            continue
+        sha, author, timestamp, message = record.split("\x1f", 3)
+        commits[sha] = {
+            "id": sha, "author": author, "timestamp": timestamp,
+            "message": "\n".join(l.strip() for l in message.split("\n"))
+                     .strip(),
         }
-    }
-    return json.dumps(data)
+    return commits
+
 
-def post(url, data, secret):
-    enc_data = data.encode()
-    sig = hmac.new(secret, enc_data, hashlib.sha1).hexdigest()
+def peel(shas):
+    """
+    Map each of *shas* to the commit it refers to, which for an annotated
+    tag is the commit it tags, with a single `git cat-file`. Those which
+    don't refer to a commit are left out.
+    """
+    if not shas:
+        return {}
+    out = git('cat-file', '--batch-check',
+              input="".join(sha + "^{commit}\n" for sha in shas))
+    commits = {}
+    for sha, line in zip(shas, out.split("\n")):
+        fields = line.split()
+        if len(fields) == 3 and fields[1] == "commit":
+            commits[sha] = fields[0]
+    return commits
+
+
+def make_data(refs):
+    """Build one batched payload covering every (old, new, ref) in *refs*."""
+    peeled = peel(sorted(set(new for (_, new, _) in refs if new != NULL_SHA)))
+    refs = [(old, peeled[new], ref) for (old, new, ref) in refs
+            if new in peeled]
+    commits = get_commits(sorted(set(new for (_, new, _) in refs)))
+    pushes = []
+    for old, new, ref in refs:
+        commit = commits[new]
+        pushes.append({
+            "ref": ref,
+            "repository": {
+                "full_name": repo_path(),
+                "url": "#"
+            },
+            "head_commit": {
+                "id": commit['id'],
+                "message": commit['message'],
+                "timestamp": commit['timestamp'],
+                "url": "#",
+                "author": {
+                    "username": commit['author']
+                }
+            },
+            "pusher": {
+                "name": getpass.getuser()
+            }
+        })
+    if not pushes:
+        return None
+    return json.dumps({"pushes": pushes})
+
+
+def connect(url, timeout):
+    parts = urlsplit(url)
+    if parts.scheme == "https":
+        conn = HTTPSConnection(parts.hostname, parts.port, timeout=timeout)
+    else:
+        conn = HTTPConnection(parts.hostname, parts.port, timeout=timeout)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    return conn, path
+
+
+def post(conn, path, payload, secret):
+    enc_data = payload['body'].encode()
+    sig = hmac.new(secret.encode(), enc_data, hashlib.sha1).hexdigest()
     headers = {
-        "X-GitHub-Event": "push",
+        "X-GitHub-Event": "push_batch",
+        "X-GitHub-Delivery": payload['delivery'],
         "X-Hub-Signature": "sha1={}".format(sig),
         "Content-Type": "application/json"
     }
-    req = Request(url, data=enc_data, headers=headers)
+    conn.request("POST", path, enc_data, headers)
+    resp = conn.getresponse()
+    resp.read()
+    if 400 <= resp.status < 500:
+        raise Rejected("HTTP {} {}".format(resp.status, resp.reason))
+    elif resp.status != 200:
+        raise HTTPException("HTTP {} {}".format(resp.status, resp.reason))
+
+
+def spooled():
+    try:
+        names = sorted(os.listdir(spool_path()))
+    except OSError:
+        return []
+    return [os.path.join(spool_path(), n) for n in names
+            if n.endswith(".json")]
+
+
+def spool(payload):
+    if not os.path.isdir(spool_path()):
+        os.makedirs(spool_path())
+    name = "{:.6f}-{}.json".format(time.time(), payload['delivery'])
+    tmp = os.path.join(spool_path(), "." + name)
+    with open(tmp, "w") as f:
+        json.dump(payload, f)
+    os.rename(tmp, os.path.join(spool_path(), name))
+
+
+def quarantine(fname):
+    """Move a spooled payload saltbot rejected out of the retry queue."""
+    rejected = os.path.join(spool_path(), "rejected")
+    if not os.path.isdir(rejected):
+        os.makedirs(rejected)
+    os.rename(fname, os.path.join(rejected, os.path.basename(fname)))
+
+
+def deliver(cfg):
+    """
+    Send spooled payloads, oldest first, over one connection. Payloads
+    saltbot rejects are quarantined so they can't hold up later ones.
+    Returns True if nothing is left to retry.
+    """
+    url = cfg['hooks.webhookurl']
+    secret = cfg['hooks.webhooksecret']
+    timeout = float(cfg.get('hooks.webhooktimeout', 5))
+    conn, path = connect(url, timeout)
+    try:
+        for fname in spooled():
+            try:
+                with open(fname) as f:
+                    post(conn, path, json.load(f), secret)
+            except (Rejected, ValueError) as e:
+                print("Notification {} rejected, moved aside: {}"
+                      .format(os.path.basename(fname), e))
+                quarantine(fname)
+                # The server may have closed the connection
+                conn.close()
+            else:
+                os.unlink(fname)
+    except (HTTPException, IOError, OSError) as e:
+        print("Error posting to webhook: {}".format(e))
+        return False
+    finally:
+        conn.close()
+    return True
+
+
+def notify(cfg, payload):
+    """
+    Send *payload*, or spool it if that fails or earlier payloads are still
+    waiting, so the push is held up by at most one attempt. Payloads
+    saltbot rejects are dropped. Returns True if nothing is left to retry.
+    """
+    if spooled():
+        spool(payload)
+        return False
+    url = cfg['hooks.webhookurl']
+    secret = cfg['hooks.webhooksecret']
+    timeout = float(cfg.get('hooks.webhooktimeout', 5))
+    conn, path = connect(url, timeout)
     try:
-        urlopen(req)
-    except URLError as e:
+        post(conn, path, payload, secret)
+    except Rejected as e:
+        print("Notification rejected: {}".format(e))
+    except (HTTPException, IOError, OSError) as e:
         print("Error posting to webhook: {}".format(e))
+        spool(payload)
+        return False
+    finally:
+        conn.close()
+    return True
+
+
+def start_retry():
+    """Start a detached process to retry spooled payloads."""
+    with open(os.devnull, "r+") as devnull:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                          "--retry"], stdin=devnull, stdout=devnull,
+                         stderr=devnull, close_fds=True,
+                         preexec_fn=os.setsid)
+
+
+def retry(cfg):
+    """Retry spooled payloads with backoff, one retrier at a time."""
+    lock = os.path.join(spool_path(), ".lock")
+    try:
+        if time.time() - os.stat(lock).st_mtime > sum(RETRY_DELAYS) * 2:
+            os.unlink(lock)
+    except OSError:
+        pass
+    try:
+        os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except OSError:
+        return
+    try:
+        for delay in RETRY_DELAYS:
+            time.sleep(delay)
+            if not spooled() or deliver(cfg):
+                break
+    finally:
+        os.unlink(lock)
+
 
 if __name__ == "__main__":
-    for line in sys.stdin.readlines():
-        old, new, ref = line.strip().split()
-        data = make_data(old, new, ref)
-        url = cfg('hooks.webhookurl').strip()
-        secret = cfg('hooks.webhooksecret').strip()
-        if url and secret:
-            print("Submitting notification to {}".format(url))
-            post(url, data, secret)
-        else:
-            print("Error: No webhook URL or secret configured")
+    cfg = get_config()
+    if not cfg.get('hooks.webhookurl') or not cfg.get('hooks.webhooksecret'):
+        print("Error: No webhook URL or secret configured")
+        sys.exit()
+
+    if sys.argv[1:] == ["--retry"]:
+        retry(cfg)
+        sys.exit()
+
+    refs = [line.strip().split() for line in sys.stdin.readlines()
+            if line.strip()]
+    data = make_data(refs)
+    if data is None:
+        sys.exit()
+    payload = {"delivery": str(uuid.uuid4()), "body": data}
+    print("Submitting notification to {}".format(cfg['hooks.webhookurl']))
+    if not notify(cfg, payload):
+        print("Notification spooled, will retry in the background")
+        start_retry()
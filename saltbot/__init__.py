@@ -21,13 +21,18 @@ except ImportError:
 
 logger = logging.getLogger("saltbot")
 
+from . import logs
 from . import config
+from . import metrics
+from . import tracing
 from . import webapp
 from . import ircbot
 from . import exchange
 from . import saltshaker
+from . import listener
 
-modules = ("config", "webapp", "ircbot", "exchange", "saltshaker")
+modules = ("config", "webapp", "ircbot", "exchange", "saltshaker",
+           "listener")
 
 
 class SaltBot:
@@ -39,6 +44,7 @@ class SaltBot:
             "reload": self.command_reload,
             "highstate": self.command_highstate,
             "ship": self.command_ship,
+            "cancel": self.command_cancel,
             "help": self.command_help,
         }
 
@@ -58,6 +64,20 @@ class SaltBot:
         self.sltcq = multiprocessing.Queue()
         # Salt Result Queue, salt->exchange
         self.sltrq = multiprocessing.Queue()
+        # Log Queue, *->core, if queued logging is enabled
+        if self.cfg['log_queue']['enabled']:
+            self.logq = multiprocessing.Queue()
+            self.loglistener = logs.LogListener(self.logq)
+            self.loglistener.start()
+        else:
+            self.logq = None
+            self.loglistener = None
+        # Metrics Queue, *->core, if metrics are enabled
+        if self.cfg['metrics']['enabled']:
+            self.start_metrics()
+        else:
+            self.metq = None
+        self.channels = {"log": self.logq, "metrics": self.metq}
 
         # Respond to signals again
         self.unblock_sigs()
@@ -66,6 +86,10 @@ class SaltBot:
         self.start_irc()
         self.start_slt()
         self.start_web()
+        if self.cfg['listener']['enabled']:
+            self.start_lsn()
+        else:
+            self.lsnp = None
 
         while True:
             self.main()
@@ -80,11 +104,31 @@ class SaltBot:
         signal.signal(signal.SIGHUP, self.signal)
         signal.signal(signal.SIGTERM, self.signal)
 
+    def start_metrics(self):
+        logger.info("Starting metrics listener")
+        self.metq = multiprocessing.Queue(10000)
+        metrics.configure(self.metq)
+        self.registry = metrics.Registry(self.metq)
+        self.registry.add_collector(self.collect_queue_depths)
+        self.registry.start()
+        metrics.serve(self.registry, self.cfg['metrics']['host'],
+                      self.cfg['metrics']['port'])
+
+    def collect_queue_depths(self):
+        for name in "ircmq", "irccq", "webpq", "sltcq", "sltrq":
+            try:
+                depth = getattr(self, name).qsize()
+            except NotImplementedError:
+                return
+            self.registry.update("gauge", "saltbot_queue_depth",
+                                 (("queue", name),), depth)
+
     def start_exc(self):
         logger.info("Starting Exchange process")
         self.excp = multiprocessing.Process(
-            target=exchange.run, name="Saltbot Exchange",
-            args=(self.cfg, self.ircmq, self.webpq, self.sltcq, self.sltrq))
+            target=run_child, name="Saltbot Exchange",
+            args=(exchange.run, self.cfg, self.channels,
+                  self.ircmq, self.webpq, self.sltcq, self.sltrq))
         self.excp.daemon = True
         self.block_sigs()
         self.excp.start()
@@ -93,8 +137,9 @@ class SaltBot:
     def start_irc(self):
         logger.info("Starting IRC process")
         self.ircp = multiprocessing.Process(
-            target=ircbot.run, name="Saltbot IRC",
-            args=(self.cfg, self.ircmq, self.irccq))
+            target=run_child, name="Saltbot IRC",
+            args=(ircbot.run, self.cfg, self.channels,
+                  self.ircmq, self.irccq))
         self.ircp.daemon = True
         self.block_sigs()
         self.ircp.start()
@@ -103,8 +148,9 @@ class SaltBot:
     def start_slt(self):
         logger.info("Starting Salt process")
         self.sltp = multiprocessing.Process(
-            target=saltshaker.run, name="Saltbot Salt",
-            args=(self.cfg, self.sltcq, self.sltrq))
+            target=run_child, name="Saltbot Salt",
+            args=(saltshaker.run, self.cfg, self.channels,
+                  self.sltcq, self.sltrq))
         self.sltp.daemon = True
         self.block_sigs()
         self.sltp.start()
@@ -113,13 +159,23 @@ class SaltBot:
     def start_web(self):
         logger.info("Starting web process")
         self.webp = multiprocessing.Process(
-            target=webapp.run, name="Saltbot Web",
-            args=(self.cfg, self.webpq))
+            target=run_child, name="Saltbot Web",
+            args=(webapp.run, self.cfg, self.channels, self.webpq))
         self.webp.daemon = True
         self.block_sigs()
         self.webp.start()
         self.unblock_sigs()
 
+    def start_lsn(self):
+        logger.info("Starting event listener process")
+        self.lsnp = multiprocessing.Process(
+            target=run_child, name="Saltbot Listener",
+            args=(listener.run, self.cfg, self.channels))
+        self.lsnp.daemon = True
+        self.block_sigs()
+        self.lsnp.start()
+        self.unblock_sigs()
+
     def main(self):
         """
         Check all child processes are still alive and restart if required.
@@ -131,16 +187,26 @@ class SaltBot:
             # Restart dead child processes
             if not self.ircp.is_alive():
                 logger.warn("IRC process died, restarting")
+                metrics.inc("saltbot_child_restarts_total", process="irc")
                 self.start_irc()
             if not self.webp.is_alive():
                 logger.warn("Web process died, restarting")
+                metrics.inc("saltbot_child_restarts_total", process="web")
                 self.start_web()
             if not self.sltp.is_alive():
                 logger.warn("Salt process died, restarting")
+                metrics.inc("saltbot_child_restarts_total", process="salt")
                 self.start_slt()
             if not self.excp.is_alive():
                 logger.warn("Exchange process died, restarting")
+                metrics.inc("saltbot_child_restarts_total",
+                            process="exchange")
                 self.start_exc()
+            if self.lsnp is not None and not self.lsnp.is_alive():
+                logger.warn("Listener process died, restarting")
+                metrics.inc("saltbot_child_restarts_total",
+                            process="listener")
+                self.start_lsn()
 
             # Handle commands from IRC
             try:
@@ -150,6 +216,8 @@ class SaltBot:
             else:
                 if cmd == "cmd":
                     self.process_irc_command(*args)
+                elif cmd == "trace":
+                    self.webpq.put(("trace_stamp", args))
 
             time.sleep(1)
         except Exception:
@@ -169,7 +237,7 @@ class SaltBot:
 
     def terminate(self):
         logger.warn("Shutting down child processes")
-        children = "excp", "sltp", "ircp", "webp"
+        children = "excp", "sltp", "ircp", "webp", "lsnp"
         for child in children:
             if hasattr(self, child) and getattr(self, child) is not None:
                 try:
@@ -183,6 +251,8 @@ class SaltBot:
                 except AttributeError:
                     pass
         logger.warn("Final exit")
+        if getattr(self, 'loglistener', None) is not None:
+            self.loglistener.stop()
         sys.exit()
 
     def process_irc_command(self, who, message):
@@ -211,6 +281,7 @@ class SaltBot:
         self.irc_send(who, "  say <message>        Says <message> on IRC")
         self.irc_send(who, "  ship <'it'|target>   Ship it!")
         self.irc_send(who, "  highstate <target> [expr_form] [wait_gitfs]")
+        self.irc_send(who, "  cancel <jid> [kill] | cancel queue <id>")
         self.irc_send(who, "  reload <module>    Reloads <module>, one of:")
         self.irc_send(who, "    {}".format(", ".join(modules)))
 
@@ -241,6 +312,10 @@ class SaltBot:
                 self.excp.terminate()
                 self.excp.join()
                 self.start_exc()
+            elif arg == "listener" and self.lsnp is not None:
+                self.lsnp.terminate()
+                self.lsnp.join()
+                self.start_lsn()
 
     def command_highstate(self, who, arg):
         if not arg or len(arg.split()) < 1:
@@ -262,6 +337,7 @@ class SaltBot:
         else:
             event["wait_gitfs"] = False
 
+        event["trace"] = tracing.new()
         logger.info("Sending IRC highstate request")
         self.irc_send(who, "Highstate request received, processing")
         self.webpq.put(("irc_highstate", event))
@@ -279,11 +355,35 @@ class SaltBot:
 
         event = {"who": who, "target": target, "wait_gitfs": False}
         event['expr_form'] = self.cfg['commands']['ship']['expr_form']
+        event['options'] = dict(
+            (k, v) for (k, v) in self.cfg['commands']['ship'].items()
+            if k in ('batch', 'halt_on_failures'))
+        event['trace'] = tracing.new()
         logger.info("Sending highstate request via IRC ship")
         self.irc_send(
             who, "Ship request received, highstating {}".format(target))
         self.webpq.put(("irc_highstate", event))
 
+    def command_cancel(self, who, arg):
+        args = (arg or "").split()
+        kind = "job"
+        if args and args[0] == "queue":
+            kind = "queue"
+            args = args[1:]
+        if not args or len(args) > 2 or (len(args) == 2 and
+                                         args[1] != "kill"):
+            self.irc_send(who, "Usage: cancel <jid> [kill] | "
+                               "cancel queue <id>")
+            logger.info("Invalid IRC cancel received")
+            return
+
+        kill = len(args) == 2 or self.cfg['salt']['kill_on_cancel']
+        logger.info("Sending IRC cancel request")
+        self.irc_send(who, "Cancelling {}{}".format(
+            "queued highstate " if kind == "queue" else "", args[0]))
+        self.webpq.put(("cancel", {"kind": kind, "id": args[0], "kill": kill,
+                                   "who": who}))
+
     def command_quit(self, who, arg):
         self.irc_send(who, "Shutting down.")
         logger.warn("Quitting due to command")
@@ -296,6 +396,17 @@ class SaltBot:
             self.irc_send(who, "Must specify a message")
 
 
+def run_child(target, config, channels, *args):
+    """
+    Entry point for child processes: route logging and metrics through the
+    queues in *channels* if enabled, then run target(config, *args).
+    """
+    if channels['log'] is not None:
+        logs.configure_child(channels['log'], config['log_queue'])
+    metrics.configure(channels['metrics'])
+    target(config, *args)
+
+
 def main():
     """
     Runs Saltbot
@@ -320,6 +431,17 @@ def createtables():
         print("Received error, ignoring:", e)
 
 
+def migratetables():
+    """
+    Adds any new tables, columns and indexes to existing DB tables
+    Entry point: saltbot-migratetables
+    """
+    from . import database
+    saltbot = SaltBot()
+    db = database.Database(saltbot.cfg)
+    db.migrate_tables()
+
+
 def droptables():
     """
     Drops DB tables
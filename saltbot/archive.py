@@ -0,0 +1,258 @@
+# Saltbot
+# Copyright 2015 Adam Greig
+# Licensed under the MIT license, see LICENCE file for details.
+
+"""
+Cold storage for old jobs.
+
+Old jobs' minions and results are moved out of the database into segment
+files of newline-delimited JSON. Each record is compressed as its own gzip
+member, so a segment is an ordinary .ndjson.gz file that zcat can read
+whole, while any one record can be decompressed on its own given its
+offset. Next to each segment is a binary index of fixed-size entries sorted
+by (kind, id), which is memory-mapped and binary searched to find records.
+
+A job's record holds its minions as /api/jobs/<jid> returns them, and each
+minion's record holds its results as /api/jobs/<jid>/minions/<id> does,
+so archived jobs can be served without touching the rest of the segment.
+The SaltJob row itself stays in the database, with `archived` naming the
+segment it was moved to.
+"""
+
+from __future__ import print_function
+
+import io
+import os
+import sys
+import json
+import gzip
+import mmap
+import zlib
+import time
+import struct
+import logging
+import argparse
+import datetime
+
+from . import config
+from . import ingest
+from .database import Database, SaltJob, SaltJobMinion, SaltMinionResult
+from .serialisers import serialise
+
+logger = logging.getLogger("saltbot.archive")
+
+# Index entries: kind, id, offset and length of the record
+ENTRY = struct.Struct(">BQQI")
+JOB, MINION = 0, 1
+
+
+def compress(record):
+    """*record* as a line of JSON in a gzip member of its own."""
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb") as f:
+        f.write(json.dumps(record).encode("utf-8") + b"\n")
+    return buf.getvalue()
+
+
+def segment_paths(archive_dir, segment):
+    base = os.path.join(archive_dir, segment)
+    return base + ".ndjson.gz", base + ".idx"
+
+
+class SegmentWriter:
+    """
+    Writes one segment and its index. Nothing is visible under the final
+    names until close() has synced both to disk.
+    """
+    def __init__(self, archive_dir, segment):
+        self.segment = segment
+        self.data_path, self.index_path = segment_paths(archive_dir, segment)
+        self.f = open(self.data_path + ".tmp", "wb")
+        self.offset = 0
+        self.entries = []
+
+    def add(self, kind, ident, record):
+        data = compress(record)
+        self.f.write(data)
+        self.entries.append((kind, ident, self.offset, len(data)))
+        self.offset += len(data)
+
+    def close(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        with open(self.index_path + ".tmp", "wb") as f:
+            for entry in sorted(self.entries):
+                f.write(ENTRY.pack(*entry))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(self.data_path + ".tmp", self.data_path)
+        os.rename(self.index_path + ".tmp", self.index_path)
+        return self.offset
+
+
+def find_entry(index, kind, ident):
+    """Binary search the mmapped *index* for (kind, ident)."""
+    lo, hi = 0, len(index) // ENTRY.size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        entry = ENTRY.unpack_from(index, mid * ENTRY.size)
+        if entry[:2] < (kind, ident):
+            lo = mid + 1
+        elif entry[:2] > (kind, ident):
+            hi = mid
+        else:
+            return entry
+    return None
+
+
+def read_record(archive_dir, segment, kind, ident):
+    """The record for (kind, ident) in *segment*, or None if it isn't."""
+    data_path, index_path = segment_paths(archive_dir, segment)
+    try:
+        with open(index_path, "rb") as f:
+            index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                entry = find_entry(index, kind, ident)
+            finally:
+                index.close()
+        if entry is None:
+            return None
+        with open(data_path, "rb") as f:
+            f.seek(entry[2])
+            data = f.read(entry[3])
+    except (IOError, OSError):
+        logger.exception("Error reading archive segment {}".format(segment))
+        return None
+    return json.loads(zlib.decompress(data, 16 + zlib.MAX_WBITS)
+                      .decode("utf-8"))
+
+
+def list_segments(archive_dir):
+    """The segments in *archive_dir* and their compressed sizes."""
+    segments = []
+    for name in sorted(os.listdir(archive_dir)):
+        if name.endswith(".ndjson.gz"):
+            segments.append({
+                "segment": name[:-len(".ndjson.gz")],
+                "bytes": os.path.getsize(os.path.join(archive_dir, name))})
+    return segments
+
+
+def archivable(cutoff, late_cutoff):
+    """
+    Jobs started before *cutoff* which are done with and not archived.
+    Partial jobs may still see late returns, so are only done with once
+    they started before *late_cutoff* too.
+    """
+    return (SaltJob.select()
+                   .where(SaltJob.when < cutoff,
+                          SaltJob.archived >> None,
+                          (SaltJob.status >> None) |
+                          ~(SaltJob.status << ["running", "partial"]) |
+                          ((SaltJob.status == "partial") &
+                           (SaltJob.when < late_cutoff)))
+                   .order_by(SaltJob.id))
+
+
+def write_job(writer, job):
+    """Add *job*'s record and its minions' records to *writer*."""
+    minions = []
+    nresults = 0
+    minionsq = (SaltJobMinion.select()
+                             .where(SaltJobMinion.job == job)
+                             .order_by(SaltJobMinion.id.desc()))
+    for minion in minionsq:
+        minion.job = job
+        resultsq = (SaltMinionResult.select()
+                                    .where(SaltMinionResult.minion == minion)
+                                    .order_by(SaltMinionResult.run_num))
+        results = [serialise(r) for r in resultsq.iterator()]
+        nresults += len(results)
+        minion.no_errors = all(r['result'] for r in results)
+        writer.add(MINION, minion.id, {"type": "minion", "jid": job.jid,
+                                       "minion": serialise(minion),
+                                       "results": results})
+        minion.num_results = len(results)
+        minion.num_good = sum(1 for r in results if r['result'])
+        minion.num_changed = sum(1 for r in results if r['changed'])
+        minions.append(serialise(minion))
+    writer.add(JOB, job.id, {"type": "job", "jid": job.jid,
+                             "job": serialise(job), "minions": minions})
+    return len(minions), nresults
+
+
+def delete_jobs(segment, ids):
+    """Mark jobs *ids* as archived to *segment* and delete their rows."""
+    for i in range(0, len(ids), ingest.CHUNK):
+        chunk = ids[i:i + ingest.CHUNK]
+        minions = SaltJobMinion.select(SaltJobMinion.id).where(
+            SaltJobMinion.job << chunk)
+        (SaltMinionResult.delete()
+                         .where(SaltMinionResult.minion << minions)
+                         .execute())
+        SaltJobMinion.delete().where(SaltJobMinion.job << chunk).execute()
+        SaltJob.update(archived=segment).where(SaltJob.id << chunk).execute()
+
+
+def run(cfg, older_than, segment_jobs):
+    archive_dir = cfg['archive']['dir']
+    if not os.path.isdir(archive_dir):
+        os.makedirs(archive_dir)
+    db = Database(cfg)
+    db.connect()
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=older_than)
+    late_cutoff = cutoff - datetime.timedelta(
+        seconds=cfg['salt']['late_returns'])
+    start = time.time()
+    njobs = nresults = nbytes = 0
+    try:
+        while True:
+            jobs = list(archivable(cutoff, late_cutoff).limit(segment_jobs))
+            if not jobs:
+                break
+            segment = "jobs-{:010d}-{:010d}".format(jobs[0].id, jobs[-1].id)
+            writer = SegmentWriter(archive_dir, segment)
+            for job in jobs:
+                nresults += write_job(writer, job)[1]
+            nbytes += writer.close()
+            # Only delete once the segment is safely on disk; if we stop
+            # before this commits, the jobs are archived again next time.
+            with db.db.atomic():
+                delete_jobs(segment, [job.id for job in jobs])
+            njobs += len(jobs)
+            print("Archived {} jobs to {}".format(len(jobs), segment))
+    finally:
+        db.close()
+    print("Archived {} jobs ({} results, {} bytes compressed) in {:.1f}s"
+          .format(njobs, nresults, nbytes, time.time() - start))
+
+
+def main():
+    """
+    Moves old jobs out of the database into the archive
+    Entry point: saltbot-archive
+    """
+    parser = argparse.ArgumentParser(
+        description="Archive old jobs' results to compressed segments")
+    parser.add_argument("--config", default="saltbot.yml")
+    parser.add_argument("--older-than", type=float, metavar="DAYS",
+                        help="archive jobs older than this "
+                             "(default archive.older_than)")
+    parser.add_argument("--segment-jobs", type=int,
+                        help="jobs per segment (default "
+                             "archive.segment_jobs)")
+    args = parser.parse_args()
+
+    cfg = config.ConfigParser().load(args.config)
+    if not cfg['archive']['dir']:
+        print("Set archive.dir in the config to archive jobs")
+        return 1
+    older_than = args.older_than
+    if older_than is None:
+        older_than = cfg['archive']['older_than']
+    run(cfg, older_than, args.segment_jobs or cfg['archive']['segment_jobs'])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
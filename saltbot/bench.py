@@ -0,0 +1,420 @@
+# Saltbot
+# Copyright 2015 Adam Greig
+# Licensed under the MIT license, see LICENCE file for details.
+
+"""
+Benchmarks for Saltbot, run against fakesalt and throwaway databases.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import math
+import shutil
+import datetime
+import random
+import logging
+import argparse
+import resource
+import tempfile
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from peewee import fn
+
+from . import fakesalt, database, ingest, saltshaker, webapp
+from .database import GitHubPush, SaltJob, SaltJobMinion, SaltMinionResult
+
+logger = logging.getLogger("saltbot.bench")
+
+
+def make_config(dbcfg):
+    """A minimal Saltbot config for benchmarking against *dbcfg*."""
+    return {"database": dbcfg,
+            "web": {"per_page": 20, "profile": {"enabled": False}},
+            "salt": {"job_deadline": None, "minion_deadline": None,
+                     "late_returns": 3600, "batch": None,
+                     "halt_on_failures": None, "aging": 300,
+                     "kill_on_cancel": False}}
+
+
+def percentile(values, p):
+    """Nearest-rank percentile *p* (0-100) of *values*."""
+    if not values:
+        return None
+    values = sorted(values)
+    k = max(0, int(round(p / 100.0 * len(values))) - 1)
+    return values[min(k, len(values) - 1)]
+
+
+def peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X reports bytes
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+class TimedQueue(Queue):
+    """Records when each salt_result summary is put on the queue."""
+    def __init__(self):
+        Queue.__init__(self)
+        self.summaries = []
+
+    def put(self, item, *args, **kwargs):
+        if item[0] == "salt_result":
+            self.summaries.append(time.time())
+        Queue.put(self, item, *args, **kwargs)
+
+
+def bench_ingest(dbcfg, args):
+    """Run args.jobs highstates through SaltShaker into the *dbcfg* DB."""
+    random.seed(args.seed)
+    sltrq = TimedQueue()
+    shaker = saltshaker.SaltShaker(make_config(dbcfg), Queue(), sltrq)
+    shaker.db.db.create_tables(database.tables, safe=True)
+    shaker.db.create_search_index()
+    shaker.client = fakesalt.client.LocalClient(
+        minions=args.minions, states=(args.states, args.states),
+        output_size=args.output_size, failure_rate=args.failure_rate,
+        seed=args.seed)
+
+    summary_times = []
+    start = time.time()
+    for _ in range(args.jobs):
+        job_start = time.time()
+        shaker.highstate("*", "glob", False, None)
+        summary_times.append(sltrq.summaries[-1] - job_start)
+    elapsed = time.time() - start
+    results = database.SaltMinionResult.select().count()
+    shaker.db.close()
+
+    return {
+        "jobs": args.jobs,
+        "results": results,
+        "seconds": round(elapsed, 3),
+        "jobs_per_sec": round(args.jobs / elapsed, 3),
+        "results_per_sec": round(results / elapsed, 1),
+        "p50_summary_ms": round(percentile(summary_times, 50) * 1000, 2),
+        "p99_summary_ms": round(percentile(summary_times, 99) * 1000, 2),
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+
+class HistoryGenerator:
+    """
+    Generates realistic, skewed job history straight into the database
+    with bulk inserts.
+
+    A few minions appear in most jobs while most appear rarely, most jobs
+    target a handful of minions while some hit much of the fleet, each
+    minion has its own stable set of states, and failures are concentrated
+    on a few flaky minions and the occasional bad push.
+    """
+    def __init__(self, db, minions, states, output_size, seed):
+        self.db = db
+        self.rng = random.Random(seed)
+        self.output_size = output_size
+        self.minions = ["minion{:05d}.example.com".format(i)
+                        for i in range(minions)]
+        # Zipf-like popularity, and per-minion state counts and flakiness
+        self.weights = [1.0 / (i + 1) for i in range(minions)]
+        self.states = dict(
+            (m, max(1, int(self.rng.lognormvariate(math.log(states), 0.5))))
+            for m in self.minions)
+        self.flakiness = dict(
+            (m, 0.3 if self.rng.random() < 0.05 else 0.005)
+            for m in self.minions)
+        self.next_ids = dict((model, 1) for model in
+                             (GitHubPush, SaltJob, SaltJobMinion,
+                              SaltMinionResult))
+        self.jobs = 0
+
+    def take_ids(self, model, n):
+        first = self.next_ids[model]
+        self.next_ids[model] += n
+        return range(first, first + n)
+
+    def pick_minions(self):
+        """Weighted sample of minions without replacement."""
+        n = min(len(self.minions), int(self.rng.paretovariate(1.2)))
+        keys = [(self.rng.random() ** (1.0 / w), m)
+                for m, w in zip(self.minions, self.weights)]
+        return sorted(m for _, m in sorted(keys, reverse=True)[:n])
+
+    def generate(self, n):
+        """Add *n* more jobs of history."""
+        pushes, jobs, jobminions, results = [], [], [], []
+        start = datetime.datetime(2015, 1, 1)
+        comment = "Lorem ipsum dolor sit amet " * (self.output_size // 27)
+        for push_id, job_id in zip(self.take_ids(GitHubPush, n),
+                                   self.take_ids(SaltJob, n)):
+            when = start + datetime.timedelta(minutes=10 * self.jobs)
+            self.jobs += 1
+            pushes.append({
+                "id": push_id, "when": when, "gitref": "refs/heads/master",
+                "repo_name": "example/states", "repo_url": "#",
+                "commit_id": "{:040x}".format(push_id),
+                "commit_msg": "Bench",
+                "commit_ts": when.isoformat(), "commit_url": "#",
+                "commit_author": "bench", "pusher": "bench"})
+            jobs.append({
+                "id": job_id, "when": when, "expr_form": "glob",
+                "jid": "{}{:06d}".format(when.strftime("%Y%m%d%H%M%S"),
+                                         job_id),
+                "target": "*", "github_push": push_id})
+            bad_push = self.rng.random() < 0.02
+            minions = self.pick_minions()
+            finished = when
+            for minion, jm_id in zip(
+                    minions, self.take_ids(SaltJobMinion, len(minions))):
+                nstates = self.states[minion]
+                durations = [round(self.rng.lognormvariate(3, 1.5), 3)
+                             for _ in range(nstates)]
+                returned = when + datetime.timedelta(
+                    milliseconds=sum(durations) + self.rng.expovariate(0.001))
+                finished = max(finished, returned)
+                jobminions.append({"id": jm_id, "job": job_id,
+                                   "minion": minion, "returned": returned})
+                fail_p = 0.5 if bad_push else self.flakiness[minion]
+                for k, r_id in enumerate(
+                        self.take_ids(SaltMinionResult, nstates)):
+                    ok = self.rng.random() >= fail_p
+                    changed = self.rng.random() < 0.2
+                    output = {"comment": comment, "result": ok,
+                              "changes": {"diff": "..."} if changed else {},
+                              "__run_num__": k}
+                    results.append({
+                        "id": r_id, "minion": jm_id,
+                        "key_state": fakesalt.states[k % 6],
+                        "key_id": "state{}".format(k),
+                        "key_name": "/srv/state{}".format(k),
+                        "key_func": fakesalt.funcs[k % 6],
+                        "comment": comment, "run_num": k,
+                        "changed": changed, "result": ok,
+                        "duration": durations[k],
+                        "start": when.strftime("%H:%M:%S.%f"),
+                        "output": json.dumps(output)})
+            jobs[-1]['finished'] = finished
+
+        with self.db.atomic():
+            ingest.bulk_insert(GitHubPush, pushes)
+            ingest.bulk_insert(SaltJob, jobs)
+            ingest.bulk_insert(SaltJobMinion, jobminions)
+            ingest.bulk_insert(SaltMinionResult, results)
+
+
+def bench_endpoints(client, args):
+    """Hit each API endpoint args.requests times and report latencies."""
+    rng = random.Random(args.seed)
+    jobs = list(SaltJob.select(SaltJob.id, SaltJob.jid))
+    pages = SaltJob.select().count() // 20 + 1
+    busiest = (SaltJobMinion.select(SaltJobMinion.minion)
+               .group_by(SaltJobMinion.minion)
+               .order_by(fn.Count(SaltJobMinion.id).desc())
+               .scalar())
+    endpoints = {
+        "/api/jobs/": lambda: "/api/jobs/",
+        "/api/jobs/?page=<deep>":
+            lambda: "/api/jobs/?page={}".format(rng.randint(1, pages)),
+        "/api/jobs/<jid>": lambda: "/api/jobs/{}".format(
+            rng.choice(jobs).jid),
+        "/api/jobs/<jid>/minions/<id>": random_minion_url(rng),
+        "/api/jobs/<jid>/slowest": lambda: "/api/jobs/{}/slowest".format(
+            rng.choice(jobs).jid),
+        "/api/jobs/<jid>/diff?against=<jid>": lambda: (
+            "/api/jobs/{}/diff?against={}".format(
+                *[j.jid for j in rng.sample(jobs, 2)])),
+        "/api/states/slowest?jobs=100":
+            lambda: "/api/states/slowest?jobs=100",
+        "/api/jobs/durations?bucket=week":
+            lambda: "/api/jobs/durations?bucket=week&days=36500",
+        "/api/minions/stragglers": lambda: "/api/minions/stragglers",
+        "/api/fleet": lambda: "/api/fleet",
+        "/api/fleet?status=failing": lambda: "/api/fleet?status=failing",
+        "/api/minions/<busiest>": lambda: "/api/minions/{}".format(busiest),
+        "/api/search?q=<id>": lambda: "/api/search?q=state{}".format(
+            rng.randrange(100)),
+        "/api/minions/<busiest>/states/<id>":
+            lambda: "/api/minions/{}/states/state{}".format(
+                busiest, rng.randrange(10)),
+    }
+
+    report = {}
+    for name, make_url in sorted(endpoints.items()):
+        times = []
+        for _ in range(args.requests):
+            url = make_url()
+            start = time.time()
+            resp = client.get(url)
+            times.append(time.time() - start)
+            if resp.status_code != 200:
+                raise RuntimeError("{} returned {}".format(
+                    url, resp.status_code))
+        report[name] = {
+            "p50_ms": round(percentile(times, 50) * 1000, 2),
+            "p95_ms": round(percentile(times, 95) * 1000, 2),
+            "p99_ms": round(percentile(times, 99) * 1000, 2),
+            "requests_per_sec": round(len(times) / sum(times), 1),
+        }
+    return report
+
+
+def random_minion_url(rng):
+    minions = list(SaltJobMinion.select(SaltJobMinion.id, SaltJob.jid)
+                   .join(SaltJob).tuples())
+
+    def make_url():
+        mid, jid = rng.choice(minions)
+        return "/api/jobs/{}/minions/{}".format(jid, mid)
+    return make_url
+
+
+def check_regressions(report, baseline, tolerance):
+    """
+    Compare *report* against *baseline*, returning a list of descriptions
+    of any throughput or latency more than *tolerance* worse.
+    """
+    failures = []
+    for name, result in report.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        for key in result:
+            if key not in base or not base[key]:
+                continue
+            if key.endswith("_per_sec"):
+                worse = result[key] < base[key] * (1 - tolerance)
+            elif key.endswith("_ms"):
+                worse = result[key] > base[key] * (1 + tolerance)
+            else:
+                continue
+            if worse:
+                failures.append("{} {}: {} vs baseline {}".format(
+                    name, key, result[key], base[key]))
+    return failures
+
+
+def finish(report, args):
+    """Print or save *report*, then compare it against any baseline."""
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        failures = check_regressions(report, baseline, args.tolerance)
+        for failure in failures:
+            print("Regression:", failure, file=sys.stderr)
+        if failures:
+            sys.exit(1)
+
+
+def add_report_args(parser):
+    parser.add_argument("--seed", type=int, default=0,
+                        help="random seed for generated data")
+    parser.add_argument("--json", metavar="FILE",
+                        help="write results as JSON to FILE")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="fail if results regress against this JSON")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed fractional regression (default 0.2)")
+
+
+def ingest_main():
+    """
+    Benchmarks result ingestion
+    Entry point: saltbot-bench-ingest
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark Saltbot result ingestion using fakesalt")
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--minions", type=int, default=50)
+    parser.add_argument("--states", type=int, default=40,
+                        help="states per minion")
+    parser.add_argument("--output-size", type=int, default=0,
+                        help="approximate bytes of output per state")
+    parser.add_argument("--failure-rate", type=float, default=0.1)
+    parser.add_argument("--db", choices=("sqlite", "memory", "both"),
+                        default="both")
+    add_report_args(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    report = {}
+    if args.db in ("memory", "both"):
+        report["memory"] = bench_ingest(
+            {"engine": "sqlite", "file": ":memory:"}, args)
+    if args.db in ("sqlite", "both"):
+        tmpdir = tempfile.mkdtemp(prefix="saltbot-bench-")
+        try:
+            report["sqlite"] = bench_ingest(
+                {"engine": "sqlite",
+                 "file": os.path.join(tmpdir, "bench.sqlite")}, args)
+        finally:
+            shutil.rmtree(tmpdir)
+    finish(report, args)
+
+
+def api_main():
+    """
+    Benchmarks API latency against generated history
+    Entry point: saltbot-bench-api
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark Saltbot API latency at several history sizes")
+    parser.add_argument("--sizes", default="100,1000,10000",
+                        help="comma separated numbers of jobs of history")
+    parser.add_argument("--minions", type=int, default=500,
+                        help="size of the fleet jobs are drawn from")
+    parser.add_argument("--states", type=int, default=40,
+                        help="typical states per minion")
+    parser.add_argument("--output-size", type=int, default=200,
+                        help="approximate bytes of output per state")
+    parser.add_argument("--requests", type=int, default=50,
+                        help="requests per endpoint at each size")
+    add_report_args(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    sizes = sorted(int(n) for n in args.sizes.split(","))
+
+    tmpdir = tempfile.mkdtemp(prefix="saltbot-bench-")
+    dbcfg = {"engine": "sqlite", "file": os.path.join(tmpdir, "api.sqlite")}
+    config = make_config(dbcfg)
+    webapp.app.config.update(config)
+    client = webapp.app.test_client()
+
+    report = {}
+    try:
+        db = database.Database(config)
+        db.create_tables()
+        db.connect()
+        generator = HistoryGenerator(db.db, args.minions, args.states,
+                                     args.output_size, args.seed)
+        for size in sizes:
+            start = time.time()
+            generator.generate(size - generator.jobs)
+            populate = time.time() - start
+            # History is bulk inserted, so bring the fleet state up to date
+            ingest.rebuild_fleet()
+            rows = SaltMinionResult.select().count()
+            logger.warning("Populated {} jobs ({} results) in {:.1f}s"
+                           .format(size, rows, populate))
+            result = bench_endpoints(client, args)
+            # Report each endpoint at each size as a separate benchmark so
+            # that baselines compare like with like.
+            for endpoint, stats in result.items():
+                report["{} @ {} jobs".format(endpoint, size)] = stats
+            report["populate @ {} jobs".format(size)] = {
+                "results": rows, "rows_per_sec": round(rows / populate, 1)}
+        db.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    finish(report, args)
@@ -5,6 +5,7 @@
 import sys
 import logging
 import logging.config
+import logging.handlers
 
 import yaml
 
@@ -12,13 +13,15 @@ logger = logging.getLogger("saltbot.config")
 
 
 class ConfigParser:
-    def load(self):
-        if len(sys.argv) == 1:
-            cfile = "saltbot.yml"
-        elif len(sys.argv) == 2:
-            cfile = sys.argv[1]
-        else:
-            raise ValueError("Usage: {} [config.yml]".format(sys.argv[0]))
+    def load(self, cfile=None):
+        if cfile is None:
+            if len(sys.argv) == 1:
+                cfile = "saltbot.yml"
+            elif len(sys.argv) == 2:
+                cfile = sys.argv[1]
+            else:
+                raise ValueError(
+                    "Usage: {} [config.yml]".format(sys.argv[0]))
         self.cfg = yaml.safe_load(open(cfile).read())
         self.check_config()
         self.configure_logging()
@@ -35,6 +38,12 @@ class ConfigParser:
         self.check_github_config()
         self.check_commands_config()
         self.check_repos_config()
+        self.check_log_queue_config()
+        self.check_metrics_config()
+        self.check_salt_config()
+        self.check_listener_config()
+        self.check_archive_config()
+        self.check_fakesalt_config()
 
     def check_web_config(self):
         web = self.cfg['web']
@@ -49,6 +58,24 @@ class ConfigParser:
         except ValueError:
             raise ValueError("web.per_page must be an integer")
 
+        if 'api_token' not in web:
+            self.cfg['web']['api_token'] = None
+        elif web['api_token'] is not None:
+            # YAML may have parsed a numeric token as a number
+            web['api_token'] = str(web['api_token'])
+
+        profile = web.get('profile') or {}
+        self.cfg['web']['profile'] = profile
+        profile['enabled'] = bool(profile.get('enabled', False))
+        profile['server_timing'] = bool(profile.get('server_timing', False))
+        profile['explain'] = bool(profile.get('explain', False))
+        try:
+            profile['threshold_ms'] = float(profile.get('threshold_ms', 100))
+            profile['slowest'] = int(profile.get('slowest', 5))
+        except (TypeError, ValueError):
+            raise ValueError("web.profile.threshold_ms and web.profile.slowest"
+                             " must be numbers")
+
         if not (
                 ('socket' in web and 'mode' in web) or
                 ('host' in web and 'port' in web)):
@@ -78,10 +105,26 @@ class ConfigParser:
             if 'password' not in irc:
                 self.cfg['irc']['password'] = None
                 logger.warn("No IRC password specified, will not identify")
+        if 'ident_ttl' not in irc:
+            self.cfg['irc']['ident_ttl'] = 60
+        try:
+            self.cfg['irc']['ident_ttl'] = int(irc['ident_ttl'])
+        except (TypeError, ValueError):
+            raise ValueError("irc.ident_ttl must be an integer")
+        if 'ident_timeout' not in irc:
+            self.cfg['irc']['ident_timeout'] = 30
+        self.check_seconds(irc, 'ident_timeout', "irc")
 
     def check_github_config(self):
         if 'secret' not in self.cfg['github']:
             raise ValueError("Missing required github.secret setting")
+        if 'delivery_history' not in self.cfg['github']:
+            self.cfg['github']['delivery_history'] = 1000
+        try:
+            self.cfg['github']['delivery_history'] = int(
+                self.cfg['github']['delivery_history'])
+        except (TypeError, ValueError):
+            raise ValueError("github.delivery_history must be an integer")
 
     def check_commands_config(self):
         cmds = self.cfg['commands']
@@ -94,6 +137,8 @@ class ConfigParser:
             raise ValueError("Missing commands.ship.target")
         if 'expr_form' not in ship:
             self.cfg['commands']['ship']['expr_form'] = 'glob'
+        for setting in 'batch', 'halt_on_failures':
+            self.check_count(ship, setting, "commands.ship")
 
     def check_repos_config(self):
         repos = self.cfg['repos']
@@ -102,6 +147,126 @@ class ConfigParser:
                 if 'target' not in repos[repo][branch]:
                     raise ValueError("No target specified for repos.{}.{}"
                                      .format(repo, branch))
+                for rule in repos[repo][branch].get('paths', []):
+                    if 'pattern' not in rule or 'target' not in rule:
+                        raise ValueError(
+                            "repos.{}.{}.paths entries need a pattern and "
+                            "a target".format(repo, branch))
+                name = "repos.{}.{}".format(repo, branch)
+                for setting in 'job_deadline', 'minion_deadline':
+                    self.check_seconds(repos[repo][branch], setting, name)
+                for setting in 'batch', 'halt_on_failures':
+                    self.check_count(repos[repo][branch], setting, name)
+                priority = repos[repo][branch].get('priority', 'push')
+                if priority not in ('push', 'bulk'):
+                    raise ValueError("{}.priority must be push or bulk"
+                                     .format(name))
+
+    def check_log_queue_config(self):
+        lq = self.cfg.setdefault('log_queue', {})
+        lq['enabled'] = bool(lq.get('enabled', False))
+        for setting in 'sampling', 'rate_limits':
+            if lq.get(setting) is None:
+                lq[setting] = {}
+            try:
+                lq[setting] = dict((str(k), float(v))
+                                   for k, v in lq[setting].items())
+            except (AttributeError, TypeError, ValueError):
+                raise ValueError("log_queue.{} must map logger names to "
+                                 "numbers".format(setting))
+        if lq['enabled'] and not hasattr(logging.handlers, 'QueueHandler'):
+            logger.warn("Queued logging needs Python 3.2+, disabling")
+            lq['enabled'] = False
+
+    def check_metrics_config(self):
+        m = self.cfg.setdefault('metrics', {})
+        m['enabled'] = 'port' in m
+        m.setdefault('host', 'localhost')
+        if m['enabled']:
+            try:
+                m['port'] = int(m['port'])
+            except (TypeError, ValueError):
+                raise ValueError("metrics.port must be an integer")
+
+    def check_salt_config(self):
+        salt = self.cfg.get('salt') or {}
+        self.cfg['salt'] = salt
+        salt.setdefault('job_deadline', None)
+        salt.setdefault('minion_deadline', None)
+        salt.setdefault('late_returns', 3600)
+        salt.setdefault('batch', None)
+        salt.setdefault('halt_on_failures', None)
+        salt.setdefault('aging', 300)
+        salt['kill_on_cancel'] = bool(salt.get('kill_on_cancel', False))
+        for setting in ('job_deadline', 'minion_deadline', 'late_returns',
+                        'aging'):
+            self.check_seconds(salt, setting, "salt")
+        for setting in 'batch', 'halt_on_failures':
+            self.check_count(salt, setting, "salt")
+
+    def check_listener_config(self):
+        lsn = self.cfg.get('listener') or {}
+        self.cfg['listener'] = lsn
+        lsn['enabled'] = bool(lsn.get('enabled', False))
+        lsn.setdefault('batch_size', 500)
+        lsn.setdefault('max_pending', 20000)
+        lsn.setdefault('flush_interval', 1)
+        lsn.setdefault('grace', 5)
+        for setting in 'batch_size', 'max_pending':
+            try:
+                lsn[setting] = int(lsn[setting])
+            except (TypeError, ValueError):
+                raise ValueError("listener.{} must be an integer"
+                                 .format(setting))
+        for setting in 'flush_interval', 'grace':
+            self.check_seconds(lsn, setting, "listener")
+
+    def check_archive_config(self):
+        arc = self.cfg.get('archive') or {}
+        self.cfg['archive'] = arc
+        arc.setdefault('dir', None)
+        arc.setdefault('older_than', 90)
+        arc.setdefault('segment_jobs', 500)
+        try:
+            arc['older_than'] = float(arc['older_than'])
+        except (TypeError, ValueError):
+            raise ValueError("archive.older_than must be a number of days")
+        try:
+            arc['segment_jobs'] = int(arc['segment_jobs'])
+        except (TypeError, ValueError):
+            raise ValueError("archive.segment_jobs must be an integer")
+
+    def check_seconds(self, section, setting, name):
+        """Make section[setting] a float if it's present and not null."""
+        if section.get(setting) is None:
+            return
+        try:
+            section[setting] = float(section[setting])
+        except (TypeError, ValueError):
+            raise ValueError("{}.{} must be a number of seconds"
+                             .format(name, setting))
+
+    def check_count(self, section, setting, name):
+        """Check section[setting] is a number of minions or a percentage."""
+        value = section.get(setting)
+        if value is None:
+            return
+        try:
+            if str(value).endswith("%"):
+                float(str(value)[:-1])
+            else:
+                section[setting] = int(value)
+        except (TypeError, ValueError):
+            raise ValueError("{}.{} must be a number of minions or a "
+                             "percentage".format(name, setting))
+
+    def check_fakesalt_config(self):
+        fs = self.cfg.get('fakesalt') or {}
+        if not isinstance(fs, dict):
+            raise ValueError("fakesalt must be a mapping of settings")
+        if not isinstance(fs.get('latency', {}), dict):
+            raise ValueError("fakesalt.latency must be a mapping")
+        self.cfg['fakesalt'] = fs
 
     def configure_logging(self):
         logging.config.dictConfig(self.cfg['logs'])
@@ -2,16 +2,45 @@
 # Copyright 2015 Adam Greig
 # Released under the MIT license. See LICENSE file for details.
 
+import time
 import logging
 
+from peewee import OperationalError, ProgrammingError
 from peewee import Proxy, SqliteDatabase, PostgresqlDatabase
 from peewee import Model, CharField, TextField, DateTimeField, ForeignKeyField
-from peewee import BooleanField, IntegerField
+from peewee import BooleanField, IntegerField, FloatField
 
 DBProxy = Proxy()
 logger = logging.getLogger("saltbot.database")
 
 
+class ProfilingMixin(object):
+    """
+    If `query_hook` is set, call it with (sql, params, seconds) after
+    executing each statement.
+    """
+    query_hook = None
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        if self.query_hook is None:
+            return super(ProfilingMixin, self).execute_sql(
+                sql, params, require_commit)
+        start = time.time()
+        try:
+            return super(ProfilingMixin, self).execute_sql(
+                sql, params, require_commit)
+        finally:
+            self.query_hook(sql, params, time.time() - start)
+
+
+class ProfilingSqliteDatabase(ProfilingMixin, SqliteDatabase):
+    pass
+
+
+class ProfilingPostgresqlDatabase(ProfilingMixin, PostgresqlDatabase):
+    pass
+
+
 class BaseModel(Model):
     class Meta:
         database = DBProxy
@@ -30,17 +59,36 @@ class GitHubPush(BaseModel):
     pusher = CharField()
 
 
+class GitHubDelivery(BaseModel):
+    when = DateTimeField()
+    delivery = CharField(unique=True)
+
+
 class SaltJob(BaseModel):
     when = DateTimeField()
     jid = CharField(unique=True)
     expr_form = CharField()
     target = TextField()
     github_push = ForeignKeyField(GitHubPush, related_name='jobs', null=True)
+    trace_id = CharField(null=True)
+    timings = TextField(null=True)
+    status = CharField(null=True)
+    wave = IntegerField(null=True)
+    waves = IntegerField(null=True)
+    finished = DateTimeField(null=True)
+    archived = CharField(null=True)
 
 
 class SaltJobMinion(BaseModel):
     job = ForeignKeyField(SaltJob, related_name='minions')
     minion = CharField()
+    status = CharField(null=True)
+    returned = DateTimeField(null=True)
+
+    class Meta:
+        indexes = (
+            (("minion", "job"), False),
+        )
 
 
 class SaltMinionResult(BaseModel):
@@ -54,9 +102,120 @@ class SaltMinionResult(BaseModel):
     changed = BooleanField(null=True)
     result = BooleanField()
     output = TextField()
+    duration = FloatField(null=True, index=True)
+    start = CharField(null=True)
+
+    class Meta:
+        indexes = (
+            (("key_state", "key_id", "duration"), False),
+            (("minion", "key_id"), False),
+        )
+
+
+class QueuedJob(BaseModel):
+    when = DateTimeField()
+    target = TextField()
+    expr_form = CharField()
+    wait_gitfs = BooleanField()
+    github_push = ForeignKeyField(GitHubPush, related_name='queued', null=True)
+    priority = CharField()
+    repo = CharField(null=True)
+    position = IntegerField(null=True)
+    trace = TextField(null=True)
+    options = TextField(null=True)
 
 
-tables = [GitHubPush, SaltJob, SaltJobMinion, SaltMinionResult]
+# The current state of the fleet: each minion's latest return, and the
+# states which failed in it. These are kept up to date as returns are
+# stored, so don't need aggregating over every result. job_minion is not a
+# foreign key as the SaltJobMinion may since have been archived.
+class FleetMinion(BaseModel):
+    minion = CharField(unique=True)
+    job = ForeignKeyField(SaltJob, related_name='fleet_minions')
+    job_minion = IntegerField()
+    status = CharField(index=True)
+    returned = DateTimeField()
+    num_results = IntegerField()
+    num_failed = IntegerField()
+    num_changed = IntegerField()
+
+
+class FleetFailure(BaseModel):
+    minion = CharField(index=True)
+    key_state = CharField(null=True)
+    key_id = CharField(null=True)
+    key_name = CharField(null=True)
+    key_func = CharField(null=True)
+    comment = TextField(null=True)
+    run_num = IntegerField(null=True)
+
+
+tables = [GitHubPush, GitHubDelivery, SaltJob, SaltJobMinion,
+          SaltMinionResult, QueuedJob, FleetMinion, FleetFailure]
+
+# Full-text search over results, kept up to date by triggers so every way
+# of storing results is covered. SQLite uses an external-content FTS5 table
+# and PostgreSQL a tsvector column with a GIN index. The 'simple' text
+# search configuration is used so paths and error strings aren't stemmed.
+SEARCH_SQLITE = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS saltminionresult_fts USING fts5(
+           key_id, key_name, comment, output,
+           content='saltminionresult', content_rowid='id')""",
+    """CREATE TRIGGER IF NOT EXISTS saltminionresult_fts_insert
+       AFTER INSERT ON saltminionresult BEGIN
+           INSERT INTO saltminionresult_fts
+               (rowid, key_id, key_name, comment, output)
+           VALUES (new.id, new.key_id, new.key_name, new.comment,
+                   new.output);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS saltminionresult_fts_delete
+       AFTER DELETE ON saltminionresult BEGIN
+           INSERT INTO saltminionresult_fts
+               (saltminionresult_fts, rowid, key_id, key_name, comment,
+                output)
+           VALUES ('delete', old.id, old.key_id, old.key_name, old.comment,
+                   old.output);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS saltminionresult_fts_update
+       AFTER UPDATE ON saltminionresult BEGIN
+           INSERT INTO saltminionresult_fts
+               (saltminionresult_fts, rowid, key_id, key_name, comment,
+                output)
+           VALUES ('delete', old.id, old.key_id, old.key_name, old.comment,
+                   old.output);
+           INSERT INTO saltminionresult_fts
+               (rowid, key_id, key_name, comment, output)
+           VALUES (new.id, new.key_id, new.key_name, new.comment,
+                   new.output);
+       END""",
+]
+SEARCH_SQLITE_REBUILD = """
+    INSERT INTO saltminionresult_fts(saltminionresult_fts) VALUES ('rebuild')
+"""
+
+SEARCH_POSTGRESQL = [
+    """ALTER TABLE saltminionresult ADD COLUMN search tsvector""",
+    """CREATE FUNCTION saltminionresult_search() RETURNS trigger AS $$
+       BEGIN
+           NEW.search := to_tsvector('simple',
+               coalesce(NEW.key_id, '') || ' ' ||
+               coalesce(NEW.key_name, '') || ' ' ||
+               coalesce(NEW.comment, '') || ' ' || NEW.output);
+           RETURN NEW;
+       END
+       $$ LANGUAGE plpgsql""",
+    """CREATE TRIGGER saltminionresult_search
+       BEFORE INSERT OR UPDATE ON saltminionresult
+       FOR EACH ROW EXECUTE PROCEDURE saltminionresult_search()""",
+    """CREATE INDEX saltminionresult_search_idx ON saltminionresult
+       USING GIN (search)""",
+]
+SEARCH_POSTGRESQL_REBUILD = """
+    UPDATE saltminionresult SET search = to_tsvector('simple',
+        coalesce(key_id, '') || ' ' || coalesce(key_name, '') || ' ' ||
+        coalesce(comment, '') || ' ' || output)
+    WHERE search IS NULL
+"""
 
 
 class Database:
@@ -65,13 +224,13 @@ class Database:
         dbcfg = self.cfg['database']
         if dbcfg['engine'] == "sqlite":
             filename = dbcfg['file']
-            self.db = SqliteDatabase(filename)
+            self.db = ProfilingSqliteDatabase(filename)
         elif dbcfg['engine'] == "postgresql":
             args = dict(dbcfg)
             del args['engine']
             database = args['database']
             del args['database']
-            self.db = PostgresqlDatabase(database, **args)
+            self.db = ProfilingPostgresqlDatabase(database, **args)
         else:
             raise ValueError("No supported database engine found in config")
         DBProxy.initialize(self.db)
@@ -79,12 +238,91 @@ class Database:
     def create_tables(self):
         logger.info("Creating database tables")
         self.connect()
-        self.db.create_tables(tables)
+        self.db.create_tables(tables, safe=True)
+        self.create_search_index()
+        self.close()
+
+    def search_available(self):
+        """Whether the full-text search index has been set up."""
+        if self.cfg['database']['engine'] == "sqlite":
+            sql = ("SELECT 1 FROM sqlite_master WHERE name = "
+                   "'saltminionresult_fts'")
+        else:
+            sql = ("SELECT 1 FROM information_schema.columns WHERE "
+                   "table_name = 'saltminionresult' AND column_name = "
+                   "'search'")
+        return self.db.execute_sql(sql).fetchone() is not None
+
+    def create_search_index(self):
+        """
+        Set up full-text search over results if it isn't already, and index
+        any results stored before it was. If the database can't do it, such
+        as an SQLite built without FTS5, search is left disabled.
+        """
+        if self.search_available():
+            return
+        if self.cfg['database']['engine'] == "sqlite":
+            statements, rebuild = SEARCH_SQLITE, SEARCH_SQLITE_REBUILD
+        else:
+            statements, rebuild = SEARCH_POSTGRESQL, SEARCH_POSTGRESQL_REBUILD
+        logger.info("Creating full-text search index")
+        try:
+            with self.db.transaction():
+                for sql in statements:
+                    self.db.execute_sql(sql)
+                self.db.execute_sql(rebuild)
+        except (OperationalError, ProgrammingError):
+            logger.exception("Couldn't create the full-text search index, "
+                             "search will be disabled")
+
+    def migrate_tables(self):
+        """
+        Bring an existing database up to date: create any new tables, add
+        any new (nullable) columns to existing tables, create any new
+        indexes, and fill in the fleet state if it's empty.
+        """
+        from playhouse.migrate import SchemaMigrator, migrate
+        logger.info("Migrating database tables")
+        self.connect()
+        self.db.create_tables(tables, safe=True)
+        migrator = SchemaMigrator.from_database(self.db)
+        quote = self.db.compiler().quote
+        for model in tables:
+            table = model._meta.db_table
+            cursor = self.db.execute_sql(
+                "SELECT * FROM {} LIMIT 0".format(quote(table)))
+            existing = set(d[0] for d in cursor.description)
+            for field in model._meta.get_fields():
+                if field.db_column not in existing:
+                    logger.info("Adding column {}.{}"
+                                .format(table, field.db_column))
+                    migrate(migrator.add_column(table, field.db_column,
+                                                field))
+            indexes = [([f], f.unique) for f in model._fields_to_index()]
+            indexes += list(model._meta.indexes or [])
+            for fields, unique in indexes:
+                # In a savepoint, so on PostgreSQL the error doesn't abort
+                # the rest of the migration's transaction.
+                try:
+                    with self.db.atomic():
+                        self.db.create_index(model, fields, unique)
+                except (OperationalError, ProgrammingError):
+                    # Index already exists
+                    pass
+        self.create_search_index()
+        if not FleetMinion.select().exists():
+            from . import ingest
+            ingest.rebuild_fleet()
         self.close()
 
     def drop_tables(self):
         logger.warn("Dropping database tables")
         self.connect()
+        if self.cfg['database']['engine'] == "sqlite":
+            self.db.execute_sql("DROP TABLE IF EXISTS saltminionresult_fts")
+        else:
+            self.db.execute_sql("DROP FUNCTION IF EXISTS "
+                                "saltminionresult_search() CASCADE")
         self.db.drop_tables(tables)
         self.close()
 
@@ -93,3 +331,16 @@ class Database:
 
     def close(self):
         self.db.close()
+
+    def explain(self, sql, params=None):
+        """Return the query plan for *sql* as a list of lines."""
+        if self.cfg['database']['engine'] == "sqlite":
+            prefix = "EXPLAIN QUERY PLAN "
+        else:
+            prefix = "EXPLAIN "
+        hook, self.db.query_hook = self.db.query_hook, None
+        try:
+            cursor = self.db.execute_sql(prefix + sql, params)
+            return [" ".join(str(c) for c in row) for row in cursor]
+        finally:
+            self.db.query_hook = hook
@@ -3,6 +3,8 @@
 # Licensed under the MIT license, see LICENCE file for details.
 
 import time
+import json
+import fnmatch
 import logging
 import datetime
 
@@ -20,10 +22,37 @@ else:
     from . import database
     reload(database)
 
-from .database import Database, GitHubPush
+from peewee import IntegrityError
+
+from . import tracing
+from .database import Database, GitHubPush, GitHubDelivery, SaltJob
 
 logger = logging.getLogger('saltbot.exchange')
 
+# Settings a repos branch may use to override the salt config section
+JOB_OPTIONS = ('job_deadline', 'minion_deadline', 'batch',
+               'halt_on_failures', 'priority')
+
+# Compound matcher prefix for each expr_form, with None for a bare glob
+COMPOUND_PREFIXES = {'glob': None, 'pcre': "E@", 'list': "L@",
+                     'grain': "G@", 'grain_pcre': "P@", 'pillar': "I@",
+                     'pillar_pcre': "J@", 'ipcidr': "S@", 'range': "R@",
+                     'nodegroup': "N@"}
+
+
+def compound_target(target, expr_form):
+    """
+    Express *target* of type *expr_form* as part of a compound target, or
+    return None if it can't be.
+    """
+    if isinstance(target, list):
+        target = ",".join(target)
+    if expr_form == 'compound':
+        return target
+    if expr_form not in COMPOUND_PREFIXES:
+        return None
+    return (COMPOUND_PREFIXES[expr_form] or "") + target
+
 
 class Exchange:
     def __init__(self, config, ircmq, webpq, sltcq, sltrq):
@@ -43,27 +72,196 @@ class Exchange:
             time.sleep(1)
 
     def check_queue(self, q):
+        """Handle every event waiting on *q*."""
+        while True:
+            try:
+                event_type, event = q.get_nowait()
+            except Empty:
+                return
+            self.handle_event(event_type, event)
+
+    def handle_event(self, event_type, event):
+        if event_type == "github_webhook":
+            self.handle_github_webhook(event)
+        elif event_type == "github_push":
+            try:
+                self.handle_github_push(event)
+            except (KeyError, ValueError):
+                logger.exception("Error processing GitHub Push")
+        elif event_type == "irc_highstate":
+            self.handle_irc_highstate(event)
+        elif event_type == "salt_started":
+            self.handle_salt_started(event)
+        elif event_type == "salt_result":
+            self.handle_salt_result(event)
+        elif event_type == "salt_late_results":
+            self.handle_salt_late_results(event)
+        elif event_type == "cancel":
+            self.sltcq.put(("cancel", (event['kind'], event['id'],
+                                       event['kill'], event['who'])))
+        elif event_type == "salt_cancelled":
+            self.handle_salt_cancelled(event)
+        elif event_type == "salt_rollout_started":
+            self.handle_salt_rollout_started(event)
+        elif event_type == "salt_rollout_finished":
+            self.handle_salt_rollout_finished(event)
+        elif event_type == "salt_error":
+            self.handle_salt_error(event)
+        elif event_type == "trace_stamp":
+            self.stamp_job(*event)
+
+    def handle_github_webhook(self, webhook):
+        """
+        Process a signature-verified webhook enqueued by the web app,
+        skipping any delivery we have already seen. A delivery is only
+        recorded once all its pushes are handled, so if one fails a
+        redelivery from GitHub will try again.
+        """
+        trace = tracing.stamp(webhook.get('trace'), "exchange_received")
+        if self.is_duplicate_delivery(webhook['delivery']):
+            logger.info("Skipping duplicate delivery {}"
+                        .format(webhook['delivery']))
+            return
+
         try:
-            event_type, event = q.get_nowait()
-        except Empty:
-            pass
+            event = json.loads(webhook['body'])
+        except ValueError:
+            logger.warning("Could not parse webhook body, skipping")
+            return
+
+        if webhook['event'] == 'push_batch':
+            events = event.get('pushes', [])
         else:
-            if event_type == "github_push":
+            events = [event]
+
+        failed = False
+        for i, event in enumerate(events):
+            push = self.parse_github_push(event)
+            if push is not None:
                 try:
-                    self.handle_github_push(event)
+                    self.handle_github_push(
+                        push, trace if i == 0 else tracing.fork(trace))
                 except (KeyError, ValueError):
                     logger.exception("Error processing GitHub Push")
-            elif event_type == "irc_highstate":
-                self.handle_irc_highstate(event)
-            elif event_type == "salt_started":
-                self.handle_salt_started(event)
-            elif event_type == "salt_result":
-                self.handle_salt_result(event)
-            elif event_type == "salt_error":
-                self.handle_salt_error(event)
-
-    def handle_github_push(self, push):
+                    failed = True
+        if not failed:
+            self.record_delivery(webhook['delivery'])
+
+    def is_duplicate_delivery(self, delivery):
+        """Check whether *delivery* has already been handled."""
+        if not delivery:
+            return False
+        return GitHubDelivery.select().where(
+            GitHubDelivery.delivery == delivery).exists()
+
+    def record_delivery(self, delivery):
+        """
+        Record *delivery* as handled. Only the most recent
+        github.delivery_history deliveries are kept.
+        """
+        if not delivery:
+            return
+        try:
+            # In a savepoint, so on PostgreSQL a duplicate doesn't leave
+            # the connection in an aborted transaction
+            with self.db.db.atomic():
+                ghd = GitHubDelivery.create(when=datetime.datetime.now(),
+                                            delivery=delivery)
+        except IntegrityError:
+            return
+        limit = self.cfg['github']['delivery_history']
+        GitHubDelivery.delete().where(
+            GitHubDelivery.id <= ghd.id - limit).execute()
+
+    def parse_github_push(self, event):
+        """Extract the fields we care about from a push event."""
+        push = {}
+        try:
+            push['gitref'] = event['ref']
+            push['repo_name'] = event['repository']['full_name']
+            push['repo_url'] = event['repository']['url']
+            push['commit_id'] = event['head_commit']['id']
+            push['commit_msg'] = event['head_commit']['message']
+            push['commit_ts'] = event['head_commit']['timestamp']
+            push['commit_url'] = event['head_commit']['url']
+            push['commit_author'] = event['head_commit']['author']['username']
+            push['pusher'] = event['pusher']['name']
+            push['files'] = self.parse_changed_files(event)
+        except (KeyError, TypeError):
+            logger.warning("Could not extract event from push, skipping")
+            logger.warning(str(event))
+            return None
+        logger.info("Details: {}".format(push))
+        return push
+
+    def parse_changed_files(self, event):
+        """
+        Return the set of paths touched by all commits in a push event,
+        or None if we can't be sure we have seen every commit (GitHub only
+        lists the first 20 commits, and new or forced refs may omit some).
+        """
+        commits = event.get('commits')
+        if commits is None or len(commits) >= 20:
+            return None
+        if event.get('created') or event.get('forced'):
+            return None
+        files = set()
+        for commit in commits:
+            for k in ('added', 'modified', 'removed'):
+                files.update(commit.get(k, []))
+        return files
+
+    def select_target(self, branch_cfg, files):
+        """
+        Work out what to highstate for a push to a branch touching *files*.
+
+        If the branch has `paths` rules, each changed file is matched
+        against them in order and the first matching rule's target is used.
+        The union of these targets, narrowed to the branch target, is
+        returned as a compound expression, so a rule can never reach
+        minions outside the branch target. A rule with an empty target
+        means those files need no highstate. Falls back to the full branch
+        target if any file matches no rule or the changed files are unknown.
+
+        Returns (target, expr_form), or None if nothing needs highstating.
+        """
+        target = branch_cfg['target']
+        expr_form = branch_cfg.get('expr_form', 'glob')
+        if not branch_cfg.get('paths') or files is None:
+            return target, expr_form
+
+        targets = []
+        for path in sorted(files):
+            for rule in branch_cfg['paths']:
+                if fnmatch.fnmatch(path, rule['pattern']):
+                    rule_target = rule['target']
+                    break
+            else:
+                logger.info("No paths rule matches {}, using full target"
+                            .format(path))
+                return target, expr_form
+            if isinstance(rule_target, list):
+                rule_target = "L@" + ",".join(rule_target)
+            if rule_target and rule_target not in targets:
+                targets.append(rule_target)
+
+        if not targets:
+            return None
+        branch_target = compound_target(target, expr_form)
+        if branch_target is None:
+            logger.warning("Can't narrow a {} target, using full target"
+                           .format(expr_form))
+            return target, expr_form
+        if len(targets) > 1:
+            rule_targets = " or ".join("( {} )".format(t) for t in targets)
+        else:
+            rule_targets = targets[0]
+        return ("( {} ) and ( {} )".format(branch_target, rule_targets),
+                'compound')
+
+    def handle_github_push(self, push, trace=None):
         logger.info("Saving GitHub Push to database")
+        files = push.pop('files', None)
         ghpush = GitHubPush(when=datetime.datetime.now(), **push)
         ghpush.save()
         if push['repo_name'] in self.cfg['repos']:
@@ -71,11 +269,6 @@ class Exchange:
             repo_cfg = self.cfg['repos'][push['repo_name']]
             if branch in repo_cfg:
                 logger.info("Push received to a configured branch")
-                target = repo_cfg[branch]['target']
-                expr_form = repo_cfg[branch].get('expr_form', 'glob')
-                wait_gitfs = repo_cfg[branch].get('wait_gitfs', False)
-                logger.info("Target (expr_form={}, wait_gitfs={}): {}"
-                            .format(expr_form, wait_gitfs, target))
                 commitmsg = push['commit_msg'].split("\n")[0][:77]
                 if len(push['commit_msg']) > 77:
                     commitmsg += "..."
@@ -83,12 +276,26 @@ class Exchange:
                     ("pubmsg", "Push to {} {} by {}: {}"
                                .format(push['repo_name'], branch,
                                        push['pusher'], commitmsg)))
+                selected = self.select_target(repo_cfg[branch], files)
+                if selected is None:
+                    logger.info("No changed files need a highstate")
+                    self.ircmq.put(
+                        ("pubmsg", "No highstate needed for changed files"))
+                    return
+                target, expr_form = selected
+                wait_gitfs = repo_cfg[branch].get('wait_gitfs', False)
+                logger.info("Target (expr_form={}, wait_gitfs={}): {}"
+                            .format(expr_form, wait_gitfs, target))
                 self.ircmq.put(
                     ("pubmsg", "Going to highstate {} {}{}".format(
                         expr_form, target,
                         " (waiting for gitfs)" if wait_gitfs else "")))
-                self.sltcq.put(("highstate", (target, expr_form,
-                                              wait_gitfs, ghpush.id)))
+                options = {"priority": "push", "repo": push['repo_name']}
+                options.update((k, v) for (k, v) in repo_cfg[branch].items()
+                               if k in JOB_OPTIONS)
+                tracing.stamp(trace, "salt_queued")
+                self.sltcq.put(("highstate", (target, expr_form, wait_gitfs,
+                                              ghpush.id, trace, options)))
             else:
                 logger.info("Push was not to a configured branch")
         else:
@@ -103,14 +310,19 @@ class Exchange:
                             commit_author=args['who'], commit_url="#",
                             commit_ts=datetime.datetime.now(), commit_id="")
         ghpush.save()
+        trace = tracing.stamp(args.get('trace'), "exchange_received")
+        tracing.stamp(trace, "salt_queued")
+        options = dict(args.get('options') or {}, priority="interactive")
         self.sltcq.put(("highstate", (args['target'], args['expr_form'],
-                                      args['wait_gitfs'], ghpush.id)))
+                                      args['wait_gitfs'], ghpush.id, trace,
+                                      options)))
 
     def handle_salt_started(self, args):
-        jid, minions = args
+        jid, minions = args[:2]
+        wave = args[2] if len(args) > 2 else None
         self.ircmq.put(
-            ("pubmsg", "Salt {} started to highstate {}"
-                       .format(jid, ', '.join(minions))))
+            ("pubmsg", "Salt {}{} started to highstate {}"
+                       .format(jid, wave_label(wave), ', '.join(minions))))
         self.ircmq.put(
             ("pubmsg", "{}/jobs/{}".format(self.cfg['web']['url'], jid)))
 
@@ -119,17 +331,102 @@ class Exchange:
             ("pubmsg", "Error processing Salt job: {}".format(args)))
 
     def handle_salt_result(self, args):
-        jid, all_ok, m, n = args
-        if all_ok and m == n:
+        jid, all_ok, m, n = args[:4]
+        status = args[4] if len(args) > 4 else "finished"
+        wave = args[5] if len(args) > 5 else None
+        job = "Salt JID {}{}".format(jid, wave_label(wave))
+        self.stamp_job(jid, "result_received")
+        # Ask the IRC bot to tell us when the verdict is actually delivered
+        trace = {"jid": jid}
+        if status == "partial":
             self.ircmq.put(
-                ("pubmsg", "Salt JID {} finished, all OK".format(jid)))
+                ("pubmsg", "{} deadline passed, {}/{} results{}, "
+                           "still listening for the rest"
+                           .format(job, m, n,
+                                   "" if all_ok else " with errors"),
+                 trace))
+        elif all_ok and m == n:
+            self.ircmq.put(
+                ("pubmsg", "{} finished, all OK".format(job), trace))
         elif not all_ok:
             self.ircmq.put(
-                ("pubmsg", "Salt JID {} finished, some errors".format(jid)))
+                ("pubmsg", "{} finished, some errors".format(job), trace))
         elif m != n:
             self.ircmq.put(
-                ("pubmsg", "Salt JID {} finished, only {}/{} results"
-                           .format(jid, m, n)))
+                ("pubmsg", "{} finished, only {}/{} results"
+                           .format(job, m, n), trace))
+
+    def handle_salt_rollout_started(self, args):
+        target, n, waves = args
+        self.ircmq.put(
+            ("pubmsg", "Rolling out highstate to {} minions of {} in {} "
+                       "waves".format(n, target, waves)))
+
+    def handle_salt_rollout_finished(self, args):
+        target, done, waves, failed, halted = args
+        if halted:
+            self.ircmq.put(
+                ("pubmsg", "Rollout to {} halted after wave {}/{}, {} "
+                           "minions failed".format(target, done, waves,
+                                                   failed)))
+        else:
+            self.ircmq.put(
+                ("pubmsg", "Rollout to {} finished all {} waves, {} minions "
+                           "failed".format(target, waves, failed)))
+
+    def handle_salt_late_results(self, args):
+        jid, ok, failed, m, n = args[:5]
+        if failed:
+            outcome = "errors from {}".format(name_list(failed))
+        else:
+            outcome = "all OK"
+        count = len(ok) + len(failed)
+        self.ircmq.put(
+            ("pubmsg", "Salt JID {}: {} late result{}, {} ({}/{} results)"
+                       .format(jid, count, "" if count == 1 else "s",
+                               outcome, m, n)))
+
+    def handle_salt_cancelled(self, args):
+        what, ident, who = args['what'], args['id'], args['who']
+        if what == "queued":
+            msg = "Queued highstate {} of {} cancelled by {}".format(
+                ident, args['target'], who)
+        elif what == "running":
+            msg = "Salt JID {} cancelled by {}, {}/{} results{}".format(
+                ident, who, args['m'], args['n'],
+                ", killing the rest" if args['kill'] else "")
+        elif args.get('kind') == "queue":
+            msg = "{}: no queued highstate {}".format(who, ident)
+        else:
+            msg = "{}: no running job {}".format(who, ident)
+        self.ircmq.put(("pubmsg", msg))
+
+    def stamp_job(self, jid, stage, when=None):
+        """Record that the job *jid* reached *stage* in its stored trace."""
+        try:
+            job = SaltJob.get(jid=jid)
+        except SaltJob.DoesNotExist:
+            return
+        if not job.timings:
+            return
+        trace = json.loads(job.timings)
+        tracing.stamp(trace, stage, when)
+        # Only the trace: the salt process owns the job's status
+        (SaltJob.update(timings=json.dumps(trace))
+                .where(SaltJob.id == job.id)
+                .execute())
+
+
+def name_list(names, limit=5):
+    """*names* for a message, cut short after *limit* of them."""
+    if len(names) <= limit:
+        return ", ".join(names)
+    return "{} and {} more".format(", ".join(names[:limit]),
+                                   len(names) - limit)
+
+
+def wave_label(wave):
+    return " (wave {}/{})".format(*wave) if wave else ""
 
 
 def run(config, ircmq, webpq, sltcq, sltrq):
@@ -2,9 +2,35 @@
 # Copyright 2015 Adam Greig
 # Licensed under the MIT license, see LICENCE file for details.
 
+"""
+A local stand-in for a Salt master, used when salt isn't installed.
 
+By default each job targets 1-5 random minions which all return instantly,
+and gitfs updates are seen a second after anyone starts waiting for them.
+For load and latency testing, configure() (or the `fakesalt` section of the
+saltbot config) can instead give a fixed fleet of minions, return latency
+distributions, minions which never respond or return error lists, large
+outputs, and a seed so that runs can be repeated.
+
+Events go through a directory shared by every process using fakesalt, so
+gitfs updates can also be fired by hand, for instance with:
+
+    python -m saltbot.fakesalt fire salt/fileserver/gitfs/update
+
+Jobs are kept in a cache directory in the same way, so a restarted process
+can still fetch their returns.
+"""
+
+import os
+import re
+import sys
+import json
 import time
+import math
+import heapq
 import random
+import fnmatch
+import argparse
 import datetime
 
 
@@ -12,69 +38,463 @@ prefixes = ("endearing", "remarkable", "caring", "delightful", "glowing")
 suffixes = ("puppy", "kitten", "biscuit", "muffin", "leaf", "flower")
 states = ("file", "user", "service", "pkg", "git", "postgres_user")
 funcs = ("present", "latest", "running", "absent", "username", "installed")
+errors = ("Rendering SLS 'base:{}' failed: Jinja variable 'dict' object has "
+          "no attribute 'missing'",
+          "Pillar failed to render with the following messages:",
+          "No matching sls found for '{}' in env 'base'")
+
+GITFS_TAG = "salt/fileserver/gitfs/update"
+
+DEFAULTS = {
+    # None for 1-5 randomly named minions per job, or the size of a fixed
+    # fleet of minions named minion00000, minion00001, ...
+    "minions": None,
+    "states": (5, 15),
+    "output_size": 0,
+    "failure_rate": 0.1,
+    # Fractions of minions which return an error list, or never return
+    "error_rate": 0.0,
+    "nonresponding_rate": 0.0,
+    # Seconds after the job starts for each minion to return: one of
+    # "none", "fixed" (mean), "uniform" (min to max) or "lognormal" (mean
+    # and sigma, clipped to min and max)
+    "latency": {"distribution": "none", "mean": 1.0, "sigma": 0.5,
+                "min": 0.0, "max": 300.0},
+    # Seconds to wait for non-responding minions before giving up
+    "timeout": 60.0,
+    # Seconds after someone starts waiting to fire a gitfs update event,
+    # or None to only fire them by hand
+    "gitfs_delay": 1.0,
+    "seed": None,
+    "event_dir": "/tmp/fakesalt-events",
+    # Where jobs are kept so other processes can fetch their returns, and
+    # for how many hours
+    "cache_dir": "/tmp/fakesalt-jobs",
+    "keep_jobs": 24,
+    # Whether to fire salt/job/ events for jobs and returns, as a master
+    # does, so they can be seen by saltbot's event listener
+    "publish_returns": False,
+    # How long fired events are kept around for other processes
+    "event_ttl": 600.0,
+}
 
+settings = dict(DEFAULTS)
 
-def random_names(n):
+
+def configure(config=None, **kwargs):
+    """Update the module settings from a config dict and/or keywords."""
+    for k, v in dict(config or {}, **kwargs).items():
+        if k not in DEFAULTS:
+            raise ValueError("Unknown fakesalt setting '{}'".format(k))
+        if k == "latency":
+            v = dict(DEFAULTS['latency'], **v)
+        settings[k] = v
+
+
+def random_names(n, rng=random):
     names = set()
+    n = min(n, len(prefixes) * len(suffixes))
     while len(names) < n:
-        name = random.choice(prefixes) + "." + random.choice(suffixes)
+        name = rng.choice(prefixes) + "." + rng.choice(suffixes)
         if name not in names:
             names.add(name)
     return list(names)
 
 
-def random_results(n):
+def fleet_names(n):
+    return ["minion{:05d}".format(i) for i in range(n)]
+
+
+def random_results(n, output_size=0, failure_rate=0.1, rng=random):
     results = {}
     for _ in range(n):
-        key_state = random.choice(states)
-        key_id = random.choice(suffixes)
-        key_name = random.choice(suffixes)
-        key_func = random.choice(funcs)
+        key_state = rng.choice(states)
+        key_id = rng.choice(suffixes)
+        key_name = rng.choice(suffixes)
+        key_func = rng.choice(funcs)
         key = "_|-".join((key_state, key_id, key_name, key_func))
         r = {}
         r['comment'] = "Lorem ipsum dolor sit amet"
+        if output_size:
+            r['comment'] = (r['comment'] + " ") * (output_size // 27 + 1)
         r['name'] = key_name
         r['start'] = datetime.datetime.now().strftime("%H:%M:%S.%f")
-        r['result'] = random.choice([True]*9 + [False])
-        r['duration'] = random.randrange(10000) / 1000.0
-        r['changes'] = random.choice([{}, {}, {}, {}, {'modified': 'things'}])
+        r['result'] = rng.random() >= failure_rate
+        r['duration'] = rng.randrange(10000) / 1000.0
+        r['changes'] = rng.choice([{}, {}, {}, {}, {'modified': 'things'}])
         r['warnings'] = ["this was generated using FakeSalt!"]
-        r['__run_num__'] = random.randrange(200)
+        r['__run_num__'] = rng.randrange(200)
         results[key] = r
     return results
 
 
+def random_errors(rng=random):
+    n = rng.randint(1, len(errors))
+    return [e.format(rng.choice(suffixes)) for e in rng.sample(errors, n)]
+
+
+def random_latency(cfg, rng=random):
+    dist = cfg['distribution']
+    if dist == "none":
+        return 0.0
+    elif dist == "fixed":
+        return float(cfg['mean'])
+    elif dist == "uniform":
+        return rng.uniform(cfg['min'], cfg['max'])
+    elif dist == "lognormal":
+        # Parameterised by the mean of the distribution itself, not of the
+        # underlying normal, as that's what people tend to know.
+        mean, sigma = float(cfg['mean']), float(cfg['sigma'])
+        if mean <= 0:
+            return 0.0
+        mu = math.log(mean) - sigma ** 2 / 2
+        latency = rng.lognormvariate(mu, sigma)
+        return min(max(latency, cfg['min']), cfg['max'])
+    raise ValueError("Unknown latency distribution '{}'".format(dist))
+
+
 def make_jid():
     return datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")
 
 
+def make_stamp():
+    return datetime.datetime.now().isoformat()
+
+
+def match_minions(names, tgt, expr_form):
+    """Resolve the targets in a fixed fleet of minion *names*."""
+    if expr_form == "list":
+        if not isinstance(tgt, (list, tuple)):
+            tgt = tgt.split(",")
+        wanted = set(t.strip() for t in tgt)
+        return [n for n in names if n in wanted]
+    elif expr_form == "glob":
+        return fnmatch.filter(names, tgt)
+    elif expr_form == "pcre":
+        return [n for n in names if re.match(tgt, n)]
+    # Grains, pillars and compound matches can't be evaluated without real
+    # minions, so assume they target everything.
+    return list(names)
+
+
+def fire_event(data, tag, event_dir=None):
+    """Put an event on the shared event bus for every process to see."""
+    event_dir = event_dir or settings['event_dir']
+    if not os.path.isdir(event_dir):
+        try:
+            os.makedirs(event_dir)
+        except OSError:
+            pass
+    now = time.time()
+    name = "{:017.6f}-{}-{}.json".format(now, os.getpid(),
+                                         random.randrange(1 << 30))
+    tmp = os.path.join(event_dir, "." + name)
+    with open(tmp, "w") as f:
+        json.dump({"tag": tag, "data": data}, f)
+    os.rename(tmp, os.path.join(event_dir, name))
+    expire_events(event_dir, now - settings['event_ttl'])
+
+
+def expire_events(event_dir, before):
+    cutoff = "{:017.6f}".format(before)
+    for name in os.listdir(event_dir):
+        if not name.startswith(".") and name < cutoff:
+            try:
+                os.unlink(os.path.join(event_dir, name))
+            except OSError:
+                pass
+
+
 class Event:
+    """
+    Watches the shared event bus, seeing every event fired after it was
+    created. Also fires the gitfs update itself once it has existed for
+    `gitfs_delay` seconds, unless that's disabled.
+    """
+    def __init__(self, opts=None):
+        opts = dict(settings, **(opts or {}))
+        self.event_dir = opts['event_dir']
+        self.created = time.time()
+        self.last = "{:017.6f}".format(self.created)
+        self.gitfs_at = None
+        if opts['gitfs_delay'] is not None:
+            self.gitfs_at = self.created + opts['gitfs_delay']
+
+    def pending(self):
+        try:
+            names = os.listdir(self.event_dir)
+        except OSError:
+            return []
+        return sorted(n for n in names
+                      if not n.startswith(".") and n > self.last)
+
     def get_event_noblock(self):
-        time.sleep(1)
-        return {"tag": "salt/fileserver/gitfs/update"}
+        if self.gitfs_at is not None and time.time() >= self.gitfs_at:
+            self.gitfs_at = None
+            fire_event({"_stamp": make_stamp()}, GITFS_TAG, self.event_dir)
+        for name in self.pending():
+            self.last = name
+            try:
+                with open(os.path.join(self.event_dir, name)) as f:
+                    return json.load(f)
+            except (IOError, OSError, ValueError):
+                continue
+        return None
+
+    def get_event(self, wait=5, tag='', full=False):
+        deadline = time.time() + wait
+        while True:
+            raw = self.get_event_noblock()
+            if raw and raw['tag'].startswith(tag):
+                return raw if full else raw['data']
+            if raw is None:
+                if time.time() >= deadline:
+                    return None
+                time.sleep(0.05)
 
 
 class client:
     class zmq:
-        class ZMQError:
+        class ZMQError(Exception):
             pass
 
     class LocalClient:
-        event = Event()
-        opts = {"transport": None, "sock_dir": "/tmp/"}
+        """
+        Pretends to run jobs on minions. Any keyword arguments override the
+        module settings for this client, so benchmarks can use several
+        differently shaped fleets at once.
+        """
+        def __init__(self, **kwargs):
+            self.settings = dict(settings)
+            for k, v in kwargs.items():
+                if k not in DEFAULTS:
+                    raise TypeError("Unknown fakesalt setting '{}'".format(k))
+                if k == "latency":
+                    v = dict(DEFAULTS['latency'], **v)
+                self.settings[k] = v
+            self.opts = {"transport": None, "sock_dir": "/tmp/",
+                         "event_dir": self.settings['event_dir'],
+                         "gitfs_delay": self.settings['gitfs_delay']}
+            self.rng = random.Random(self.settings['seed'])
+            self.jobs = {}
+            self.killed = set()
+            self.count = 0
+
+        def job_rng(self, num, minion):
+            """
+            A generator for one minion's part of one job, so that seeded
+            runs give the same results whatever order minions return in.
+            """
+            if self.settings['seed'] is None:
+                return random.Random()
+            return random.Random("{}/{}/{}".format(
+                self.settings['seed'], num, minion))
 
         def run_job(self, tgt, fun, arg=(), expr_form='glob', ret='',
                     timeout=None, jid='', kwarg=None, **kwargs):
-            n = random.randrange(1, 6)
-            return {"jid": make_jid(), "minions": random_names(n)}
+            cfg = self.settings
+            if cfg['minions'] is None and expr_form == "list":
+                if not isinstance(tgt, (list, tuple)):
+                    tgt = tgt.split(",")
+                minions = [t.strip() for t in tgt]
+            elif cfg['minions'] is None:
+                minions = random_names(self.rng.randrange(1, 6), self.rng)
+            else:
+                minions = match_minions(fleet_names(cfg['minions']), tgt,
+                                        expr_form)
+            if not minions:
+                return {}
+
+            if fun == "saltutil.kill_job":
+                self.killed.add(arg[0])
+                return {"jid": make_jid(), "minions": minions}
 
-        def get_iter_returns(self, jid, minions, **kwargs):
+            self.count += 1
+            plan = {}
             for minion in minions:
-                n = random.randrange(5, 15)
-                yield {minion: {'ret': random_results(n), 'out': 'highstate'}}
+                rng = self.job_rng(self.count, minion)
+                if rng.random() < cfg['nonresponding_rate']:
+                    plan[minion] = None
+                else:
+                    plan[minion] = random_latency(cfg['latency'], rng)
+            jid = jid or make_jid()
+            self.jobs[jid] = (self.count, time.time(), fun, plan)
+            self.save_job(jid, *self.jobs[jid])
+            if cfg['publish_returns']:
+                fire_event({"jid": jid, "tgt": tgt, "tgt_type": expr_form,
+                            "minions": minions, "fun": fun, "arg": list(arg),
+                            "user": "fakesalt", "_stamp": make_stamp()},
+                           "salt/job/{}/new".format(jid), cfg['event_dir'])
+            return {"jid": jid, "minions": minions}
+
+        def publish_return(self, jid, fun, minion, ret):
+            ok = not isinstance(ret['ret'], list)
+            fire_event({"jid": jid, "id": minion, "fun": fun, "fun_args": [],
+                        "return": ret['ret'], "retcode": 0 if ok else 2,
+                        "success": ok, "cmd": "_return",
+                        "_stamp": make_stamp()},
+                       "salt/job/{}/ret/{}".format(jid, minion),
+                       self.settings['event_dir'])
+
+        def save_job(self, jid, num, start, fun, plan):
+            """
+            Keep the job in the job cache directory, so that other processes
+            can see its returns as they would with a real master.
+            """
+            cache_dir = self.settings['cache_dir']
+            if not os.path.isdir(cache_dir):
+                try:
+                    os.makedirs(cache_dir)
+                except OSError:
+                    pass
+            path = os.path.join(cache_dir, jid + ".json")
+            with open(path + ".tmp", "w") as f:
+                json.dump({"num": num, "start": start, "fun": fun,
+                           "plan": plan}, f)
+            os.rename(path + ".tmp", path)
+
+            cutoff = time.time() - self.settings['keep_jobs'] * 3600
+            for name in os.listdir(cache_dir):
+                path = os.path.join(cache_dir, name)
+                try:
+                    if os.stat(path).st_mtime < cutoff:
+                        os.unlink(path)
+                except OSError:
+                    pass
+
+        def load_job(self, jid):
+            path = os.path.join(self.settings['cache_dir'], jid + ".json")
+            try:
+                with open(path) as f:
+                    job = json.load(f)
+            except (IOError, OSError, ValueError):
+                return None
+            return job['num'], job['start'], job['fun'], job['plan']
+
+        def get_cache_returns(self, jid):
+            """The returns which have arrived so far for the job *jid*."""
+            job = self.load_job(jid)
+            if job is None or jid in self.killed:
+                return {}
+            num, start, fun, plan = job
+            now = time.time()
+            return dict((m, self.make_return(num, fun, m))
+                        for m, lat in plan.items()
+                        if lat is not None and start + lat <= now)
+
+        def make_return(self, num, fun, minion):
+            cfg = self.settings
+            rng = self.job_rng(num, minion)
+            rng.random()    # already used by run_job to pick non-responders
+            if fun == "test.ping":
+                return {'ret': True, 'out': 'nested'}
+            if rng.random() < cfg['error_rate']:
+                return {'ret': random_errors(rng), 'out': 'highstate'}
+            n = rng.randint(*cfg['states'])
+            ret = random_results(n, cfg['output_size'], cfg['failure_rate'],
+                                 rng)
+            return {'ret': ret, 'out': 'highstate'}
+
+        def cmd(self, tgt, fun, arg=(), timeout=None, expr_form='glob',
+                ret='', kwarg=None, **kwargs):
+            """Run *fun* and wait for the returns, as salt's cmd does."""
+            job = self.run_job(tgt, fun, arg, expr_form, timeout=timeout)
+            if not job:
+                return {}
+            returns = {}
+            for r in self.get_iter_returns(job['jid'], job['minions'],
+                                           timeout=timeout):
+                for minion, result in (r or {}).items():
+                    returns[minion] = result['ret']
+            return returns
+
+        def get_iter_returns(self, jid, minions, timeout=None, **kwargs):
+            """
+            Yield each minion's return once its latency has passed, and
+            None while waiting, as salt does. Gives up on minions which
+            haven't returned after *timeout* seconds.
+            """
+            job = self.jobs.pop(jid, None) or self.load_job(jid)
+            if job is None:
+                return
+            num, start, fun, plan = job
+            if timeout is None:
+                timeout = self.settings['timeout']
+            due = [(lat, m) for m, lat in plan.items()
+                   if lat is not None and m in minions]
+            heapq.heapify(due)
+            waiting = len(due) < len(minions)
+            while due or waiting:
+                now = time.time()
+                if now - start >= timeout or jid in self.killed:
+                    return
+                if due and start + due[0][0] <= now:
+                    _, minion = heapq.heappop(due)
+                    ret = self.make_return(num, fun, minion)
+                    if self.settings['publish_returns']:
+                        self.publish_return(jid, fun, minion, ret)
+                    yield {minion: ret}
+                    continue
+                yield None
+                if due:
+                    wait = start + due[0][0] - time.time()
+                else:
+                    wait = start + timeout - time.time()
+                time.sleep(min(max(wait, 0), 0.1))
 
 
 class utils:
     class event:
         def get_event(*args, **kwargs):
-            return Event()
+            return Event(kwargs.get('opts'))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Control the fakesalt salt master")
+    commands = parser.add_subparsers(dest="command")
+    fire = commands.add_parser(
+        "fire", help="Fire an event on the fakesalt event bus")
+    fire.add_argument("tag", nargs="?", default=GITFS_TAG)
+    fire.add_argument("data", nargs="?", default="{}",
+                      help="Event data as JSON")
+    fire.add_argument("--event-dir", default=settings['event_dir'])
+    highstate = commands.add_parser(
+        "highstate", help="Run a highstate and publish its returns, as if "
+                          "it had been run from the salt CLI")
+    highstate.add_argument("target", nargs="?", default="*")
+    highstate.add_argument("--expr-form", default="glob")
+    highstate.add_argument("--minions", type=int,
+                           help="simulate a fleet of this many minions")
+    highstate.add_argument("--config", help="saltbot config file to read "
+                                            "fakesalt settings from")
+    args = parser.parse_args()
+
+    if args.command == "fire":
+        fire_event(json.loads(args.data), args.tag, args.event_dir)
+        print("Fired {}".format(args.tag))
+    elif args.command == "highstate":
+        if args.config:
+            import yaml
+            with open(args.config) as f:
+                configure((yaml.safe_load(f) or {}).get('fakesalt'))
+        if args.minions is not None:
+            configure(minions=args.minions)
+        configure(publish_returns=True)
+        salt = client.LocalClient()
+        job = salt.run_job(args.target, "state.highstate",
+                           expr_form=args.expr_form)
+        if not job:
+            print("No minions matched")
+            return 1
+        print("Started {} on {} minions".format(job['jid'],
+                                                len(job['minions'])))
+        n = sum(1 for r in salt.get_iter_returns(job['jid'], job['minions'])
+                if r)
+        print("{}/{} minions returned".format(n, len(job['minions'])))
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
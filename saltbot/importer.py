@@ -0,0 +1,230 @@
+# Saltbot
+# Copyright 2015 Adam Greig
+# Licensed under the MIT license, see LICENCE file for details.
+
+"""
+Import historical highstates from the salt master's local job cache.
+
+The cache is walked and each job is parsed in a pool of worker processes,
+which turn the returns into database rows. The main process writes the rows
+in bulk, a batch of jobs per transaction. Jobs already in the database are
+skipped, so an interrupted import can simply be run again.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import logging
+import argparse
+import datetime
+import multiprocessing
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from . import config
+from . import ingest
+from .database import Database, SaltJob, SaltJobMinion, SaltMinionResult
+
+logger = logging.getLogger("saltbot.importer")
+
+JOBS_DIR = "/var/cache/salt/master/jobs"
+
+# Set in each worker process by init_worker()
+skip_jids = frozenset()
+
+
+def unpack(path):
+    """Load a msgpack file from the job cache."""
+    with open(path, "rb") as f:
+        data = f.read()
+    try:
+        return msgpack.unpackb(data, raw=False)
+    except TypeError:
+        # msgpack before 0.5.2
+        return msgpack.unpackb(data, encoding="utf-8")
+
+
+def job_dirs(jobs_dir):
+    """
+    Yield the directory of every job in *jobs_dir*, which salt lays out as
+    <first two characters of the jid hash>/<rest of the hash>/.
+    """
+    for top in sorted(os.listdir(jobs_dir)):
+        top = os.path.join(jobs_dir, top)
+        if not os.path.isdir(top):
+            continue
+        for name in sorted(os.listdir(top)):
+            yield os.path.join(top, name)
+
+
+def job_time(jid, path):
+    """When the job started, from its jid or failing that the cache."""
+    return (ingest.jid_time(jid) or
+            datetime.datetime.fromtimestamp(os.path.getmtime(path)))
+
+
+def init_worker(jids):
+    global skip_jids
+    skip_jids = jids
+
+
+def parse_job(path):
+    """
+    Parse the cached job in *path*. Returns None if it isn't a highstate
+    or is already imported, otherwise a dict describing the job with a
+    list of (minion, rows, ok, returned) for each minion, where each row
+    is ready to insert once its "minion" key is set.
+    """
+    try:
+        with open(os.path.join(path, "jid")) as f:
+            jid = f.read().strip()
+        if jid in skip_jids:
+            return None
+        load = unpack(os.path.join(path, ".load.p"))
+    except (IOError, OSError, ValueError):
+        return None
+    if load.get('fun') not in ingest.FUNCS:
+        return None
+
+    target = load.get('tgt', "")
+    if isinstance(target, list):
+        target = ",".join(target)
+    minions = []
+    for name in sorted(os.listdir(path)):
+        ret_path = os.path.join(path, name, "return.p")
+        if not os.path.isfile(ret_path):
+            continue
+        try:
+            ret = unpack(ret_path)
+            # The return is written to the cache as it arrives
+            returned = datetime.datetime.fromtimestamp(
+                os.path.getmtime(ret_path))
+        except (IOError, OSError, ValueError):
+            logger.warning("Couldn't read {}".format(ret_path))
+            continue
+        rows, ok = ingest.minion_rows(None, ret)
+        minions.append((name, rows, ok, returned))
+    when = job_time(jid, path)
+    finished = max([m[3] for m in minions] or [when])
+    return {"jid": jid, "when": when, "finished": finished,
+            "target": target, "expr_form": load.get('tgt_type', "glob"),
+            "minions": minions}
+
+
+def write_jobs(db, jobs):
+    """Store a batch of parsed jobs in one transaction."""
+    nrows = 0
+    with db.atomic():
+        job_ids = {}
+        minions = []
+        for job in jobs:
+            dbjob = SaltJob.create(jid=job['jid'], when=job['when'],
+                                   finished=job['finished'],
+                                   target=job['target'],
+                                   expr_form=job['expr_form'],
+                                   status="finished")
+            job_ids[dbjob.id] = job
+            minions.extend({"job": dbjob.id, "minion": name,
+                            "status": "returned", "returned": returned}
+                           for name, _, _, returned in job['minions'])
+        ingest.bulk_insert(SaltJobMinion, minions)
+
+        ids = list(job_ids)
+        minion_ids = {}
+        for i in range(0, len(ids), ingest.CHUNK):
+            query = (SaltJobMinion
+                     .select(SaltJobMinion.id, SaltJobMinion.job,
+                             SaltJobMinion.minion)
+                     .where(SaltJobMinion.job << ids[i:i + ingest.CHUNK]))
+            for dbminion in query:
+                minion_ids[(dbminion._data['job'], dbminion.minion)] = \
+                    dbminion.id
+
+        rows = []
+        fleet = []
+        for job_id, job in job_ids.items():
+            for name, minion_rows, _, returned in job['minions']:
+                minion_id = minion_ids[(job_id, name)]
+                for row in minion_rows:
+                    row['minion'] = minion_id
+                rows.extend(minion_rows)
+                fleet.append((name, job_id, minion_id, returned, minion_rows))
+        ingest.bulk_insert(SaltMinionResult, rows)
+        ingest.update_fleet(fleet)
+        nrows += len(rows)
+    return nrows
+
+
+def run(cfg, jobs_dir, workers, batch_size):
+    db = Database(cfg)
+    db.connect()
+    existing = frozenset(j.jid for j in SaltJob.select(SaltJob.jid))
+    print("{} jobs already in the database will be skipped"
+          .format(len(existing)))
+
+    start = last_report = time.time()
+    seen = imported = minions = rows = 0
+    batch = []
+    pool = multiprocessing.Pool(workers, init_worker, (existing,))
+    try:
+        for job in pool.imap_unordered(parse_job, job_dirs(jobs_dir), 16):
+            seen += 1
+            if job is not None:
+                batch.append(job)
+            if len(batch) >= batch_size:
+                rows += write_jobs(db.db, batch)
+                imported += len(batch)
+                minions += sum(len(j['minions']) for j in batch)
+                batch = []
+            if time.time() - last_report >= 5:
+                last_report = time.time()
+                elapsed = last_report - start
+                print("{} jobs scanned, {} imported ({:.0f} jobs/s, "
+                      "{:.0f} rows/s)".format(seen, imported,
+                                              imported / elapsed,
+                                              rows / elapsed))
+        if batch:
+            rows += write_jobs(db.db, batch)
+            imported += len(batch)
+            minions += sum(len(j['minions']) for j in batch)
+    finally:
+        pool.terminate()
+        db.close()
+
+    elapsed = time.time() - start
+    print("Imported {} of {} jobs ({} minion returns, {} rows) in {:.1f}s, "
+          "{:.0f} jobs/s".format(imported, seen, minions, rows, elapsed,
+                                 imported / max(elapsed, 1e-6)))
+
+
+def main():
+    """
+    Imports highstates from the salt master's job cache
+    Entry point: saltbot-import
+    """
+    parser = argparse.ArgumentParser(
+        description="Import highstate history from the salt job cache")
+    parser.add_argument("jobs_dir", nargs="?", default=JOBS_DIR,
+                        help="salt's job cache (default {})".format(JOBS_DIR))
+    parser.add_argument("--config", default="saltbot.yml")
+    parser.add_argument("--workers", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="processes parsing jobs (default: one per CPU)")
+    parser.add_argument("--batch", type=int, default=200,
+                        help="jobs written per transaction")
+    args = parser.parse_args()
+
+    if msgpack is None:
+        print("The msgpack module is needed to read salt's job cache")
+        return 1
+    cfg = config.ConfigParser().load(args.config)
+    run(cfg, args.jobs_dir, args.workers, args.batch)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
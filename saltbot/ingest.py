@@ -0,0 +1,299 @@
+# Saltbot
+# Copyright 2015 Adam Greig
+# Licensed under the MIT license, see LICENCE file for details.
+
+"""
+Storing minion returns in the database.
+
+Each minion's return is written in a single transaction along with its
+status, so a minion either has all of its results stored or none of them,
+and anything recovering after a crash can tell which minions are missing.
+The fleet state tables are updated in the same transaction.
+"""
+
+import json
+import logging
+import datetime
+
+from peewee import IntegrityError
+
+from .database import SaltJob, SaltJobMinion, SaltMinionResult
+from .database import FleetMinion, FleetFailure
+
+logger = logging.getLogger("saltbot.ingest")
+
+# Salt functions whose returns are highstate results
+FUNCS = ("state.highstate", "state.apply")
+
+# Ids per IN (...) list, keeping well under SQLite's default limit of 999
+# bound parameters per statement
+CHUNK = 90
+
+
+def state_row(minion_id, key, val):
+    """A SaltMinionResult row for one state in a highstate return."""
+    row = {"minion": minion_id, "output": json.dumps(val),
+           "key_state": None, "key_id": None, "key_name": None,
+           "key_func": None, "comment": None, "run_num": None,
+           "changed": None, "result": None, "duration": None,
+           "start": None}
+
+    # Get key based data
+    try:
+        k_state, k_id, k_name, k_func = key.split("_|-")
+        row['key_state'] = k_state
+        row['key_id'] = k_id
+        row['key_name'] = k_name
+        row['key_func'] = k_func
+    except ValueError:
+        pass
+
+    # Get some other data fields that we care to store
+    try:
+        row['result'] = bool(val['result'])
+        row['comment'] = str(val['comment'])
+        row['run_num'] = int(val['__run_num__'])
+        row['changed'] = val['changes'] != {}
+    except KeyError:
+        row['result'] = False
+
+    # Timings, which older salt versions don't report
+    if isinstance(val, dict):
+        row['duration'] = parse_duration(val.get('duration'))
+        if val.get('start') is not None:
+            row['start'] = str(val['start'])
+    return row
+
+
+def jid_time(jid):
+    """When the job *jid* started, which salt encodes in the jid, or None."""
+    try:
+        return datetime.datetime.strptime(jid[:20], "%Y%m%d%H%M%S%f")
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_duration(duration):
+    """
+    A state's duration in milliseconds, given as a number or, by some salt
+    versions, a string such as "12.3 ms".
+    """
+    if duration is None:
+        return None
+    try:
+        return float(str(duration).replace("ms", "").strip())
+    except ValueError:
+        return None
+
+
+def error_row(minion_id, msg):
+    """A SaltMinionResult row for one error returned by a minion."""
+    return {"minion": minion_id, "output": json.dumps(msg),
+            "key_state": None, "key_id": "Minion Error", "key_name": None,
+            "key_func": None, "comment": None, "run_num": None,
+            "changed": None, "result": False, "duration": None,
+            "start": None}
+
+
+def minion_rows(minion_id, ret):
+    """
+    Turn one minion's return into SaltMinionResult rows. Returns the rows
+    and whether the minion reported no errors.
+    """
+    if not isinstance(ret, (dict, list)):
+        # Some errors are returned as a single string
+        ret = [ret]
+    if isinstance(ret, list):
+        # The minion returned a list of errors instead of state results
+        return [error_row(minion_id, msg) for msg in ret], False
+    rows = []
+    ok = True
+    for key, val in ret.items():
+        rows.append(state_row(minion_id, key, val))
+        if 'result' in val and not val['result']:
+            ok = False
+    return rows, ok
+
+
+def bulk_insert(model, rows):
+    """
+    Insert *rows* (dicts of field name to value, all with the same keys)
+    with a single executemany, which is much faster than insert_many for
+    large numbers of rows.
+    """
+    if not rows:
+        return
+    db = model._meta.database
+    fields = [model._meta.fields[name] for name in rows[0]]
+    quote = db.compiler().quote
+    sql = "INSERT INTO {} ({}) VALUES ({})".format(
+        quote(model._meta.db_table),
+        ", ".join(quote(f.db_column) for f in fields),
+        ", ".join([db.interpolation] * len(fields)))
+    params = [[f.db_value(row[f.name]) for f in fields] for row in rows]
+    db.get_cursor().executemany(sql, params)
+
+
+def insert_rows(rows):
+    # Each row is bound separately by executemany, so however many columns
+    # a result has, no statement comes near SQLite's parameter limit
+    bulk_insert(SaltMinionResult, rows)
+
+
+def update_minions(updates, status):
+    """
+    Set *status* and the return time on each of a list of (SaltJobMinion
+    id, returned) with a single executemany.
+    """
+    db = SaltJobMinion._meta.database
+    quote = db.compiler().quote
+    sql = "UPDATE {} SET {} = {p}, {} = {p} WHERE {} = {p}".format(
+        quote(SaltJobMinion._meta.db_table), quote("status"),
+        quote("returned"), quote("id"), p=db.interpolation)
+    returned_field = SaltJobMinion._meta.fields['returned']
+    db.get_cursor().executemany(sql, [
+        (status, returned_field.db_value(returned), ident)
+        for ident, returned in updates])
+
+
+def store_return(dbminion, ret, status="returned", returned=None):
+    """
+    Store the return *ret* for *dbminion* and set its status and return
+    time (by default now), all in one transaction. Returns (ok, number of
+    rows written).
+    """
+    oks, rows = store_returns([(dbminion, ret, returned)], status)
+    return oks[0], rows
+
+
+def store_returns(returns, status="returned"):
+    """
+    Store a batch of (dbminion, ret, returned) returns in one transaction,
+    setting each minion's status and return time (now if *returned* is
+    None). Returns (a list of ok for each return, number of rows written).
+    """
+    now = datetime.datetime.now()
+    rows, oks = [], []
+    updates = []
+    fleet = []
+    for dbminion, ret, returned in returns:
+        new_rows, ok = minion_rows(dbminion.id, ret)
+        rows.extend(new_rows)
+        oks.append(ok)
+        updates.append((dbminion.id, returned or now))
+        fleet.append((dbminion.minion, dbminion._data['job'], dbminion.id,
+                      returned or now, new_rows))
+    with SaltMinionResult._meta.database.atomic():
+        insert_rows(rows)
+        update_minions(updates, status)
+        update_fleet(fleet)
+    for dbminion, _, returned in returns:
+        dbminion.status = status
+        dbminion.returned = returned or now
+    return oks, len(rows)
+
+
+def fleet_status(rows):
+    """A minion's fleet status given the rows for its latest return."""
+    if any(r['key_state'] is None and r['key_id'] == "Minion Error"
+           for r in rows):
+        return "error"
+    elif all(r['result'] for r in rows):
+        return "ok"
+    else:
+        return "failing"
+
+
+def update_fleet(returns):
+    """
+    Update the fleet state from a batch of (minion name, job id, job minion
+    id, returned, rows) returns. A return older than the one already
+    recorded for its minion, such as a late return to an old job or one
+    from an import, is ignored.
+
+    Two processes storing returns for one minion at once can race to
+    replace its entry. The fleet state is only a summary of results stored
+    elsewhere, so rather than fail the whole batch the update is skipped
+    and the minion's next return puts it right.
+    """
+    latest = {}
+    for entry in returns:
+        if entry[0] not in latest or entry[3] >= latest[entry[0]][3]:
+            latest[entry[0]] = entry
+    names = list(latest)
+    for i in range(0, len(names), CHUNK):
+        query = (FleetMinion.select(FleetMinion.minion, FleetMinion.returned)
+                            .where(FleetMinion.minion << names[i:i + CHUNK]))
+        for current in query:
+            if current.returned > latest[current.minion][3]:
+                del latest[current.minion]
+    if not latest:
+        return
+
+    names = list(latest)
+    minions, failures = [], []
+    for name, job_id, job_minion, returned, rows in latest.values():
+        minions.append({
+            "minion": name, "job": job_id, "job_minion": job_minion,
+            "status": fleet_status(rows), "returned": returned,
+            "num_results": len(rows),
+            "num_failed": sum(1 for r in rows if not r['result']),
+            "num_changed": sum(1 for r in rows if r['changed'])})
+        failures.extend({
+            "minion": name, "key_state": r['key_state'],
+            "key_id": r['key_id'], "key_name": r['key_name'],
+            "key_func": r['key_func'], "run_num": r['run_num'],
+            "comment": r['comment'] if r['comment'] is not None
+            else r['output']} for r in rows if not r['result'])
+    try:
+        with FleetMinion._meta.database.atomic():
+            for i in range(0, len(names), CHUNK):
+                chunk = names[i:i + CHUNK]
+                FleetFailure.delete().where(
+                    FleetFailure.minion << chunk).execute()
+                FleetMinion.delete().where(
+                    FleetMinion.minion << chunk).execute()
+            bulk_insert(FleetMinion, minions)
+            bulk_insert(FleetFailure, failures)
+    except IntegrityError:
+        logger.warning("Fleet state for {} changed while updating it, "
+                       "skipped".format(", ".join(names)))
+
+
+def rebuild_fleet():
+    """
+    Recreate the fleet state from each minion's latest stored return, for
+    databases with results from before it was kept. Returns stored before
+    their time was recorded count as arriving when their job started, and
+    are ordered by job.
+    """
+    latest = {}
+    with_results = SaltMinionResult.select(SaltMinionResult.minion)
+    returnsq = (SaltJobMinion.select(SaltJobMinion.minion,
+                                     SaltJobMinion.returned, SaltJob.when,
+                                     SaltJob.id, SaltJobMinion.id)
+                             .join(SaltJob)
+                             .where(~(SaltJobMinion.returned >> None) |
+                                    (SaltJobMinion.id << with_results))
+                             .tuples())
+    for name, returned, when, job_id, ident in returnsq.iterator():
+        key = (returned or when, job_id, ident)
+        if name not in latest or key > latest[name]:
+            latest[name] = key
+    logger.info("Rebuilding fleet state for {} minions".format(len(latest)))
+    returned = dict((ident, when) for when, _, ident in latest.values())
+    ids = list(returned)
+    with FleetMinion._meta.database.atomic():
+        FleetFailure.delete().execute()
+        FleetMinion.delete().execute()
+        for i in range(0, len(ids), CHUNK):
+            chunk = ids[i:i + CHUNK]
+            rows = {}
+            results = (SaltMinionResult.select()
+                                       .where(SaltMinionResult.minion << chunk)
+                                       .dicts())
+            for row in results:
+                rows.setdefault(row['minion'], []).append(row)
+            minions = SaltJobMinion.select().where(SaltJobMinion.id << chunk)
+            update_fleet([(m.minion, m._data['job'], m.id, returned[m.id],
+                           rows.get(m.id, [])) for m in minions])
@@ -3,6 +3,7 @@
 # Licensed under MIT license, see LICENCE file for details.
 
 
+import time
 import string
 import logging
 
@@ -27,7 +28,14 @@ class IRCBot(irc.bot.SingleServerIRCBot):
         self.port = config['irc']['port']
         self.channel = config['irc']['channel']
         self.nick = config['irc']['nick']
-        self.auth_check_in_flight = None
+        self.ident_ttl = config['irc']['ident_ttl']
+        self.ident_timeout = config['irc']['ident_timeout']
+        # Both are keyed by the nick in lower case, as NickServ may not
+        # reply with the same case as the nick was sent in.
+        # Nick -> (time ACC was sent, nick, commands awaiting the response)
+        self.auth_checks_in_flight = {}
+        # Nick -> time at which their verified identity expires
+        self.verified_idents = {}
         super(IRCBot, self).__init__([(self.server, self.port)],
                                      self.nick, self.nick)
 
@@ -65,6 +73,17 @@ class IRCBot(irc.bot.SingleServerIRCBot):
             if sender in self.config['irc']['owners']:
                 self.check_ident_and_cmd(sender, a[1])
 
+    def on_nick(self, c, e):
+        old = e.source.split("!")[0]
+        self.forget_ident(old)
+        self.forget_ident(e.target)
+
+    def on_quit(self, c, e):
+        self.forget_ident(e.source.split("!")[0])
+
+    def on_part(self, c, e):
+        self.forget_ident(e.source.split("!")[0])
+
     def on_privnotice(self, c, e):
         # Strip non-printable characters from log output
         msg = ''.join(c for c in e.arguments[0] if c in string.printable)
@@ -78,11 +97,52 @@ class IRCBot(irc.bot.SingleServerIRCBot):
         """
         Verify with NickServ that *sender* is identified, and if so,
         execute *msg*.
+
+        Recently verified identities are cached for irc.ident_ttl seconds,
+        in which case *msg* is executed immediately. Otherwise *msg* is
+        queued behind any other commands from *sender* awaiting NickServ,
+        and only one ACC request is in flight per nick at a time. If
+        NickServ hasn't answered within irc.ident_timeout seconds the
+        waiting commands are dropped, so a lost reply can't lock a nick out.
         """
+        key = irc.strings.lower(sender)
+        expires = self.verified_idents.get(key)
+        if expires is not None and expires > time.time():
+            logger.info("Identity for {} cached, issuing command: {}"
+                        .format(sender, msg))
+            self.irccq.put(("cmd", (sender, msg)))
+            return
+
+        self.expire_auth_checks()
+        if key in self.auth_checks_in_flight:
+            self.auth_checks_in_flight[key][2].append(msg)
+            return
+        self.auth_checks_in_flight[key] = (time.time(), sender, [msg])
         logger.info("Validating identity of {} with NickServ".format(sender))
-        self.auth_check_in_flight = (sender, msg)
         self.connection.privmsg("NickServ", "ACC {}".format(sender))
 
+    def expire_auth_checks(self):
+        """Drop ACC requests which NickServ hasn't answered in time."""
+        cutoff = time.time() - self.ident_timeout
+        for key, (sent, who, pending) in list(
+                self.auth_checks_in_flight.items()):
+            if sent < cutoff:
+                del self.auth_checks_in_flight[key]
+                logger.warning("No response from NickServ about {}, "
+                               "dropping {} command(s)"
+                               .format(who, len(pending)))
+                self.connection.privmsg(
+                    who, "NickServ didn't respond, please try again")
+
+    def forget_ident(self, who):
+        """
+        Drop any cached identity for *who*, e.g. when they change nick,
+        quit or part. Commands already awaiting NickServ are kept, as the
+        ACC response will still tell us whether to run them.
+        """
+        if self.verified_idents.pop(irc.strings.lower(who), None) is not None:
+            logger.info("Forgetting cached identity for {}".format(who))
+
     def handle_nickserv(self, e):
         """
         Respond to a NickServ privmsg.
@@ -91,14 +151,22 @@ class IRCBot(irc.bot.SingleServerIRCBot):
         msg = e.arguments[0]
         parts = msg.split()
 
-        if self.auth_check_in_flight and len(parts) == 3 and parts[1] == "ACC":
-            who, what = self.auth_check_in_flight
-            if parts[0] == who and parts[2] == "3":
-                logger.info("Identity for {} valid, issuing command: {}"
-                            .format(who, what))
-                self.irccq.put(("cmd", (who, what)))
+        if len(parts) == 3 and parts[1] == "ACC":
+            key = irc.strings.lower(parts[0])
+            check = self.auth_checks_in_flight.pop(key, None)
+            if check is None:
+                return
+            _, who, pending = check
+            if parts[2] == "3":
+                if self.ident_ttl:
+                    self.verified_idents[key] = time.time() + self.ident_ttl
+                for what in pending:
+                    logger.info("Identity for {} valid, issuing command: {}"
+                                .format(who, what))
+                    self.irccq.put(("cmd", (who, what)))
             else:
-                logger.info("Could not validate identity for {}".format(who))
+                logger.info("Could not validate identity for {}, dropping "
+                            "{} command(s)".format(who, len(pending)))
                 self.connection.privmsg(who, "Please identify to NickServ")
 
     def check_queue(self):
@@ -110,19 +178,29 @@ class IRCBot(irc.bot.SingleServerIRCBot):
                 send `message` to the current channel
             "privmsg" : (user, message)
                 send `message` to `user`
+
+        Either may be followed by a trace dict containing a `jid`, in which
+        case we report back once the message has been sent.
+
+        Also gives up on any NickServ checks that have timed out.
         """
+        self.expire_auth_checks()
         while True:
             try:
-                cmd, arg = self.ircmq.get_nowait()
+                item = self.ircmq.get_nowait()
             except Empty:
                 break
             else:
+                cmd, arg = item[:2]
                 if cmd == "pubmsg":
                     logger.info("Sending [{}] {}".format(self.channel, arg))
                     self.connection.privmsg(self.channel, arg)
                 elif cmd == "privmsg":
                     logger.info("Sending [{}] {}".format(arg[0], arg[1]))
                     self.connection.privmsg(arg[0], arg[1])
+                if len(item) > 2 and item[2]:
+                    self.irccq.put(("trace", (item[2]['jid'],
+                                              "irc_delivered", time.time())))
 
 
 def run(config, ircmq, irccq):
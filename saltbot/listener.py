@@ -0,0 +1,229 @@
+# Saltbot
+# Copyright 2015 Adam Greig
+# Licensed under the MIT license, see LICENCE file for details.
+
+"""
+Passive ingestion of highstate returns from the salt master's event bus.
+
+Highstates run from cron, the salt CLI or a scheduler don't go through the
+saltshaker, so the listener picks up their returns and stores them as jobs
+too. Returns are buffered and written in batches, and if the database falls
+behind, the oldest buffered returns are dropped rather than letting the
+buffer grow without limit.
+"""
+
+import re
+import time
+import errno
+import logging
+import datetime
+import collections
+
+from peewee import DatabaseError
+
+try:
+    import salt.client
+    FAKE_SALT = False
+except ImportError:
+    from . import fakesalt as salt
+    FAKE_SALT = True
+
+from . import ingest
+from . import metrics
+from .database import Database, SaltJob, SaltJobMinion
+
+logger = logging.getLogger("saltbot.listener")
+
+NEW_TAG = re.compile(r"^salt/job/(\d+)/new$")
+RET_TAG = re.compile(r"^salt/job/(\d+)/ret/(.+)$")
+
+# How many jobs to remember details of
+JOB_CACHE = 1000
+
+
+class Listener:
+    def __init__(self, config):
+        self.cfg = config['listener']
+        if FAKE_SALT:
+            salt.configure(config.get('fakesalt'))
+        self.client = salt.client.LocalClient()
+        self.db = Database(config)
+        self.db.connect()
+        self.pending = collections.deque()
+        self.jobs = collections.OrderedDict()
+        self.new = collections.OrderedDict()
+        self.last_flush = time.time()
+        self.dropped = 0
+
+    def run(self):
+        opts = self.client.opts
+        event = salt.utils.event.get_event(
+            'master', opts['sock_dir'], opts['transport'], opts=opts,
+            listen=True)
+        logger.info("Listening for highstate returns")
+        while True:
+            try:
+                raw = event.get_event(wait=self.cfg['flush_interval'],
+                                      tag='salt/job/', full=True)
+            except salt.client.zmq.ZMQError as e:
+                if e.errno not in (errno.EAGAIN, errno.EINTR):
+                    raise
+                raw = None
+            if raw:
+                self.handle_event(raw['tag'], raw['data'])
+            if self.flush_due():
+                self.flush()
+
+    def handle_event(self, tag, data):
+        if data.get('fun') not in ingest.FUNCS:
+            return
+        match = NEW_TAG.match(tag)
+        if match:
+            remember(self.new, match.group(1), data)
+            return
+        match = RET_TAG.match(tag)
+        if not match:
+            return
+        if len(self.pending) >= self.cfg['max_pending']:
+            self.pending.popleft()
+            self.dropped += 1
+            metrics.inc("saltbot_events_total", outcome="dropped")
+        else:
+            metrics.inc("saltbot_events_total", outcome="queued")
+        jid, minion = match.groups()
+        self.pending.append((time.time(), jid, minion, data.get('return')))
+
+    def flush_due(self):
+        if not self.pending:
+            return False
+        return (len(self.pending) >= self.cfg['batch_size'] or
+                time.time() - self.last_flush >= self.cfg['flush_interval'])
+
+    def flush(self):
+        """
+        Store up to batch_size buffered returns. Returns are only stored
+        once they're `grace` seconds old, so that jobs started by the
+        saltshaker have been recorded by then and can be skipped.
+        """
+        self.last_flush = time.time()
+        ready = self.last_flush - self.cfg['grace']
+        batch = []
+        while (self.pending and len(batch) < self.cfg['batch_size'] and
+               self.pending[0][0] <= ready):
+            batch.append(self.pending.popleft())
+        if not batch:
+            return
+
+        start = time.time()
+        try:
+            with self.db.db.atomic():
+                returns = []
+                seen = set()
+                finished = {}
+                for received, jid, minion, ret in batch:
+                    dbminion = self.minion_record(jid, minion)
+                    if dbminion is None or (jid, minion) in seen:
+                        continue
+                    seen.add((jid, minion))
+                    returned = datetime.datetime.fromtimestamp(received)
+                    returns.append((dbminion, ret, returned))
+                    job_id = dbminion._data['job']
+                    finished[job_id] = max(finished.get(job_id, returned),
+                                           returned)
+                oks, rows = ingest.store_returns(returns)
+                # An observed job is finished as of its latest return
+                for job_id, returned in finished.items():
+                    (SaltJob.update(finished=returned)
+                            .where(SaltJob.id == job_id)
+                            .execute())
+        except DatabaseError:
+            logger.exception("Error storing returns, will retry")
+            # Records created in the failed transaction are gone too
+            self.jobs.clear()
+            self.pending.extendleft(reversed(batch))
+            return
+
+        elapsed = time.time() - start
+        logger.info("Stored {} returns ({} rows) in {:.3f}s, {} pending"
+                    .format(len(returns), rows, elapsed, len(self.pending)))
+        if self.dropped:
+            logger.warning("Dropped {} returns as the database fell behind"
+                           .format(self.dropped))
+            self.dropped = 0
+        metrics.observe("saltbot_db_write_seconds", elapsed)
+        metrics.inc("saltbot_db_rows_total", rows)
+        metrics.set_gauge("saltbot_queue_depth", len(self.pending),
+                          queue="events")
+
+    def minion_record(self, jid, minion):
+        """
+        The SaltJobMinion to store *minion*'s return to *jid* in, or None
+        if it shouldn't be stored: because the job was started by the
+        saltshaker, or the return has already been stored.
+        """
+        if jid not in self.jobs:
+            remember(self.jobs, jid, self.job_record(jid))
+        dbjob, dbminions = self.jobs[jid]
+        if dbjob is None:
+            return None
+        if minion not in dbminions:
+            dbminions[minion] = SaltJobMinion.create(job=dbjob, minion=minion)
+        elif dbminions[minion].status is not None:
+            return None
+        return dbminions[minion]
+
+    def job_record(self, jid):
+        """
+        Find or create the SaltJob for *jid*, returning it and its minions,
+        or (None, {}) if it's a job the saltshaker is looking after.
+        """
+        try:
+            dbjob = SaltJob.get(jid=jid)
+        except SaltJob.DoesNotExist:
+            new = self.new.pop(jid, {})
+            target = new.get('tgt', "")
+            if isinstance(target, list):
+                target = ",".join(target)
+            dbjob = SaltJob.create(jid=jid, when=job_time(jid, new),
+                                   target=target,
+                                   expr_form=new.get('tgt_type', "glob"),
+                                   status="observed")
+            logger.info("Recording highstate {} seen on the event bus"
+                        .format(jid))
+            for minion in new.get('minions', []):
+                SaltJobMinion.create(job=dbjob, minion=minion)
+        else:
+            if dbjob.status != "observed":
+                return None, {}
+        return dbjob, dict((m.minion, m) for m in dbjob.minions)
+
+
+def job_time(jid, new):
+    """
+    When the job *jid* started: from its jid, or failing that the time
+    stamp on its new job event, or failing that now.
+    """
+    when = ingest.jid_time(jid)
+    if when is None and new.get('_stamp'):
+        try:
+            when = datetime.datetime.strptime(new['_stamp'],
+                                              "%Y-%m-%dT%H:%M:%S.%f")
+        except ValueError:
+            pass
+    return when or datetime.datetime.now()
+
+
+def remember(cache, key, value):
+    """Add *key* to an OrderedDict *cache*, forgetting the oldest keys."""
+    cache[key] = value
+    while len(cache) > JOB_CACHE:
+        cache.popitem(last=False)
+
+
+def run(config):
+    listener = Listener(config)
+    try:
+        listener.run()
+    except Exception:
+        logger.exception("Unhandled exception")
+        raise
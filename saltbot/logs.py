@@ -0,0 +1,120 @@
+# Saltbot
+# Copyright 2015 Adam Greig
+# Licensed under the MIT license, see LICENCE file for details.
+
+import time
+import random
+import logging
+import threading
+
+try:
+    from logging.handlers import QueueHandler
+except ImportError:
+    QueueHandler = None
+
+logger = logging.getLogger("saltbot.logs")
+
+
+def match_logger(name, names):
+    """
+    Find the most specific entry in *names* which is either *name* or one
+    of its ancestors, or None if there isn't one.
+    """
+    while name:
+        if name in names:
+            return name
+        name = name.rpartition(".")[0]
+    return None
+
+
+class ThrottleFilter(logging.Filter):
+    """
+    Drop some records below WARNING from high volume loggers.
+
+    *sampling* maps logger names to the fraction of records to keep, and
+    *rate_limits* maps logger names to the maximum records per second to
+    keep. Both apply to descendants of the named loggers too.
+    """
+    def __init__(self, sampling, rate_limits):
+        super(ThrottleFilter, self).__init__()
+        self.sampling = sampling
+        self.rate_limits = rate_limits
+        self.buckets = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+
+        name = match_logger(record.name, self.sampling)
+        if name is not None and random.random() >= self.sampling[name]:
+            return False
+
+        name = match_logger(record.name, self.rate_limits)
+        if name is not None:
+            rate = self.rate_limits[name]
+            now = time.time()
+            tokens, last = self.buckets.get(name, (rate, now))
+            tokens = min(rate, tokens + (now - last) * rate)
+            if tokens < 1:
+                self.buckets[name] = (tokens, now)
+                return False
+            self.buckets[name] = (tokens - 1, now)
+
+        return True
+
+
+class LogListener:
+    """
+    Runs in the main process, taking records off *logq* and handing them to
+    the handlers configured for their logger.
+    """
+    def __init__(self, logq):
+        self.logq = logq
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,
+                                       name="Saltbot Log Listener")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                record = self.logq.get()
+            except (EOFError, OSError):
+                break
+            if record is None:
+                break
+            log = logging.getLogger(record.name)
+            if log.isEnabledFor(record.levelno):
+                log.handle(record)
+
+    def stop(self):
+        if self.thread is not None:
+            self.logq.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+def configure_child(logq, config):
+    """
+    Replace every handler inherited from the main process with a single
+    QueueHandler feeding *logq*, so that slow handlers only ever run in the
+    main process's LogListener.
+    """
+    root = logging.getLogger()
+    loggers = [l for l in logging.Logger.manager.loggerDict.values()
+               if isinstance(l, logging.Logger)]
+    for log in [root] + loggers:
+        for handler in list(log.handlers):
+            log.removeHandler(handler)
+        if log is not root:
+            # The listener dispatches to the original logger, which will
+            # honour its own propagate setting there.
+            log.propagate = True
+
+    handler = QueueHandler(logq)
+    handler.addFilter(ThrottleFilter(config['sampling'],
+                                     config['rate_limits']))
+    root.addHandler(handler)
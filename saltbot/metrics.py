@@ -0,0 +1,193 @@
+# Saltbot
+# Copyright 2015 Adam Greig
+# Licensed under the MIT license, see LICENCE file for details.
+
+"""
+Process-wide metrics, exposed in the Prometheus text format.
+
+Any process may call inc(), observe() or set_gauge(); the update is put on
+a shared queue and aggregated by a Registry in the main process, which also
+serves /metrics from a small dedicated HTTP listener. If metrics are not
+enabled these calls do nothing.
+"""
+
+import logging
+import threading
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+try:
+    from queue import Full
+except ImportError:
+    from Queue import Full
+
+logger = logging.getLogger("saltbot.metrics")
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+           120, 300, 600, 1800)
+
+METRICS = {
+    "saltbot_queue_depth":
+        ("gauge", "Messages waiting on each inter-process queue"),
+    "saltbot_jobs_total":
+        ("counter", "Salt jobs finished, by outcome"),
+    "saltbot_job_duration_seconds":
+        ("histogram", "Time from starting a Salt job to its summary"),
+    "saltbot_minion_return_seconds":
+        ("histogram", "Time from starting a Salt job to each minion return"),
+    "saltbot_db_write_seconds":
+        ("histogram", "Time to store the results from one minion"),
+    "saltbot_db_rows_total":
+        ("counter", "Result rows written to the database"),
+    "saltbot_http_request_seconds":
+        ("histogram", "Web request latency, by route"),
+    "saltbot_events_total":
+        ("counter", "Highstate returns seen on the event bus, by outcome"),
+    "saltbot_child_restarts_total":
+        ("counter", "Child processes restarted after dying, by process"),
+}
+
+_queue = None
+
+
+def configure(metq):
+    """Send this process's metrics to *metq*."""
+    global _queue
+    _queue = metq
+
+
+def _put(kind, name, value, labels):
+    if _queue is None:
+        return
+    try:
+        _queue.put_nowait((kind, name, tuple(sorted(labels.items())), value))
+    except Full:
+        pass
+
+
+def inc(name, value=1, **labels):
+    _put("counter", name, value, labels)
+
+
+def observe(name, value, **labels):
+    _put("histogram", name, value, labels)
+
+
+def set_gauge(name, value, **labels):
+    _put("gauge", name, value, labels)
+
+
+def format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ""
+    esc = lambda v: (str(v).replace("\\", "\\\\").replace("\n", "\\n")
+                     .replace('"', '\\"'))
+    return "{" + ",".join('{}="{}"'.format(k, esc(v))
+                          for k, v in labels) + "}"
+
+
+class Registry:
+    """Aggregates metric updates arriving on *metq* from all processes."""
+    def __init__(self, metq):
+        self.metq = metq
+        self.lock = threading.Lock()
+        self.values = {}
+        self.collectors = []
+        self.thread = None
+
+    def add_collector(self, collector):
+        """
+        Register *collector*, called at each scrape to update metrics that
+        are cheaper to sample than to track, such as queue depths.
+        """
+        self.collectors.append(collector)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,
+                                       name="Saltbot Metrics")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                update = self.metq.get()
+            except (EOFError, OSError):
+                break
+            self.update(*update)
+
+    def update(self, kind, name, labels, value):
+        key = (name, labels)
+        with self.lock:
+            if kind == "counter":
+                self.values[key] = self.values.get(key, 0) + value
+            elif kind == "gauge":
+                self.values[key] = value
+            elif kind == "histogram":
+                if key not in self.values:
+                    self.values[key] = [[0] * len(BUCKETS), 0.0, 0]
+                hist = self.values[key]
+                for i, bound in enumerate(BUCKETS):
+                    if value <= bound:
+                        hist[0][i] += 1
+                hist[1] += value
+                hist[2] += 1
+
+    def render(self):
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception:
+                logger.exception("Error running metrics collector")
+
+        lines = []
+        with self.lock:
+            for name in sorted(METRICS):
+                kind, doc = METRICS[name]
+                keys = sorted(k for k in self.values if k[0] == name)
+                lines.append("# HELP {} {}".format(name, doc))
+                lines.append("# TYPE {} {}".format(name, kind))
+                for key in keys:
+                    labels, value = key[1], self.values[key]
+                    if kind != "histogram":
+                        lines.append("{}{} {}".format(
+                            name, format_labels(labels), value))
+                        continue
+                    buckets, total, count = value
+                    for bound, n in zip(BUCKETS, buckets):
+                        lines.append("{}_bucket{} {}".format(
+                            name, format_labels(labels, [("le", bound)]), n))
+                    lines.append("{}_bucket{} {}".format(
+                        name, format_labels(labels, [("le", "+Inf")]), count))
+                    lines.append("{}_sum{} {}".format(
+                        name, format_labels(labels), total))
+                    lines.append("{}_count{} {}".format(
+                        name, format_labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+    def wsgi_app(self, environ, start_response):
+        if environ.get('PATH_INFO') != "/metrics":
+            start_response("404 Not Found", [("Content-Type", "text/plain")])
+            return [b"Not Found\n"]
+        body = self.render().encode()
+        start_response("200 OK", [
+            ("Content-Type", "text/plain; version=0.0.4"),
+            ("Content-Length", str(len(body)))])
+        return [body]
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def serve(registry, host, port):
+    """Serve /metrics for *registry* from a background thread."""
+    server = make_server(host, port, registry.wsgi_app,
+                         handler_class=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name="Saltbot Metrics Server")
+    thread.daemon = True
+    thread.start()
+    logger.info("Serving metrics on {}:{}".format(host, port))
+    return server
@@ -4,6 +4,7 @@
 
 import time
 import json
+import math
 import errno
 import logging
 import datetime
@@ -21,21 +22,33 @@ try:
 except NameError:
     reloading = False
 else:
-    from . import fakesalt, database
+    from . import fakesalt, database, scheduler, ingest
     reload(fakesalt)
     reload(database)
+    reload(scheduler)
+    reload(ingest)
 
 
 try:
     import salt.client
+    FAKE_SALT = False
 except ImportError:
     import warnings
     warnings.warn("Could not import 'salt', will use fake salt.")
     from . import fakesalt as salt
+    FAKE_SALT = True
 
+from . import ingest
+from . import metrics
+from . import tracing
+from .scheduler import Scheduler
 from .database import Database, SaltJob, SaltJobMinion, SaltMinionResult
 
 
+# Late returns are reported together, at most this often per job (seconds)
+LATE_REPORT_INTERVAL = 60
+
+
 class SaltShakerException(Exception):
     pass
 
@@ -45,24 +58,75 @@ class SaltShaker:
         self.cfg = config
         self.sltcq = sltcq
         self.sltrq = sltrq
+        if FAKE_SALT:
+            salt.configure(config.get('fakesalt'))
         self.client = salt.client.LocalClient()
         self.db = Database(config)
         self.db.connect()
+        self.late = []
+        self.current = None
+        self.scheduler = Scheduler(config['salt']['aging'])
 
     def run(self):
+        self.scheduler.load()
+        self.recover()
+        while True:
+            self.receive()
+            arg = self.scheduler.pop()
+            if arg is None:
+                self.poll_late()
+                time.sleep(1)
+                continue
+            try:
+                self.highstate(*arg)
+            except SaltShakerException as e:
+                metrics.inc("saltbot_jobs_total", outcome="error")
+                self.sltrq.put(("salt_error", str(e)))
+
+    def receive(self):
+        """Take every waiting command off the queue."""
+        received = False
         while True:
             try:
                 cmd, arg = self.sltcq.get_nowait()
             except Empty:
-                time.sleep(1)
-                continue
-            else:
-                logger.info("Received command {} {}".format(cmd, arg))
-                if cmd == "highstate":
-                    try:
-                        self.highstate(*arg)
-                    except SaltShakerException as e:
-                        self.sltrq.put(("salt_error", str(e)))
+                break
+            logger.info("Received command {} {}".format(cmd, arg))
+            if cmd == "highstate":
+                self.scheduler.push(*arg)
+                received = True
+            elif cmd == "cancel":
+                self.cancel(*arg)
+                received = True
+        if received:
+            metrics.set_gauge("saltbot_queue_depth", len(self.scheduler),
+                              queue="scheduler")
+
+    def cancel(self, kind, ident, kill, who):
+        """
+        Cancel the queued highstate with queue id *ident* if *kind* is
+        "queue", or the running job with jid *ident* if it's "job". Running
+        jobs stop waiting for returns straight away, and if *kill* is set
+        the minions which haven't returned are told to kill the job.
+        """
+        report = {"kind": kind, "id": ident, "who": who, "kill": kill,
+                  "what": None}
+        if kind == "queue":
+            entry = self.scheduler.remove(ident)
+            if entry is not None:
+                logger.info("Cancelled queued highstate {}".format(ident))
+                report.update(what="queued", target=entry.target)
+            self.sltrq.put(("salt_cancelled", report))
+            return
+        for job in [self.current] + self.late:
+            if job is not None and job.jid == ident and not job.cancelled:
+                logger.info("Cancelling Salt job {}".format(ident))
+                job.cancel(kill)
+                if job in self.late:
+                    self.late.remove(job)
+                report.update(what="running", m=len(job.returned),
+                              n=len(job.minions))
+        self.sltrq.put(("salt_cancelled", report))
 
     def start_salt(self, tgt, expr):
         job = self.client.run_job(tgt, 'state.highstate', expr_form=expr)
@@ -70,13 +134,19 @@ class SaltShaker:
             raise SaltShakerException("Salt job not started, check targets")
         jid, minions = job['jid'], job['minions']
         iter_returns = self.client.get_iter_returns(
-            jid, minions, tgt=tgt, tgt_type=expr)
+            jid, minions, tgt=tgt, tgt_type=expr, block=False)
         return jid, minions, iter_returns
 
-    def create_records(self, tgt, expr, jid, minions, push_id):
+    def create_records(self, tgt, expr, jid, minions, push_id, trace,
+                       wave=None):
         now = datetime.datetime.now()
+        if isinstance(tgt, list):
+            tgt = ",".join(tgt)
+        wave, waves = wave or (None, None)
         dbjob = SaltJob(target=tgt, expr_form=expr, jid=jid,
-                        when=now, github_push=push_id)
+                        wave=wave, waves=waves,
+                        when=now, github_push=push_id, status="running",
+                        trace_id=trace['id'], timings=json.dumps(trace))
         dbjob.save()
         dbminions = []
         for minion in minions:
@@ -85,40 +155,6 @@ class SaltShaker:
             dbminions.append(dbminion)
         return dbjob, dbminions
 
-    def store_state_result(self, dbminion, key, val):
-        out_j = json.dumps(val)
-        dbresult = SaltMinionResult(minion=dbminion, output=out_j)
-
-        # Get key based data
-        try:
-            k_state, k_id, k_name, k_func = key.split("_|-")
-            dbresult.key_state = k_state
-            dbresult.key_id = k_id
-            dbresult.key_name = k_name
-            dbresult.key_func = k_func
-        except ValueError:
-            pass
-
-        # Get some other data fields that we care to store
-        try:
-            dbresult.result = bool(val['result'])
-            dbresult.comment = str(val['comment'])
-            dbresult.run_num = int(val['__run_num__'])
-            dbresult.changed = val['changes'] != {}
-        except KeyError:
-            dbresult.result = False
-        dbresult.save()
-
-    def handle_minion_error(self, dbminion, ret):
-        logger.warning("Got an error list for minion result:")
-        logger.warning(str(ret))
-        for msg in ret:
-            dbresult = SaltMinionResult(minion=dbminion,
-                                        output=json.dumps(msg))
-            dbresult.key_id = "Minion Error"
-            dbresult.result = False
-            dbresult.save()
-
     def wait_gitfs(self):
         """
         Watch Salt events, waiting for a gitfs refresh, then return.
@@ -143,7 +179,8 @@ class SaltShaker:
             if self.client.opts.get('transport') == 'zeromq':
                 try:
                     raw = event.get_event_noblock()
-                    logger.debug("Saw event: {}".format(raw.get('tag')))
+                    if raw:
+                        logger.debug("Saw event: {}".format(raw.get('tag')))
                     if raw and raw.get('tag', '') == tag:
                         logger.info("Saw gitfs update event")
                         break
@@ -155,7 +192,8 @@ class SaltShaker:
                         break
             else:
                 raw = event.get_event_noblock()
-                logger.debug("Saw event: {}".format(raw.get('tag')))
+                if raw:
+                    logger.debug("Saw event: {}".format(raw.get('tag')))
                 if raw and raw.get('tag', '') == tag:
                     logger.info("Saw gitfs update event")
                     break
@@ -163,47 +201,365 @@ class SaltShaker:
         # Make sure this is deleted as otherwise we'll leak event listeners
         del event
 
-    def highstate(self, target, expr, wait_gitfs, gh_push_id):
+    def recover(self):
+        """
+        Pick up jobs left running when the saltshaker last stopped. Returns
+        from minions which weren't stored yet are fetched from salt's job
+        cache, and if salt may still be running the job we carry on
+        listening for the rest as late returns.
+        """
+        dbjobs = SaltJob.select().where(SaltJob.status << ["running",
+                                                           "partial"])
+        for dbjob in dbjobs:
+            self.recover_job(dbjob)
+
+    def recover_job(self, dbjob):
+        dbminions = list(dbjob.minions.order_by(SaltJobMinion.id))
+        minions = [m.minion for m in dbminions]
+        if dbjob.timings:
+            trace = json.loads(dbjob.timings)
+        else:
+            trace = tracing.new("salt_started")
+        start = time.mktime(dbjob.when.timetuple())
+        wave = (dbjob.wave, dbjob.waves) if dbjob.waves else None
+        job = HighstateJob(self, dbjob.jid, minions, iter(()), dbjob,
+                           dbminions, trace, start, self.cfg['salt'], wave)
+        job.finalised = dbjob.status == "partial"
+        for dbminion in dbminions:
+            if dbminion.status in ("returned", "late"):
+                job.returned[dbminion.minion] = 0.0
+        failedq = (SaltJobMinion
+                   .select(SaltJobMinion.minion)
+                   .join(SaltMinionResult)
+                   .where((SaltJobMinion.job == dbjob) &
+                          (SaltMinionResult.result == False))  # noqa
+                   .distinct())
+        job.failed = set(m.minion for m in failedq)
+        job.all_ok = not job.failed
+
+        missing = [m for m in minions if m not in job.returned]
+        logger.info("Recovering Salt job {}, {}/{} minions missing"
+                    .format(dbjob.jid, len(missing), len(minions)))
+        if missing:
+            cached = self.client.get_cache_returns(dbjob.jid) or {}
+            for minion in missing:
+                if 'ret' in cached.get(minion, {}):
+                    job.store_return(minion, cached[minion]['ret'])
+
+        missing = [m for m in minions if m not in job.returned]
+        listening = bool(missing) and not job.expired()
+        if listening:
+            job.iter_returns = self.client.get_iter_returns(
+                dbjob.jid, missing, block=False)
+        if not job.finalised:
+            job.finalise(listening)
+        elif not listening:
+            job.close()
+        if listening:
+            self.late.append(job)
+
+    def poll_late(self):
+        """Store any late returns for jobs finalised before they arrived."""
+        for job in list(self.late):
+            if not job.poll() or job.expired():
+                job.close()
+                self.late.remove(job)
+            else:
+                job.report_late()
+
+    def find_minions(self, tgt, expr):
+        """List the minions matched by a target which respond to a ping."""
+        found = self.client.cmd(tgt, 'test.ping', expr_form=expr)
+        if not found:
+            raise SaltShakerException("No minions responded, check targets")
+        return sorted(found)
+
+    def highstate(self, target, expr, wait_gitfs, gh_push_id, trace=None,
+                  options=None):
+        """
+        Highstate *target*, with any per-job *options* overriding the salt
+        config section. If a batch size is set, the highstate is rolled
+        out in waves.
+        """
+        if trace is None:
+            trace = tracing.new("salt_dequeued")
+        tracing.stamp(trace, "salt_dequeued")
         if wait_gitfs:
             self.wait_gitfs()
+        tracing.stamp(trace, "gitfs_ready")
+
+        options = dict(self.cfg['salt'], **(options or {}))
+        if options.get('batch'):
+            self.rollout(target, expr, gh_push_id, trace, options)
+        else:
+            self.run_highstate(target, expr, gh_push_id, trace, options)
 
+    def rollout(self, target, expr, gh_push_id, trace, options):
+        """
+        Highstate *target* in waves of at most options['batch'] minions,
+        one wave at a time. If options['halt_on_failures'] is set, stop
+        once that many minions have failed or not returned.
+        """
+        minions = self.find_minions(target, expr)
+        size = count_option(options['batch'], len(minions))
+        limit = options.get('halt_on_failures')
+        if limit is not None:
+            limit = count_option(limit, len(minions))
+        waves = [minions[i:i + size] for i in range(0, len(minions), size)]
+        logger.info("Rolling out highstate to {} minions in {} waves"
+                    .format(len(minions), len(waves)))
+        self.sltrq.put(("salt_rollout_started",
+                        (target, len(minions), len(waves))))
+
+        base = tracing.fork(trace)
+        failed = 0
+        halted = False
+        for i, wave in enumerate(waves):
+            wave_trace = trace if i == 0 else tracing.fork(base)
+            job = self.run_highstate(wave, 'list', gh_push_id, wave_trace,
+                                     options, (i + 1, len(waves)))
+            failed += len(job.failed)
+            if job.cancelled:
+                halted = True
+                break
+            if limit is not None and failed >= limit and i + 1 < len(waves):
+                logger.warning("Halting rollout to {} after {} failures"
+                               .format(target, failed))
+                halted = True
+                break
+        self.sltrq.put(("salt_rollout_finished",
+                        (target, i + 1, len(waves), failed, halted)))
+
+    def run_highstate(self, target, expr, gh_push_id, trace, options,
+                      wave=None):
+        """Run one highstate job until it is finalised, returning it."""
+        start = time.time()
         jid, minions, iter_returns = self.start_salt(target, expr)
+        tracing.stamp(trace, "salt_started")
         dbjob, dbminions = self.create_records(
-            target, expr, jid, minions, gh_push_id)
+            target, expr, jid, minions, gh_push_id, trace, wave)
 
         logger.info("Started Salt {} to highstate {}, DB ID {}"
                     .format(jid, minions, dbjob.id))
-        self.sltrq.put(("salt_started", (jid, minions)))
-
-        all_ok = True
-        minions_heard_from = 0
-        for ret in iter_returns:
+        self.sltrq.put(("salt_started", (jid, minions, wave)))
+
+        job = HighstateJob(self, jid, minions, iter_returns, dbjob,
+                           dbminions, trace, start, options, wave)
+        self.current = job
+        while not job.cancelled:
+            if not job.poll():
+                job.finalise(listening=False)
+                break
+            deadline = job.deadline()
+            if deadline is not None and time.time() >= deadline:
+                logger.info("Deadline passed for {}".format(jid))
+                job.finalise(listening=True)
+                self.late.append(job)
+                break
+            self.receive()
+            self.poll_late()
+            time.sleep(0.05)
+        self.current = None
+        return job
+
+
+def count_option(value, total):
+    """
+    Turn an option given as a number of minions, or as a percentage of
+    *total* such as "10%", into a number of minions (at least one).
+    """
+    if str(value).endswith("%"):
+        value = int(math.ceil(total * float(str(value)[:-1]) / 100.0))
+    return max(1, int(value))
+
+
+class HighstateJob:
+    """
+    A running highstate. Returns are stored as they arrive, and once every
+    minion has returned, salt gives up, or a deadline passes, the job is
+    finalised and its summary sent. Minions still missing then are marked
+    as timed out; if salt is still listening for them, their returns are
+    stored when they turn up and reported as late.
+
+    The job deadline is counted from the start of the job. The minion
+    deadline is counted from when the median minion returned, so that the
+    time to a verdict follows the typical minion rather than the slowest.
+    """
+    def __init__(self, shaker, jid, minions, iter_returns, dbjob, dbminions,
+                 trace, start, options, wave=None):
+        self.shaker = shaker
+        self.jid = jid
+        self.minions = minions
+        self.iter_returns = iter_returns
+        self.dbjob = dbjob
+        self.dbminions = dict(zip(minions, dbminions))
+        self.trace = trace
+        self.start = start
+        self.job_deadline = options['job_deadline']
+        self.minion_deadline = options['minion_deadline']
+        self.late_returns = options['late_returns']
+        self.wave = wave
+        self.returned = {}
+        self.failed = set()
+        self.all_ok = True
+        self.finalised = False
+        self.cancelled = False
+        # Late returns not yet reported, as (minion, ok)
+        self.unreported = []
+        self.late_reported = 0.0
+
+    def deadline(self):
+        """The time to stop waiting for minions, or None to wait for salt."""
+        deadlines = []
+        if self.job_deadline is not None:
+            deadlines.append(self.start + self.job_deadline)
+        n = len(self.minions)
+        if self.minion_deadline is not None and len(self.returned) * 2 >= n:
+            median = sorted(self.returned.values())[(n - 1) // 2]
+            deadlines.append(self.start + median + self.minion_deadline)
+        return min(deadlines) if deadlines else None
+
+    def expired(self):
+        return time.time() - self.start > self.late_returns
+
+    def poll(self):
+        """
+        Store every return that has arrived so far. Returns False once
+        there is nothing more to wait for.
+        """
+        for ret in self.iter_returns:
             if not ret:
-                continue
+                return True
 
             for minion, result in ret.items():
-                dbminion = dbminions[minions.index(minion)]
-                if 'ret' not in result:
+                if 'ret' not in result or minion not in self.dbminions:
                     continue
-                logger.info("Processing Salt results for {}".format(minion))
-                minions_heard_from += 1
-
-                # Handle errors returned from the minion
-                if isinstance(result['ret'], list):
-                    self.handle_minion_error(dbminion, result['ret'])
-                    all_ok = False
-                    continue
-
-                # Handle actual state results returned from the minion
-                for key, val in result['ret'].items():
-                    self.store_state_result(dbminion, key, val)
-                    if 'result' in val and not val['result']:
-                        all_ok = False
-
-        m, n = minions_heard_from, len(minions)
+                self.store_return(minion, result['ret'])
+
+            if len(self.returned) == len(self.minions):
+                return False
+        return False
+
+    def store_return(self, minion, ret):
+        if minion in self.returned:
+            return
+        logger.info("Processing Salt results for {}".format(minion))
+        received = time.time()
+        self.returned[minion] = received - self.start
+        dbminion = self.dbminions[minion]
+        if not self.finalised:
+            tracing.stamp(self.trace, "first_return", received)
+        metrics.observe("saltbot_minion_return_seconds",
+                        received - self.start)
+
+        if isinstance(ret, list):
+            logger.warning("Got an error list for minion result:")
+            logger.warning(str(ret))
+        status = "late" if self.finalised else "returned"
+        ok, rows = ingest.store_return(
+            dbminion, ret, status, datetime.datetime.fromtimestamp(received))
+        self.all_ok = self.all_ok and ok
+        if not ok:
+            self.failed.add(minion)
+
+        written = time.time()
+        metrics.observe("saltbot_db_write_seconds", written - received)
+        metrics.inc("saltbot_db_rows_total", rows)
+        if self.finalised:
+            self.unreported.append((minion, ok))
+        else:
+            self.trace['db_seconds'] += written - received
+            self.trace['stamps']['last_return'] = received
+
+    def finalise(self, listening):
+        """
+        Report the job's summary. If *listening*, salt may still return
+        results for the missing minions and the job is left open.
+        """
+        self.finalised = True
+        missing = [m for m in self.minions if m not in self.returned]
+        self.failed.update(missing)
+        if missing:
+            ids = [self.dbminions[m].id for m in missing]
+            (SaltJobMinion.update(status="timeout")
+                          .where(SaltJobMinion.id << ids)
+                          .execute())
+
+        all_ok = self.all_ok
+        m, n = len(self.returned), len(self.minions)
         logger.info("Results for {}: {}/{} results, all_ok={}"
-                    .format(jid, m, n, all_ok))
-        self.sltrq.put(("salt_result", (jid, all_ok, m, n)))
+                    .format(self.jid, m, n, all_ok))
+        outcome = "ok" if all_ok and m == n else (
+            "errors" if not all_ok else "incomplete")
+        metrics.inc("saltbot_jobs_total", outcome=outcome)
+        metrics.observe("saltbot_job_duration_seconds",
+                        time.time() - self.start, outcome=outcome)
+        status = "partial" if missing and listening else "finished"
+        self.update(status=status, finished=datetime.datetime.now(),
+                    timings=json.dumps(self.trace))
+        self.shaker.sltrq.put(("salt_result", (self.jid, all_ok, m, n,
+                                               status, self.wave)))
+
+    def cancel(self, kill):
+        """
+        Stop waiting for this job, marking it and any minions which haven't
+        returned as cancelled. If *kill*, ask those minions to kill it.
+        """
+        self.cancelled = True
+        self.report_late(force=True)
+        missing = [m for m in self.minions if m not in self.returned]
+        self.failed.update(missing)
+        if missing:
+            ids = [self.dbminions[m].id for m in missing]
+            (SaltJobMinion.update(status="cancelled")
+                          .where(SaltJobMinion.id << ids)
+                          .execute())
+            if kill:
+                self.shaker.client.run_job(missing, 'saltutil.kill_job',
+                                           [self.jid], expr_form='list')
+        if self.finalised:
+            # The exchange owns the trace once the summary is sent
+            self.update(status="cancelled")
+        else:
+            metrics.inc("saltbot_jobs_total", outcome="cancelled")
+            self.finalised = True
+            self.update(status="cancelled", finished=datetime.datetime.now(),
+                        timings=json.dumps(self.trace))
+
+    def close(self):
+        """Stop listening for late returns."""
+        logger.info("Stopped waiting for late returns to {}, {}/{} in"
+                    .format(self.jid, len(self.returned), len(self.minions)))
+        self.report_late(force=True)
+        self.update(status="finished")
+
+    def report_late(self, force=False):
+        """
+        Report the late returns stored since the last report, unless that
+        was under LATE_REPORT_INTERVAL ago, so that a fleet's worth of
+        stragglers is one message a minute rather than one each.
+        """
+        now = time.time()
+        if not self.unreported:
+            return
+        if not force and now - self.late_reported < LATE_REPORT_INTERVAL:
+            return
+        ok = [m for m, good in self.unreported if good]
+        failed = [m for m, good in self.unreported if not good]
+        self.unreported = []
+        self.late_reported = now
+        self.shaker.sltrq.put(
+            ("salt_late_results", (self.jid, ok, failed, len(self.returned),
+                                   len(self.minions))))
+
+    def update(self, **fields):
+        """
+        Write just *fields* of this job's row, leaving the rest alone: the
+        exchange stamps the stored trace once the summary is sent.
+        """
+        for name, value in fields.items():
+            setattr(self.dbjob, name, value)
+        SaltJob.update(**fields).where(SaltJob.id == self.dbjob.id).execute()
 
 
 def run(config, sltcq, sltrq):
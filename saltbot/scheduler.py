@@ -0,0 +1,112 @@
+# Saltbot
+# Copyright 2015 Adam Greig
+# Licensed under the MIT license, see LICENCE file for details.
+
+"""
+Scheduling for highstates waiting to run in the saltshaker.
+
+Queued highstates are kept in the QueuedJob table, so that the web app can
+show them and they survive the saltshaker restarting.
+"""
+
+import json
+import logging
+import datetime
+
+from .database import QueuedJob
+
+logger = logging.getLogger("saltbot.scheduler")
+
+# Priority classes, highest first
+PRIORITIES = ("interactive", "push", "bulk")
+
+
+class Scheduler:
+    """
+    Orders queued highstates. The highest priority class waiting runs
+    first, but every *aging* seconds spent waiting promotes a job by one
+    class so that bulk work is never starved. Within a class, the repository
+    served least recently goes first so that one busy repository can't
+    monopolise the salt master, and after that jobs run in arrival order.
+    """
+    def __init__(self, aging):
+        self.aging = aging
+        self.entries = []
+        self.served = {}
+        self.turns = 0
+
+    def load(self):
+        """Pick up highstates left queued when the saltshaker last stopped."""
+        self.entries = list(QueuedJob.select().order_by(QueuedJob.id))
+        if self.entries:
+            logger.info("Loaded {} queued highstates".format(
+                len(self.entries)))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def push(self, target, expr_form, wait_gitfs, gh_push_id, trace=None,
+             options=None):
+        options = options or {}
+        priority = options.get('priority', "push")
+        if priority not in PRIORITIES:
+            logger.warning("Unknown priority {}, using bulk".format(priority))
+            priority = "bulk"
+        if isinstance(target, list):
+            target = ",".join(target)
+        entry = QueuedJob.create(
+            when=datetime.datetime.now(), target=target, expr_form=expr_form,
+            wait_gitfs=bool(wait_gitfs), github_push=gh_push_id,
+            priority=priority, repo=options.get('repo'),
+            trace=json.dumps(trace), options=json.dumps(options))
+        self.entries.append(entry)
+        self.update_positions()
+        return entry
+
+    def rank(self, entry, now):
+        waited = (now - entry.when).total_seconds()
+        rank = PRIORITIES.index(entry.priority)
+        if self.aging:
+            rank -= int(waited // self.aging)
+        return (max(rank, 0), self.served.get(entry.repo, 0), entry.id)
+
+    def order(self, now=None):
+        """The queued entries in the order they would run now."""
+        now = now or datetime.datetime.now()
+        return sorted(self.entries, key=lambda e: self.rank(e, now))
+
+    def pop(self):
+        """
+        Remove the next highstate from the queue, returning the arguments
+        to run it with, or None if nothing is queued.
+        """
+        if not self.entries:
+            return None
+        entry = self.order()[0]
+        self.entries.remove(entry)
+        self.turns += 1
+        self.served[entry.repo] = self.turns
+        entry.delete_instance()
+        self.update_positions()
+        return (entry.target, entry.expr_form, entry.wait_gitfs,
+                entry._data.get('github_push'), json.loads(entry.trace),
+                json.loads(entry.options))
+
+    def remove(self, ident):
+        """Remove the entry with id *ident* if queued, returning it."""
+        for entry in self.entries:
+            if str(entry.id) == str(ident):
+                self.entries.remove(entry)
+                entry.delete_instance()
+                self.update_positions()
+                return entry
+        return None
+
+    def update_positions(self):
+        """Store each entry's place in the queue where it has changed."""
+        for position, entry in enumerate(self.order()):
+            if entry.position != position:
+                entry.position = position
+                (QueuedJob.update(position=position)
+                          .where(QueuedJob.id == entry.id)
+                          .execute())
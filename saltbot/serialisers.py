@@ -3,8 +3,11 @@
 # Released under the MIT license. See LICENSE file for details.
 import sys
 import json
+import datetime
 
+from . import tracing
 from .database import GitHubPush, SaltJob, SaltJobMinion, SaltMinionResult
+from .database import QueuedJob, FleetMinion, FleetFailure
 
 PY2 = sys.version_info[0] == 2
 if not PY2:
@@ -22,6 +25,12 @@ def serialise(obj):
         return serialise_saltjobminion(obj)
     elif isinstance(obj, SaltMinionResult):
         return serialise_saltminionresult(obj)
+    elif isinstance(obj, QueuedJob):
+        return serialise_queuedjob(obj)
+    elif isinstance(obj, FleetMinion):
+        return serialise_fleetminion(obj)
+    elif isinstance(obj, FleetFailure):
+        return serialise_fleetfailure(obj)
     else:
         raise TypeError("Can't serialise type {}".format(type(obj)))
 
@@ -71,8 +80,15 @@ def serialise_githubpush(obj):
 
 
 def serialise_saltjob(obj):
-    r = serialise_fields(obj, skip=['github_push', 'id'])
-    r['push'] = serialise_githubpush(obj.github_push)
+    r = serialise_fields(obj, skip=['github_push', 'id', 'timings'])
+    if obj.github_push is not None:
+        r['push'] = serialise_githubpush(obj.github_push)
+    else:
+        r['push'] = None
+    if getattr(obj, 'timings', None):
+        trace = json.loads(obj.timings)
+        r['timings'] = trace['stamps']
+        r['stages'] = tracing.durations(trace)
     serialise_if_exists(obj, r, 'all_in', bool, False)
     serialise_if_exists(obj, r, 'no_errors', bool, True)
     return r
@@ -102,5 +118,28 @@ def serialise_saltminionresult(obj):
         r['output'] = json.loads(obj.output)
     except ValueError:
         r['output'] = str(obj.output)
+    serialise_if_exists(obj, r, 'duration', float, None)
+
+    return r
+
+
+def serialise_queuedjob(obj):
+    r = serialise_fields(obj, skip=['github_push', 'trace', 'options'])
+    r['push_id'] = obj._data.get('github_push')
+    r['waited'] = (datetime.datetime.now() - obj.when).total_seconds()
+    return r
+
+
+def serialise_fleetminion(obj):
+    r = serialise_fields(obj, skip=['id', 'job'])
+    r['jid'] = obj.job.jid
+    for k in 'job_minion', 'num_results', 'num_failed', 'num_changed':
+        r[k] = int(getattr(obj, k))
+    serialise_if_exists(obj, r, 'failures', list, [])
+    return r
+
 
+def serialise_fleetfailure(obj):
+    r = serialise_fields(obj, skip=['id', 'minion'])
+    serialise_if_exists(obj, r, 'run_num', int, None)
     return r
@@ -0,0 +1,59 @@
+# Saltbot
+# Copyright 2015 Adam Greig
+# Licensed under the MIT license, see LICENCE file for details.
+
+"""
+Job lifecycle traces.
+
+A trace is a plain dict created when a request is ingested and carried on
+every queue message about that request. Each process stamps the time it
+reaches a stage, and the saltshaker stores the trace on the SaltJob.
+"""
+
+import time
+import uuid
+
+# (name, from stamp, to stamp) for each reported stage
+STAGES = (
+    ("exchange_wait", "ingested", "exchange_received"),
+    ("salt_queue_wait", "salt_queued", "salt_dequeued"),
+    ("gitfs_wait", "salt_dequeued", "gitfs_ready"),
+    ("salt_start", "gitfs_ready", "salt_started"),
+    ("first_return", "salt_started", "first_return"),
+    ("last_return", "salt_started", "last_return"),
+    ("result_wait", "last_return", "result_received"),
+    ("irc_delivery", "result_received", "irc_delivered"),
+    ("total", "ingested", "irc_delivered"),
+)
+
+
+def new(stage="ingested"):
+    """Start a new trace, stamped with *stage*."""
+    trace = {"id": uuid.uuid4().hex, "stamps": {}, "db_seconds": 0.0}
+    return stamp(trace, stage)
+
+
+def fork(trace):
+    """Copy *trace* under a new id, e.g. for each push in a batch."""
+    if trace is None:
+        return None
+    return {"id": uuid.uuid4().hex, "stamps": dict(trace['stamps']),
+            "db_seconds": trace['db_seconds']}
+
+
+def stamp(trace, stage, when=None):
+    """Record that *trace* reached *stage* now (or at *when*)."""
+    if trace is not None and stage not in trace['stamps']:
+        trace['stamps'][stage] = time.time() if when is None else when
+    return trace
+
+
+def durations(trace):
+    """Work out how long each stage took, in seconds, where known."""
+    stamps = trace.get('stamps', {})
+    stages = {}
+    for name, start, end in STAGES:
+        if start in stamps and end in stamps:
+            stages[name] = round(stamps[end] - stamps[start], 6)
+    stages['db_write'] = round(trace.get('db_seconds', 0.0), 6)
+    return stages
@@ -3,10 +3,12 @@
 # Licensed under the MIT license, see LICENCE file for details.
 
 import hmac
+import time
+import datetime
 import hashlib
 import logging
 
-from flask import Flask, request, g, jsonify, abort
+from flask import Flask, request, g, jsonify, abort, send_from_directory
 from werkzeug.contrib.fixers import ProxyFix
 from tornado.wsgi import WSGIContainer
 from tornado.httpserver import HTTPServer
@@ -28,12 +30,18 @@ except NameError:
 else:
     from . import database
     from . import serialisers
+    from . import archive
     reload(database)
     reload(serialisers)
+    reload(archive)
 
+from . import archive
+from . import metrics
+from . import tracing
 from .database import Database
 from .database import GitHubPush, SaltJob, SaltJobMinion, SaltMinionResult
-from .serialisers import serialise
+from .database import QueuedJob, FleetMinion, FleetFailure
+from .serialisers import serialise, serialise_fields
 
 app = Flask(__name__)
 app.wsgi_app = ProxyFix(app.wsgi_app)
@@ -69,6 +77,49 @@ def bool_sum(field):
         return fn.Sum(SQL("{}::int".format(field)))
 
 
+def seconds_between(start, end):
+    """SQL for the seconds between two timestamp columns, portably"""
+    if app.config['database']['engine'] == "sqlite":
+        return "((julianday({}) - julianday({})) * 86400)".format(end, start)
+    elif app.config['database']['engine'] == "postgresql":
+        return "EXTRACT(EPOCH FROM {} - {})".format(end, start)
+
+
+def time_bucket(column, bucket):
+    """SQL for the date starting the day or (ISO) week of *column*"""
+    if app.config['database']['engine'] == "sqlite":
+        if bucket == "week":
+            return "date({}, 'weekday 0', '-6 days')".format(column)
+        return "date({})".format(column)
+    elif app.config['database']['engine'] == "postgresql":
+        return "CAST(date_trunc('{}', {}) AS DATE)".format(bucket, column)
+
+
+def percentile_sql(keys, value, source):
+    """
+    SQL for the count, mean, max and nearest-rank p50, p95 and p99 of
+    *value* for each group of *keys* in the rows selected by *source*.
+
+    The percentiles are found by numbering the values in each group in
+    order with window functions, which needs PostgreSQL or SQLite 3.25+.
+    """
+    keys = ", ".join(keys)
+    return """
+        SELECT {keys}, COUNT(*), AVG({value}), MAX({value}),
+               MIN(CASE WHEN rn >= 0.50 * total THEN {value} END) AS p50,
+               MIN(CASE WHEN rn >= 0.95 * total THEN {value} END) AS p95,
+               MIN(CASE WHEN rn >= 0.99 * total THEN {value} END) AS p99
+        FROM (
+            SELECT src.*,
+                   ROW_NUMBER() OVER (PARTITION BY {keys}
+                                      ORDER BY {value}) AS rn,
+                   COUNT(*) OVER (PARTITION BY {keys}) AS total
+            FROM ({source}) src
+        ) ranked
+        GROUP BY {keys}
+    """.format(keys=keys, value=value, source=source)
+
+
 def compare_digest(a, b):
     if hasattr(hmac, 'compare_digest'):
         return hmac.compare_digest(a, b)
@@ -78,8 +129,68 @@ def compare_digest(a, b):
 
 @app.before_request
 def before_request():
+    g._start = time.time()
+    # Webhooks and cancels are acked without touching the database, and
+    # archive downloads come straight off disk
+    if request.endpoint in ('webhook', 'cancel_job', 'cancel_queued',
+                            'archive_segments', 'archive_segment'):
+        return
     g._db = Database(app.config)
     g._db.connect()
+    if app.config['web']['profile']['enabled']:
+        g._queries = []
+        g._db.db.query_hook = lambda *q: g._queries.append(q)
+
+
+@app.after_request
+def after_request(response):
+    rule = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.observe("saltbot_http_request_seconds", time.time() - g._start,
+                    route=rule, method=request.method,
+                    status=response.status_code)
+    if hasattr(g, '_queries'):
+        profile_request(response)
+    return response
+
+
+def profile_request(response):
+    """
+    Report the SQL statements run for this request. Requests whose total DB
+    time, or any single statement, exceeds web.profile.threshold_ms are
+    logged with their slowest statements, plus query plans for the slow
+    statements if web.profile.explain is set.
+    """
+    cfg = app.config['web']['profile']
+    g._db.db.query_hook = None
+    queries = g._queries
+    db_ms = sum(q[2] for q in queries) * 1000
+    total_ms = (time.time() - g._start) * 1000
+    threshold = cfg['threshold_ms']
+    flagged = [q for q in queries if q[2] * 1000 >= threshold]
+
+    if flagged or db_ms >= threshold:
+        logger.warning("Slow request {} {}: {} statements, {:.1f}ms in DB, "
+                       "{:.1f}ms total".format(request.method, request.path,
+                                               len(queries), db_ms, total_ms))
+        slowest = sorted(queries, key=lambda q: -q[2])[:cfg['slowest']]
+        for sql, params, elapsed in slowest:
+            logger.warning("  {:.1f}ms: {} {}".format(
+                elapsed * 1000, sql, list(params or ())))
+        if cfg['explain']:
+            for sql, params, elapsed in flagged:
+                if sql.lstrip().upper().startswith("SELECT"):
+                    plan = g._db.explain(sql, params)
+                    logger.warning("  Plan for {:.1f}ms statement:\n    {}"
+                                   .format(elapsed * 1000,
+                                           "\n    ".join(plan)))
+    else:
+        logger.debug("Request {} {}: {} statements, {:.1f}ms in DB".format(
+            request.method, request.path, len(queries), db_ms))
+
+    if cfg['server_timing']:
+        response.headers['Server-Timing'] = (
+            'db;dur={:.1f};desc="{} statements", app;dur={:.1f}'
+            .format(db_ms, len(queries), total_ms))
 
 
 @app.teardown_appcontext
@@ -123,9 +234,12 @@ def jobs():
     subquery must either appear inside an aggregate or the GROUP_BY,
     which means instead of just grouping by `id' and selecting * on the outer
     query, we must explicitly list the fields for the model. Sigh.
+    Archived jobs have no minions left to aggregate, so theirs are filled in
+    from the archive.
     """
     job_fields = SQL(
-        '"id", "when", "jid", "expr_form", "target", "github_push_id"')
+        '"id", "when", "jid", "expr_form", "target", "github_push_id", '
+        '"trace_id", "status", "wave", "waves", "finished", "archived"')
 
     no_errors_int = bool_and(SaltMinionResult.result).alias('no_errors_int')
     no_errors = bool_and(SQL('no_errors_int')).alias('no_errors')
@@ -147,11 +261,61 @@ def jobs():
 
     page, pages, pp = get_page(jobsq)
 
-    jobs = [serialise(j) for j in jobsq.paginate(page, pp).iterator()]
+    jobs = []
+    for j in jobsq.paginate(page, pp).iterator():
+        if not j.archived:
+            jobs.append(serialise(j))
+            continue
+        # One unreadable segment shouldn't take the whole listing with it,
+        # so its jobs are listed without a summary instead.
+        record = load_archived(j, archive.JOB, j.id, j.jid)
+        if record is not None:
+            summarise_job(j, record)
+        r = serialise(j)
+        if record is None:
+            r['no_errors'] = r['all_in'] = None
+        jobs.append(r)
 
     return jsonify(page=page, pages=pages, jobs=jobs)
 
 
+def load_archived(job, kind, ident, jid):
+    """
+    Read a record of *job* from its archive segment, or None if the archive
+    isn't available or the record isn't for *jid*.
+    """
+    archive_dir = app.config.get('archive', {}).get('dir')
+    if not archive_dir:
+        logger.error("Job {} is archived but archive.dir is not set"
+                     .format(job.jid))
+        return None
+    record = archive.read_record(archive_dir, job.archived, kind, ident)
+    if record is None or record['jid'] != jid:
+        logger.error("Record {}/{} of job {} is missing from segment {}"
+                     .format(kind, ident, job.jid, job.archived))
+        return None
+    return record
+
+
+def archived_record(job, kind, ident, jid):
+    """As load_archived, but 404 if the record can't be read."""
+    record = load_archived(job, kind, ident, jid)
+    if record is None:
+        abort(404)
+    return record
+
+
+def summarise_job(job, record):
+    """Set the job-wide no_errors and all_in from its minions."""
+    job.no_errors = all(m['no_errors'] for m in record['minions'])
+    job.all_in = all(m['num_results'] > 0 for m in record['minions'])
+
+
+def archived_jobs():
+    """How many jobs have been archived, so have no results to query."""
+    return SaltJob.select().where(~(SaltJob.archived >> None)).count()
+
+
 @app.route("/api/jobs/<jid>")
 def job(jid):
     """
@@ -162,6 +326,11 @@ def job(jid):
     except SaltJob.DoesNotExist:
         abort(404)
 
+    if job.archived:
+        record = archived_record(job, archive.JOB, job.id, jid)
+        summarise_job(job, record)
+        return jsonify(minions=record['minions'], **serialise(job))
+
     no_errors = bool_and(SaltMinionResult.result).alias('no_errors')
     num_results = fn.Count(SaltMinionResult.id).alias('num_results')
     num_changed = bool_sum('changed').alias('num_changed')
@@ -189,6 +358,9 @@ def minionresults(jid, minion):
     """
     try:
         job = SaltJob.get(jid=jid)
+        if job.archived:
+            record = archived_record(job, archive.MINION, minion, jid)
+            return jsonify(results=record['results'], **record['minion'])
         minion = SaltJobMinion.get(id=minion, job=job)
     except (SaltJob.DoesNotExist, SaltJobMinion.DoesNotExist):
         abort(404)
@@ -205,11 +377,621 @@ def minionresults(jid, minion):
     return jsonify(results=results, **serialise(minion))
 
 
+def get_int(name, default):
+    """A positive integer query parameter"""
+    try:
+        return max(1, int(request.args.get(name, default)))
+    except ValueError:
+        abort(400)
+
+
+def get_limit(default=20, maximum=1000):
+    """The ?limit= query parameter, clamped to 1..maximum"""
+    return min(get_int('limit', default), maximum)
+
+
+@app.route("/api/jobs/<jid>/slowest")
+def job_slowest(jid):
+    """
+    The slowest individual states in one job, optionally only those from
+    the minion named by ?minion=. 409 if the job has been archived.
+    """
+    try:
+        job = SaltJob.get(jid=jid)
+    except SaltJob.DoesNotExist:
+        abort(404)
+    if job.archived:
+        abort(409)
+
+    resultsq = (SaltMinionResult
+                .select(SaltMinionResult, SaltJobMinion.minion)
+                .join(SaltJobMinion)
+                .where(SaltJobMinion.job == job,
+                       SaltMinionResult.duration.is_null(False))
+                .order_by(SaltMinionResult.duration.desc())
+                .limit(get_limit()))
+    if request.args.get('minion'):
+        resultsq = resultsq.where(
+            SaltJobMinion.minion == request.args['minion'])
+
+    states = []
+    for result in resultsq:
+        r = serialise(result)
+        r['minion'] = result.minion.minion
+        r['minion_id'] = result.minion.id
+        states.append(r)
+    return jsonify(jid=job.jid, states=states)
+
+
+@app.route("/api/states/slowest")
+def states_slowest():
+    """
+    Duration statistics for each state (by key_state and key_id) across
+    the last ?jobs= jobs, optionally only on the minion named by ?minion=,
+    slowest p95 first. Archived jobs are left out, and counted in
+    `archived`.
+    """
+    njobs = get_int('jobs', 20)
+    db = g._db.db
+    q = db.compiler().quote
+    param = db.interpolation
+    where = ["r.{} IS NOT NULL".format(q("duration"))]
+    params = [njobs]
+    if request.args.get('minion'):
+        where.append("m.{} = {}".format(q("minion"), param))
+        params.append(request.args['minion'])
+    params.append(get_limit())
+
+    source = """
+        SELECT r.{key_state}, r.{key_id}, r.{duration}
+        FROM {results} r JOIN {minions} m ON r.{minion_id} = m.{id}
+        WHERE m.{job_id} IN (SELECT {id} FROM {jobs}
+                             WHERE {archived} IS NULL
+                             ORDER BY {id} DESC LIMIT {param})
+          AND {where}
+    """.format(
+        key_state=q("key_state"), key_id=q("key_id"),
+        duration=q("duration"), id=q("id"), archived=q("archived"),
+        minion_id=q("minion_id"), job_id=q("job_id"),
+        results=q(SaltMinionResult._meta.db_table),
+        minions=q(SaltJobMinion._meta.db_table),
+        jobs=q(SaltJob._meta.db_table),
+        where=" AND ".join(where), param=param)
+    sql = percentile_sql([q("key_state"), q("key_id")], q("duration"), source)
+    sql += " ORDER BY p95 DESC LIMIT {}".format(param)
+
+    fields = ("key_state", "key_id", "count", "mean", "max", "p50", "p95",
+              "p99")
+    states = [dict(zip(fields, row)) for row in db.execute_sql(sql, params)]
+    return jsonify(jobs=njobs, minion=request.args.get('minion'),
+                   archived=archived_jobs(), states=states)
+
+
+@app.route("/api/jobs/durations")
+def job_durations():
+    """
+    How long jobs took, from starting to their summary, for each target
+    and each ?bucket= (day or week) over the last ?days= days. Only jobs
+    for ?target= if given.
+    """
+    days = get_int('days', 30)
+    bucket = request.args.get('bucket', "day")
+    if bucket not in ("day", "week"):
+        abort(400)
+    db = g._db.db
+    q = db.compiler().quote
+    param = db.interpolation
+    since = datetime.datetime.now() - datetime.timedelta(days=days)
+    where = ["{} IS NOT NULL".format(q("finished")),
+             "{} >= {}".format(q("when"), param)]
+    params = [since]
+    if request.args.get('target'):
+        where.append("{} = {}".format(q("target"), param))
+        params.append(request.args['target'])
+
+    source = """
+        SELECT {target}, {period} AS period, {seconds} AS seconds
+        FROM {jobs} WHERE {where}
+    """.format(target=q("target"), period=time_bucket(q("when"), bucket),
+               seconds=seconds_between(q("when"), q("finished")),
+               jobs=q(SaltJob._meta.db_table), where=" AND ".join(where))
+    sql = percentile_sql([q("target"), "period"], "seconds", source)
+    sql += " ORDER BY period, {}".format(q("target"))
+
+    fields = ("target", "period", "count", "mean", "max", "p50", "p95",
+              "p99")
+    windows = []
+    for row in db.execute_sql(sql, params):
+        window = dict(zip(fields, row))
+        window['period'] = str(window['period'])
+        windows.append(window)
+    return jsonify(days=days, bucket=bucket, durations=windows)
+
+
+@app.route("/api/jobs/<jid>/diff")
+def job_diff(jid):
+    """
+    The states whose result, changed flag or comment differ between job
+    *jid* and the job ?against= (by default the previous job with the same
+    target), matched by minion and state key, optionally only for the
+    minion named by ?minion=. States only in one of the jobs are included
+    as added or removed. Archived jobs have no results left to compare, so
+    the previous job is the previous one still in the database, and
+    naming an archived job gives a 409.
+
+    Both jobs' results are merged and compared in one query, so only the
+    differences come back from the database.
+    """
+    try:
+        job = SaltJob.get(jid=jid)
+        if request.args.get('against'):
+            old = SaltJob.get(jid=request.args['against'])
+        else:
+            old = (SaltJob.select()
+                          .where(SaltJob.target == job.target,
+                                 SaltJob.expr_form == job.expr_form,
+                                 SaltJob.id < job.id,
+                                 SaltJob.archived >> None)
+                          .order_by(SaltJob.id.desc())
+                          .get())
+    except SaltJob.DoesNotExist:
+        abort(404)
+    if job.archived or old.archived:
+        abort(409)
+
+    db = g._db.db
+    q = db.compiler().quote
+    param = db.interpolation
+    keys = ", ".join(q(k) for k in ("minion", "key_state", "key_id",
+                                    "key_name", "key_func"))
+    side = """
+        SELECT {side} AS side, m.{minion}, r.{key_state}, r.{key_id},
+               r.{key_name}, r.{key_func},
+               CAST(r.{result} AS INTEGER) AS result,
+               CAST(r.{changed} AS INTEGER) AS changed, r.{comment}
+        FROM {results} r JOIN {minions} m ON r.{minion_id} = m.{id}
+        WHERE m.{job_id} = {param} {where}
+    """
+    where = ""
+    params = [old.id, job.id]
+    if request.args.get('minion'):
+        where = "AND m.{} = {}".format(q("minion"), param)
+        params = [old.id, request.args['minion'],
+                  job.id, request.args['minion']]
+    sides = [side.format(
+        side=n, minion=q("minion"), key_state=q("key_state"),
+        key_id=q("key_id"), key_name=q("key_name"), key_func=q("key_func"),
+        result=q("result"), changed=q("changed"), comment=q("comment"),
+        results=q(SaltMinionResult._meta.db_table),
+        minions=q(SaltJobMinion._meta.db_table),
+        minion_id=q("minion_id"), id=q("id"), job_id=q("job_id"),
+        param=param, where=where) for n in (0, 1)]
+
+    def either(n, column, null):
+        return "MAX(CASE WHEN side = {} THEN COALESCE({}, {}) END)".format(
+            n, column, null)
+    columns = [either(n, c, null) for c, null in (
+        ("result", "-1"), ("changed", "-1"), (q("comment"), "''"))
+        for n in (0, 1)]
+
+    sql = """
+        SELECT {keys}, MIN(side), MAX(side), {columns}
+        FROM ({old} UNION ALL {new}) both_jobs
+        GROUP BY {keys}
+        HAVING MIN(side) = MAX(side) OR {differs}
+        ORDER BY {keys}
+    """.format(keys=keys, columns=", ".join(columns), old=sides[0],
+               new=sides[1], differs=" OR ".join(
+                   "{} <> {}".format(columns[i], columns[i + 1])
+                   for i in range(0, len(columns), 2)))
+
+    def side_fields(result, changed, comment):
+        return {"result": None if result == -1 else bool(result),
+                "changed": None if changed == -1 else bool(changed),
+                "comment": comment}
+
+    states = []
+    for row in db.execute_sql(sql, params):
+        state = dict(zip(("minion", "key_state", "key_id", "key_name",
+                          "key_func"), row[:5]))
+        first, last = row[5], row[6]
+        if first == last:
+            state['change'] = "added" if first == 1 else "removed"
+        else:
+            state['change'] = "changed"
+        old_fields = side_fields(row[7], row[9], row[11])
+        new_fields = side_fields(row[8], row[10], row[12])
+        state['old'] = old_fields if first == 0 else None
+        state['new'] = new_fields if last == 1 else None
+        states.append(state)
+
+    return jsonify(jid=job.jid, against=old.jid, states=states)
+
+
+@app.route("/api/minions/stragglers")
+def stragglers():
+    """
+    How often each minion is among the last tenth of minions to return (or
+    doesn't return at all) across the last ?jobs= finished jobs targeting
+    at least ?min_minions= minions. Cancelled jobs are left out, as their
+    minions were never given the chance to return. Minions in at least
+    ?min_jobs= of those jobs are listed, most often slow first, and
+    flagged when that's at least ?threshold= of the time. Archived jobs
+    are left out too, and counted in `archived`.
+    """
+    njobs = get_int('jobs', 50)
+    min_jobs = get_int('min_jobs', 5)
+    # In smaller jobs the last tenth is just the last minion, which is
+    # always "slow" however quickly it returned
+    min_minions = get_int('min_minions', 10)
+    try:
+        threshold = float(request.args.get('threshold', 0.5))
+    except ValueError:
+        abort(400)
+    db = g._db.db
+    q = db.compiler().quote
+    param = db.interpolation
+
+    sql = """
+        SELECT {minion}, COUNT(*),
+               SUM(CASE WHEN rn > 0.9 * total THEN 1 ELSE 0 END) AS slow,
+               SUM(missing), AVG(took)
+        FROM (
+            SELECT m.{minion},
+                   ROW_NUMBER() OVER (
+                       PARTITION BY m.{job_id}
+                       ORDER BY CASE WHEN m.{returned} IS NULL
+                                THEN 1 ELSE 0 END, m.{returned}) AS rn,
+                   COUNT(*) OVER (PARTITION BY m.{job_id}) AS total,
+                   CASE WHEN m.{returned} IS NULL
+                        THEN 1 ELSE 0 END AS missing,
+                   {took} AS took
+            FROM {minions} m JOIN {jobs} j ON m.{job_id} = j.{id}
+            WHERE j.{id} IN (SELECT c.{id} FROM {jobs} c
+                             WHERE c.{finished} IS NOT NULL
+                             AND c.{archived} IS NULL
+                             AND (c.{status} IS NULL OR
+                                  c.{status} <> 'cancelled')
+                             AND (SELECT COUNT(*) FROM {minions} cm
+                                  WHERE cm.{job_id} = c.{id}) >= {param}
+                             ORDER BY c.{id} DESC LIMIT {param})
+        ) ranked
+        GROUP BY {minion}
+        HAVING COUNT(*) >= {param}
+        ORDER BY 1.0 * SUM(CASE WHEN rn > 0.9 * total THEN 1 ELSE 0 END)
+                 / COUNT(*) DESC, {minion}
+        LIMIT {param}
+    """.format(minion=q("minion"), job_id=q("job_id"), id=q("id"),
+               returned=q("returned"), finished=q("finished"),
+               status=q("status"), archived=q("archived"),
+               took=seconds_between("j." + q("when"), "m." + q("returned")),
+               minions=q(SaltJobMinion._meta.db_table),
+               jobs=q(SaltJob._meta.db_table), param=param)
+
+    minions = []
+    for name, jobs, slow, missing, took in db.execute_sql(
+            sql, [min_minions, njobs, min_jobs, get_limit()]):
+        fraction = float(slow) / jobs
+        minions.append({"minion": name, "jobs": jobs, "slow": int(slow),
+                        "missing": int(missing), "mean_seconds": took,
+                        "slow_fraction": fraction,
+                        "flagged": fraction >= threshold})
+    return jsonify(jobs=njobs, threshold=threshold,
+                   archived=archived_jobs(), minions=minions)
+
+
+@app.route("/api/fleet")
+def fleet():
+    """
+    The current state of every minion, from its latest return: its status
+    ("ok", "failing" or "error"), that job, and for minions that aren't ok
+    the states which failed. Filter with ?status=, which may list several
+    statuses separated by commas.
+    """
+    counts = dict(FleetMinion.select(FleetMinion.status, fn.Count(SQL("*")))
+                             .group_by(FleetMinion.status)
+                             .tuples())
+
+    fleetq = (FleetMinion.select(FleetMinion, SaltJob.jid)
+                         .join(SaltJob)
+                         .order_by(FleetMinion.minion))
+    failuresq = (FleetFailure.select()
+                             .order_by(FleetFailure.minion,
+                                       FleetFailure.run_num))
+    status = request.args.get('status')
+    if status:
+        statuses = status.split(",")
+        fleetq = fleetq.where(FleetMinion.status << statuses)
+        failuresq = failuresq.join(
+            FleetMinion, on=(FleetFailure.minion == FleetMinion.minion)
+        ).where(FleetMinion.status << statuses)
+
+    failures = {}
+    for failure in failuresq.iterator():
+        failures.setdefault(failure.minion, []).append(serialise(failure))
+    minions = []
+    for minion in fleetq.iterator():
+        minion.failures = failures.get(minion.minion, [])
+        minions.append(serialise(minion))
+
+    return jsonify(counts=counts, minions=minions)
+
+
+def get_before():
+    """The ?before= keyset pagination cursor, a job id, or None"""
+    if 'before' not in request.args:
+        return None
+    return get_int('before', 1)
+
+
+def get_result_cursor():
+    """
+    The ?before= keyset pagination cursor for results, a (job id, result
+    id) pair given as "job:result", or None
+    """
+    if 'before' not in request.args:
+        return None
+    try:
+        job, result = request.args['before'].split(":")
+        return int(job), int(result)
+    except ValueError:
+        abort(400)
+
+
+@app.route("/api/minions/<name>")
+def minion_history(name):
+    """
+    The jobs minion *name* has been part of, newest first, with counts of
+    its results in each. Paginated by job: pass the returned `next` as
+    ?before= to get the page after. Archived jobs no longer record which
+    minions they ran on, so are left out; `archived` counts them.
+    """
+    limit = get_limit()
+    before = get_before()
+    minionsq = (SaltJobMinion
+                .select(SaltJobMinion, SaltJob)
+                .join(SaltJob)
+                .where(SaltJobMinion.minion == name)
+                .order_by(SaltJobMinion.job.desc())
+                .limit(limit + 1))
+    if before is not None:
+        minionsq = minionsq.where(SaltJobMinion.job < before)
+    minions = list(minionsq)
+    if not minions and before is None:
+        abort(404)
+    more = len(minions) > limit
+    minions = minions[:limit]
+
+    # Count results for just this page rather than aggregating in the
+    # query above, which would aggregate every job the minion was in.
+    counts = {}
+    if minions:
+        countsq = (SaltMinionResult
+                   .select(SaltMinionResult.minion,
+                           fn.Count(SaltMinionResult.id),
+                           bool_sum('result'), bool_sum('changed'))
+                   .where(SaltMinionResult.minion << [m.id for m in minions])
+                   .group_by(SaltMinionResult.minion)
+                   .tuples())
+        counts = dict((row[0], row[1:]) for row in countsq)
+
+    jobs = []
+    for minion in minions:
+        r = serialise(minion)
+        r['job'] = serialise_fields(minion.job, skip=['github_push',
+                                                      'timings'])
+        results, good, changed = counts.get(minion.id, (0, 0, 0))
+        r['num_results'] = int(results)
+        r['num_good'] = int(good or 0)
+        r['num_changed'] = int(changed or 0)
+        r['num_errors'] = r['num_results'] - r['num_good']
+        jobs.append(r)
+
+    return jsonify(minion=name, jobs=jobs, archived=archived_jobs(),
+                   next=minions[-1].job.id if more else None)
+
+
+@app.route("/api/minions/<name>/states/<path:key>")
+def minion_state_history(name, key):
+    """
+    The results of one state on minion *name*, newest first. *key* is
+    either the full state key as salt reports it
+    (state_|-id_|-name_|-function) or just the state's id, which may
+    match several states in each job. Paginated like minion_history, but
+    by job and result, as a page can end part way through a job.
+    """
+    limit = get_limit()
+    before = get_result_cursor()
+    resultsq = (SaltMinionResult
+                .select(SaltMinionResult, SaltJobMinion, SaltJob)
+                .join(SaltJobMinion)
+                .join(SaltJob)
+                .where(SaltJobMinion.minion == name)
+                .order_by(SaltJobMinion.job.desc(),
+                          SaltMinionResult.id.desc())
+                .limit(limit + 1))
+    parts = key.split("_|-")
+    if len(parts) == 4:
+        resultsq = resultsq.where(SaltMinionResult.key_state == parts[0],
+                                  SaltMinionResult.key_id == parts[1],
+                                  SaltMinionResult.key_name == parts[2],
+                                  SaltMinionResult.key_func == parts[3])
+    else:
+        resultsq = resultsq.where(SaltMinionResult.key_id == key)
+    if before is not None:
+        # (job, id) < before, written out as peewee has no row values
+        job, result = before
+        resultsq = resultsq.where(
+            (SaltJobMinion.job < job) |
+            ((SaltJobMinion.job == job) & (SaltMinionResult.id < result)))
+    results = list(resultsq)
+    more = len(results) > limit
+    results = results[:limit]
+
+    history = []
+    for result in results:
+        r = serialise(result)
+        r['minion_id'] = result.minion.id
+        r['jid'] = result.minion.job.jid
+        r['when'] = str(result.minion.job.when)
+        history.append(r)
+
+    cursor = None
+    if more:
+        cursor = "{}:{}".format(results[-1].minion.job.id, results[-1].id)
+    return jsonify(minion=name, key=key, results=history, next=cursor)
+
+
+def search_sql(terms):
+    """
+    SQL selecting the id and rank of up to one page of results matching
+    all of *terms*, best first, plus the parameters for it.
+    """
+    param = g._db.db.interpolation
+    if app.config['database']['engine'] == "sqlite":
+        # Quote each term so FTS5 doesn't treat punctuation as syntax
+        query = " ".join('"{}"'.format(t.replace('"', '""')) for t in terms)
+        sql = """
+            SELECT rowid, rank FROM saltminionresult_fts
+            WHERE saltminionresult_fts MATCH {0}
+            ORDER BY rank LIMIT {0} OFFSET {0}
+        """.format(param)
+    elif app.config['database']['engine'] == "postgresql":
+        query = " ".join(terms)
+        sql = """
+            SELECT id, -ts_rank(search, query) AS rank
+            FROM saltminionresult, plainto_tsquery('simple', {0}) query
+            WHERE search @@ query
+            ORDER BY rank LIMIT {0} OFFSET {0}
+        """.format(param)
+    return sql, [query]
+
+
+@app.route("/api/search")
+def search():
+    """
+    Full-text search of state results for those containing every word in
+    ?q=, best matches first, with the job and minion each came from.
+    Paginated with ?page=, reporting whether there are more rather than
+    a total, which would mean counting every match. Returns 501 if the
+    database couldn't set up the search index.
+    """
+    if not g._db.search_available():
+        abort(501)
+    terms = request.args.get('q', "").split()
+    if not terms:
+        abort(400)
+    page = get_int('page', 1)
+    per_page = app.config['web']['per_page']
+    sql, params = search_sql(terms)
+    params += [per_page + 1, (page - 1) * per_page]
+    ranked = list(g._db.db.execute_sql(sql, params))
+    more = len(ranked) > per_page
+    ranked = ranked[:per_page]
+
+    results = {}
+    if ranked:
+        resultsq = (SaltMinionResult
+                    .select(SaltMinionResult, SaltJobMinion, SaltJob)
+                    .join(SaltJobMinion)
+                    .join(SaltJob)
+                    .where(SaltMinionResult.id << [r[0] for r in ranked]))
+        results = dict((r.id, r) for r in resultsq)
+
+    matches = []
+    for result_id, rank in ranked:
+        if result_id not in results:
+            continue
+        result = results[result_id]
+        r = serialise(result)
+        r['id'] = result.id
+        r['rank'] = -rank
+        r['minion'] = result.minion.minion
+        r['minion_id'] = result.minion.id
+        r['jid'] = result.minion.job.jid
+        r['when'] = str(result.minion.job.when)
+        r['target'] = result.minion.job.target
+        matches.append(r)
+
+    return jsonify(q=" ".join(terms), page=page, more=more, results=matches)
+
+
+@app.route("/api/archive/")
+def archive_segments():
+    """
+    List the archive's segments. Each is a gzipped file of one JSON object
+    per line: a "job" record after each job's "minion" records.
+    """
+    archive_dir = app.config.get('archive', {}).get('dir')
+    if not archive_dir:
+        abort(404)
+    return jsonify(segments=archive.list_segments(archive_dir))
+
+
+@app.route("/api/archive/<segment>")
+def archive_segment(segment):
+    """Download one archive segment, streamed from disk."""
+    archive_dir = app.config.get('archive', {}).get('dir')
+    if not archive_dir:
+        abort(404)
+    return send_from_directory(archive_dir, segment + ".ndjson.gz",
+                               mimetype="application/gzip",
+                               as_attachment=True)
+
+
+@app.route("/api/queue")
+def queue():
+    """
+    The highstates running now, and those queued in the order they will
+    run in.
+    """
+    runningq = (SaltJob
+                .select()
+                .where(SaltJob.status == "running")
+                .order_by(SaltJob.id))
+    queuedq = (QueuedJob
+               .select()
+               .order_by(QueuedJob.position, QueuedJob.id))
+    running = [serialise(j) for j in runningq.iterator()]
+    queued = [serialise(q) for q in queuedq.iterator()]
+    return jsonify(running=running, queued=queued)
+
+
+def request_cancel(kind, ident):
+    """
+    Ask the saltshaker to cancel the queued highstate (*kind* "queue") or
+    running job (*kind* "job") *ident*. Needs the web.api_token in an
+    X-Saltbot-Token header.
+    """
+    token = app.config['web']['api_token']
+    given = request.headers.get('X-Saltbot-Token', '')
+    if not token or not compare_digest(given.encode(), str(token).encode()):
+        abort(403)
+    kill = request.args.get('kill', app.config['salt']['kill_on_cancel'])
+    kill = str(kill).lower() in ("1", "true", "yes")
+    who = "API ({})".format(request.remote_addr)
+    logger.info("Cancel of {} requested by {}".format(ident, who))
+    app.config['webpq'].put(("cancel", {"kind": kind, "id": ident,
+                                        "kill": kill, "who": who}))
+    return jsonify(cancelling=ident, kill=kill), 202
+
+
+@app.route("/api/jobs/<jid>/cancel", methods=["POST"])
+def cancel_job(jid):
+    return request_cancel("job", jid)
+
+
+@app.route("/api/queue/<int:qid>/cancel", methods=["POST"])
+def cancel_queued(qid):
+    return request_cancel("queue", str(qid))
+
+
 @app.route("/api/webhook", methods=["POST"])
 def webhook():
     """
     Process receiving a webhook from GitHub.
-    Only supports push event notifications.
+    Only supports push event notifications, plus batches of pushes from
+    our own post-receive hook.
     """
     logger.info("Webhook received")
 
@@ -221,27 +1003,15 @@ def webhook():
         return "Invalid signature", 403
     logger.info("HMAC signature valid")
 
-    if request.headers.get('X-GitHub-Event') == 'push':
-        event = request.get_json()
-        push = {}
-        try:
-            push['gitref'] = event['ref']
-            push['repo_name'] = event['repository']['full_name']
-            push['repo_url'] = event['repository']['url']
-            push['commit_id'] = event['head_commit']['id']
-            push['commit_msg'] = event['head_commit']['message']
-            push['commit_ts'] = event['head_commit']['timestamp']
-            push['commit_url'] = event['head_commit']['url']
-            push['commit_author'] = event['head_commit']['author']['username']
-            push['pusher'] = event['pusher']['name']
-        except (KeyError, TypeError):
-            logger.warning("Could not extract event from push, skipping")
-            logger.warning(str(event))
-        else:
-            logger.info("Details: {}".format(push))
-            app.config['webpq'].put(("github_push", push))
-
-    if request.headers.get('X-GitHub-Event') == 'ping':
+    # Parsing and deduplication happen in the exchange, so we can ack quickly
+    event = request.headers.get('X-GitHub-Event')
+    if event in ('push', 'push_batch'):
+        app.config['webpq'].put(("github_webhook", {
+            "event": event,
+            "delivery": request.headers.get('X-GitHub-Delivery'),
+            "body": request.get_data().decode('utf-8'),
+            "trace": tracing.new()}))
+    elif event == 'ping':
         logger.info("Received GitHub ping")
 
     return "OK"
@@ -17,7 +17,12 @@ def get_version():
 console_scripts = [
     "saltbot = saltbot:main",
     "saltbot-createtables = saltbot:createtables",
-    "saltbot-droptables = saltbot:droptables"
+    "saltbot-migratetables = saltbot:migratetables",
+    "saltbot-droptables = saltbot:droptables",
+    "saltbot-import = saltbot.importer:main",
+    "saltbot-archive = saltbot.archive:main",
+    "saltbot-bench-ingest = saltbot.bench:ingest_main",
+    "saltbot-bench-api = saltbot.bench:api_main",
 ]
 
 setup(
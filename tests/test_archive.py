@@ -0,0 +1,130 @@
+import os
+import shutil
+import datetime
+import tempfile
+
+from nose.tools import assert_equal
+
+from saltbot import archive
+from saltbot import ingest
+from saltbot import webapp
+from saltbot.database import SaltJob, SaltJobMinion, SaltMinionResult
+
+from .test_webapp import WebAppTest
+
+
+class TestSegments(object):
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        writer = archive.SegmentWriter(self.tmpdir, "seg")
+        for i in (5, 1, 3):
+            writer.add(archive.MINION, i, {"jid": "j", "n": i})
+        writer.add(archive.JOB, 3, {"jid": "j", "n": "job"})
+        writer.close()
+        for i in (1, 3, 5):
+            assert_equal(archive.read_record(self.tmpdir, "seg",
+                                             archive.MINION, i)['n'], i)
+        assert_equal(archive.read_record(self.tmpdir, "seg",
+                                         archive.JOB, 3)['n'], "job")
+        assert_equal(archive.read_record(self.tmpdir, "seg",
+                                         archive.MINION, 2), None)
+        assert_equal(archive.read_record(self.tmpdir, "missing",
+                                         archive.JOB, 3), None)
+        assert_equal(archive.list_segments(self.tmpdir)[0]['segment'], "seg")
+
+    def test_find_entry(self):
+        index = b"".join(archive.ENTRY.pack(archive.MINION, i, i * 10, 1)
+                         for i in range(0, 100, 2))
+        assert_equal(archive.find_entry(index, archive.MINION, 42)[2], 420)
+        assert_equal(archive.find_entry(index, archive.MINION, 43), None)
+        assert_equal(archive.find_entry(index, archive.JOB, 42), None)
+
+
+class TestArchive(WebAppTest):
+    def setup(self):
+        super(TestArchive, self).setup()
+        self.cfg['archive'] = {"dir": os.path.join(self.tmpdir, "archive")}
+        self.cfg['salt'] = {"late_returns": 3600}
+        webapp.app.config.update(self.cfg)
+        # Old enough to archive, but for the last job only just
+        self.start = datetime.datetime.now() - datetime.timedelta(days=2)
+
+    def store(self, status="finished"):
+        job = self.job({"web": 1, "db": 2}, status=status)
+        for minion in job.minions:
+            ingest.store_return(minion, {
+                "pkg_|-nginx_|-nginx_|-installed": {
+                    "result": minion.minion == "web", "comment": "",
+                    "__run_num__": 1, "changes": {}}})
+        return job
+
+    def test_round_trip(self):
+        job = self.store()
+        before = self.get("/api/jobs/{}".format(job.jid))
+        minion = before['minions'][0]['id']
+        results = self.get("/api/jobs/{}/minions/{}".format(job.jid, minion))
+        archive.run(self.cfg, 1, 10)
+        self.db.connect()
+        assert_equal(SaltMinionResult.select().count(), 0)
+        assert_equal(SaltJobMinion.select().count(), 0)
+        after = self.get("/api/jobs/{}".format(job.jid))
+        assert_equal(after['minions'], before['minions'])
+        assert_equal(after['no_errors'], False)
+        assert_equal(self.get("/api/jobs/{}/minions/{}".format(
+            job.jid, minion)), results)
+
+    def test_partial_waits_for_late_returns(self):
+        # Past the one day cutoff, but only by less than late_returns
+        recently = datetime.datetime.now() - datetime.timedelta(
+            days=1, minutes=30)
+        jobs = {}
+        for name, status, when in (("old", "partial", None),
+                                   ("late", "partial", recently),
+                                   ("done", "finished", recently),
+                                   ("running", "running", None)):
+            job = self.store(status=status)
+            if when is not None:
+                SaltJob.update(when=when).where(SaltJob.id == job.id).execute()
+            jobs[job.jid] = name
+        archive.run(self.cfg, 1, 10)
+        self.db.connect()
+        archived = [jobs[j.jid] for j in SaltJob.select().where(
+            ~(SaltJob.archived >> None)).order_by(SaltJob.id)]
+        assert_equal(archived, ["old", "done"])
+
+    def test_missing_segment(self):
+        job = self.store()
+        self.store()
+        archive.run(self.cfg, 1, 1)
+        self.db.connect()
+        segment = SaltJob.get(jid=job.jid).archived
+        for path in archive.segment_paths(self.cfg['archive']['dir'],
+                                          segment):
+            os.unlink(path)
+        jobs = self.get("/api/jobs/")['jobs']
+        assert_equal([(j['jid'], j['no_errors']) for j in jobs],
+                     [("2", False), ("1", None)])
+        assert_equal(jobs[1]['all_in'], None)
+        resp = self.client.get("/api/jobs/{}".format(job.jid))
+        assert_equal(resp.status_code, 404)
+
+    def test_statistics_skip_archived(self):
+        old = self.store()
+        archive.run(self.cfg, 1, 10)
+        self.db.connect()
+        self.start = datetime.datetime.now()
+        new = self.store()
+        # No previous job still in the database to diff against
+        resp = self.client.get("/api/jobs/{}/diff".format(new.jid))
+        assert_equal(resp.status_code, 404)
+        resp = self.client.get("/api/jobs/{}/diff?against={}".format(
+            new.jid, old.jid))
+        assert_equal(resp.status_code, 409)
+        for url in ("/api/minions/stragglers", "/api/states/slowest",
+                    "/api/minions/web"):
+            assert_equal(self.get(url)['archived'], 1)
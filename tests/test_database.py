@@ -0,0 +1,27 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+
+from saltbot.database import Database, SaltJob
+
+
+class TestMigrate(object):
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cfg = {"database": {"engine": "sqlite",
+                                 "file": os.path.join(self.tmpdir, "db")}}
+        self.db = Database(self.cfg)
+
+    def teardown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_migrate_up_to_date(self):
+        # Every index already exists, which mustn't stop the migration
+        self.db.create_tables()
+        self.db.migrate_tables()
+        self.db.migrate_tables()
+        self.db.connect()
+        assert_equal(SaltJob.select().count(), 0)
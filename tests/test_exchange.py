@@ -0,0 +1,129 @@
+import os
+import json
+import shutil
+import tempfile
+
+import mock
+from nose.tools import assert_equal, assert_true
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from saltbot.database import Database
+from saltbot.exchange import Exchange
+
+
+def push_event(ref="refs/heads/master"):
+    return {"ref": ref,
+            "repository": {"full_name": "org/states", "url": "#"},
+            "head_commit": {"id": "abc", "message": "m", "timestamp": "t",
+                            "url": "#", "author": {"username": "a"}},
+            "pusher": {"name": "p"}}
+
+
+class TestDeliveries:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cfg = {"database": {"engine": "sqlite",
+                                 "file": os.path.join(self.tmpdir, "db")},
+                    "github": {"delivery_history": 10},
+                    "repos": {"org/states": {"master": {"target": "*"}}}}
+        Database(self.cfg).create_tables()
+        self.sltcq = Queue()
+        self.exchange = Exchange(self.cfg, Queue(), Queue(), self.sltcq,
+                                 Queue())
+
+    def teardown(self):
+        self.exchange.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def webhook(self, delivery):
+        self.exchange.handle_github_webhook({
+            "event": "push", "delivery": delivery,
+            "body": json.dumps(push_event())})
+
+    def test_redelivery_skipped(self):
+        self.webhook("d1")
+        self.webhook("d1")
+        self.webhook("d2")
+        assert_equal(self.sltcq.qsize(), 2)
+
+    def test_failed_push_retried(self):
+        with mock.patch.object(self.exchange, "handle_github_push",
+                               side_effect=ValueError):
+            self.webhook("d1")
+        self.webhook("d1")
+        assert_equal(self.sltcq.qsize(), 1)
+
+    def test_duplicate_record_keeps_connection_usable(self):
+        self.exchange.record_delivery("d1")
+        self.exchange.record_delivery("d1")
+        assert_true(self.exchange.is_duplicate_delivery("d1"))
+
+
+class TestSelectTarget:
+    def setup(self):
+        self.exchange = Exchange.__new__(Exchange)
+        self.branch = {"target": "prod*", "paths": [
+            {"pattern": "*.md", "target": None},
+            {"pattern": "web/*", "target": "G@role:web"},
+            {"pattern": "db/*", "target": ["db0", "db1"]}]}
+
+    def test_rule_narrows_branch_target(self):
+        assert_equal(self.exchange.select_target(self.branch, {"web/a"}),
+                     ("( prod* ) and ( G@role:web )", "compound"))
+
+    def test_union_of_rules(self):
+        assert_equal(
+            self.exchange.select_target(self.branch, {"web/a", "db/b"}),
+            ("( prod* ) and ( ( L@db0,db1 ) or ( G@role:web ) )",
+             "compound"))
+
+    def test_branch_expr_forms(self):
+        self.branch.update(target=["prod0", "prod1"], expr_form="list")
+        assert_equal(self.exchange.select_target(self.branch, {"web/a"})[0],
+                     "( L@prod0,prod1 ) and ( G@role:web )")
+        self.branch.update(target="prod[0-9]", expr_form="pcre")
+        assert_equal(self.exchange.select_target(self.branch, {"web/a"})[0],
+                     "( E@prod[0-9] ) and ( G@role:web )")
+
+    def test_no_highstate_needed(self):
+        assert_equal(self.exchange.select_target(self.branch, {"README.md"}),
+                     None)
+
+    def test_unmatched_file_uses_branch_target(self):
+        assert_equal(self.exchange.select_target(self.branch, {"x", "web/a"}),
+                     ("prod*", "glob"))
+        assert_equal(self.exchange.select_target(self.branch, None),
+                     ("prod*", "glob"))
+
+
+class TestLateResults:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        cfg = {"database": {"engine": "sqlite",
+                            "file": os.path.join(self.tmpdir, "db")}}
+        Database(cfg).create_tables()
+        self.ircmq = Queue()
+        self.sltrq = Queue()
+        self.exchange = Exchange(cfg, self.ircmq, Queue(), Queue(),
+                                 self.sltrq)
+
+    def teardown(self):
+        self.exchange.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_summaries(self):
+        failed = ["m{}".format(i) for i in range(7)]
+        self.sltrq.put(("salt_late_results", ("1", ["a"], [], 2, 10)))
+        self.sltrq.put(("salt_late_results", ("1", ["b"], failed, 10, 10)))
+        # Everything waiting is handled in one go
+        self.exchange.check_queue(self.sltrq)
+        assert_true(self.sltrq.empty())
+        assert_equal(self.ircmq.get_nowait()[1],
+                     "Salt JID 1: 1 late result, all OK (2/10 results)")
+        assert_equal(self.ircmq.get_nowait()[1],
+                     "Salt JID 1: 8 late results, errors from m0, m1, m2, "
+                     "m3, m4 and 2 more (10/10 results)")
@@ -0,0 +1,128 @@
+import os
+import shutil
+import sqlite3
+import datetime
+import tempfile
+
+from nose.tools import assert_equal, assert_true, assert_false
+
+from saltbot import ingest
+from saltbot.database import Database, SaltJob, SaltJobMinion
+from saltbot.database import SaltMinionResult, FleetMinion, FleetFailure
+
+
+def state(ok=True, changed=False, duration=None):
+    return {"result": ok, "comment": "c", "__run_num__": 1,
+            "changes": {"x": 1} if changed else {}, "duration": duration}
+
+
+class TestParsing:
+    def test_parse_duration(self):
+        assert_equal(ingest.parse_duration(12.5), 12.5)
+        assert_equal(ingest.parse_duration("12.3 ms"), 12.3)
+        assert_equal(ingest.parse_duration(None), None)
+        assert_equal(ingest.parse_duration("soon"), None)
+
+    def test_minion_rows(self):
+        rows, ok = ingest.minion_rows(1, {
+            "file_|-motd_|-/etc/motd_|-managed": state(duration="3 ms"),
+            "pkg_|-vim_|-vim_|-installed": state(ok=False)})
+        assert_false(ok)
+        rows = sorted(rows, key=lambda r: r['key_state'])
+        assert_equal(rows[0]['key_id'], "motd")
+        assert_equal(rows[0]['duration'], 3.0)
+        assert_false(rows[1]['result'])
+
+    def test_minion_error_rows(self):
+        for ret in (["No matching sls found"], "Minion did not return"):
+            rows, ok = ingest.minion_rows(1, ret)
+            assert_false(ok)
+            assert_equal(rows[0]['key_id'], "Minion Error")
+            assert_equal(ingest.fleet_status(rows), "error")
+
+    def test_fleet_status(self):
+        assert_equal(ingest.fleet_status(ingest.minion_rows(1, {
+            "a_|-b_|-c_|-d": state()})[0]), "ok")
+        assert_equal(ingest.fleet_status(ingest.minion_rows(1, {
+            "a_|-b_|-c_|-d": state(ok=False)})[0]), "failing")
+
+
+class TestStoreReturns:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = Database({"database": {
+            "engine": "sqlite", "file": os.path.join(self.tmpdir, "db")}})
+        self.db.create_tables()
+        self.db.connect()
+        conn = self.db.db.get_conn()
+        if hasattr(conn, "setlimit"):
+            # The default on SQLite before 3.32, which newer builds raise
+            conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+        self.job = SaltJob.create(jid="1", when=datetime.datetime.now(),
+                                  expr_form="glob", target="*")
+
+    def teardown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_large_return(self):
+        dbminion = SaltJobMinion.create(job=self.job, minion="m")
+        ret = dict(("pkg_|-p{0}_|-p{0}_|-installed".format(i),
+                    state(ok=i != 7)) for i in range(500))
+        ok, rows = ingest.store_return(dbminion, ret)
+        assert_false(ok)
+        assert_equal(rows, 500)
+        assert_equal(SaltMinionResult.select().count(), 500)
+        assert_equal(SaltJobMinion.get().status, "returned")
+
+    def test_many_minions(self):
+        returns = []
+        for i in range(300):
+            dbminion = SaltJobMinion.create(job=self.job,
+                                            minion="m{}".format(i))
+            returns.append((dbminion, {"a_|-b_|-c_|-d": state()}, None))
+        oks, rows = ingest.store_returns(returns)
+        assert_true(all(oks))
+        assert_equal(FleetMinion.select().count(), 300)
+
+    def test_fleet_ignores_older_return(self):
+        now = datetime.datetime.now()
+        new = SaltJobMinion.create(job=self.job, minion="m")
+        ingest.store_return(new, {"a_|-b_|-c_|-d": state()}, returned=now)
+        old = SaltJobMinion.create(job=self.job, minion="m")
+        ingest.store_return(old, {"a_|-b_|-c_|-d": state(ok=False)},
+                            returned=now - datetime.timedelta(days=1))
+        assert_equal(FleetMinion.get().status, "ok")
+        assert_equal(FleetFailure.select().count(), 0)
+
+    def test_rebuild_fleet_without_return_times(self):
+        # As stored before return times were recorded
+        later = SaltJob.create(jid="2", when=self.job.when, expr_form="glob",
+                               target="*")
+        for job, ok in ((self.job, True), (later, False)):
+            dbminion = SaltJobMinion.create(job=job, minion="m")
+            ingest.store_return(dbminion, {"a_|-b_|-c_|-d": state(ok=ok)})
+        SaltJobMinion.create(job=later, minion="silent")
+        SaltJobMinion.update(returned=None, status=None).execute()
+        FleetFailure.delete().execute()
+        FleetMinion.delete().execute()
+        ingest.rebuild_fleet()
+        fleet = FleetMinion.get()
+        assert_equal(FleetMinion.select().count(), 1)
+        assert_equal((fleet.minion, fleet.job.id, fleet.status),
+                     ("m", later.id, "failing"))
+        assert_equal(fleet.returned, later.when)
+
+
+class TestJobTimes:
+    def test_jid_time(self):
+        assert_equal(ingest.jid_time("20150118104539540662"),
+                     datetime.datetime(2015, 1, 18, 10, 45, 39, 540662))
+        assert_equal(ingest.jid_time("not-a-jid"), None)
+
+    def test_listener_job_time(self):
+        from saltbot.listener import job_time
+        assert_equal(job_time("20150118104539540662", {}),
+                     datetime.datetime(2015, 1, 18, 10, 45, 39, 540662))
+        assert_equal(job_time("x", {"_stamp": "2015-01-18T10:45:39.5"}),
+                     datetime.datetime(2015, 1, 18, 10, 45, 39, 500000))
@@ -0,0 +1,64 @@
+import mock
+from nose.tools import assert_equal
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from saltbot.ircbot import IRCBot
+
+
+class TestIdentChecks:
+    def setup(self):
+        config = {"irc": {"server": "localhost", "port": 6667,
+                          "channel": "#saltbot", "nick": "saltbot",
+                          "owners": ["Adam"], "ident_ttl": 60,
+                          "ident_timeout": 30}}
+        self.irccq = Queue()
+        self.bot = IRCBot(config, Queue(), self.irccq)
+        self.bot.connection = mock.Mock()
+
+    def nickserv(self, msg):
+        self.bot.handle_nickserv(mock.Mock(arguments=[msg]))
+
+    def commands(self):
+        cmds = []
+        while not self.irccq.empty():
+            cmds.append(self.irccq.get())
+        return cmds
+
+    def test_one_acc_per_nick(self):
+        self.bot.check_ident_and_cmd("Adam", "help")
+        self.bot.check_ident_and_cmd("Adam", "say hi")
+        assert_equal(self.bot.connection.privmsg.call_count, 1)
+        self.nickserv("Adam ACC 3")
+        assert_equal(self.commands(), [("cmd", ("Adam", "help")),
+                                       ("cmd", ("Adam", "say hi"))])
+
+    def test_reply_case_differs(self):
+        self.bot.check_ident_and_cmd("Adam", "help")
+        self.nickserv("adam ACC 3")
+        assert_equal(self.commands(), [("cmd", ("Adam", "help"))])
+        # And the identity is cached whatever the case
+        self.bot.check_ident_and_cmd("ADAM", "help")
+        assert_equal(self.commands(), [("cmd", ("ADAM", "help"))])
+
+    @mock.patch("saltbot.ircbot.time")
+    def test_unanswered_acc_times_out(self, time):
+        time.time.return_value = 1000
+        self.bot.check_ident_and_cmd("Adam", "help")
+        time.time.return_value = 1031
+        self.bot.check_ident_and_cmd("Adam", "say hi")
+        self.bot.connection.privmsg.assert_any_call(
+            "Adam", "NickServ didn't respond, please try again")
+        self.bot.connection.privmsg.assert_called_with("NickServ", "ACC Adam")
+        assert_equal(self.bot.connection.privmsg.call_count, 3)
+        self.nickserv("Adam ACC 3")
+        assert_equal(self.commands(), [("cmd", ("Adam", "say hi"))])
+
+    def test_not_identified(self):
+        self.bot.check_ident_and_cmd("Adam", "help")
+        self.nickserv("Adam ACC 1")
+        assert_equal(self.commands(), [])
+        assert_equal(self.bot.auth_checks_in_flight, {})
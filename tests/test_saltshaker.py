@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+
+import mock
+from nose.tools import assert_equal, assert_true
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from saltbot import tracing
+from saltbot.database import Database, SaltJob
+from saltbot.saltshaker import SaltShaker, HighstateJob
+
+
+class TestCancel:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        cfg = {"database": {"engine": "sqlite",
+                            "file": os.path.join(self.tmpdir, "db")},
+               "salt": {"aging": 300}}
+        Database(cfg).create_tables()
+        self.sltrq = Queue()
+        self.shaker = SaltShaker(cfg, Queue(), self.sltrq)
+        self.entry = self.shaker.scheduler.push("*", "glob", False, None)
+        # A running job whose jid happens to match the queue id
+        self.shaker.current = mock.Mock(jid=str(self.entry.id),
+                                        cancelled=False, returned={},
+                                        minions=["a"])
+
+    def teardown(self):
+        self.shaker.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_cancel_job_leaves_queue_alone(self):
+        self.shaker.cancel("job", str(self.entry.id), False, "test")
+        assert_equal(len(self.shaker.scheduler), 1)
+        self.shaker.current.cancel.assert_called_once_with(False)
+        assert_equal(self.sltrq.get()[1]['what'], "running")
+
+    def test_cancel_queued_leaves_job_alone(self):
+        self.shaker.cancel("queue", str(self.entry.id), False, "test")
+        assert_equal(len(self.shaker.scheduler), 0)
+        assert_equal(self.shaker.current.cancel.call_count, 0)
+        assert_equal(self.sltrq.get()[1]['what'], "queued")
+
+    def test_nothing_matches(self):
+        self.shaker.cancel("queue", "999", False, "test")
+        assert_equal(self.sltrq.get()[1]['what'], None)
+
+
+class TestJobRow:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        cfg = {"database": {"engine": "sqlite",
+                            "file": os.path.join(self.tmpdir, "db")},
+               "salt": {"aging": 300}}
+        Database(cfg).create_tables()
+        self.sltrq = Queue()
+        self.shaker = SaltShaker(cfg, Queue(), self.sltrq)
+        trace = tracing.new()
+        minions = ["a", "b", "c", "d"]
+        dbjob, dbminions = self.shaker.create_records(
+            "*", "glob", "1", minions, None, trace)
+        options = {"job_deadline": None, "minion_deadline": None,
+                   "late_returns": 3600}
+        self.job = HighstateJob(self.shaker, "1", minions, iter([]),
+                                dbjob, dbminions, trace, time.time(),
+                                options)
+        self.job.store_return("a", {})
+        self.job.finalise(True)
+        self.sltrq.get_nowait()
+
+    def teardown(self):
+        self.shaker.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def stamp(self):
+        """Stamp the stored trace, as the exchange does."""
+        dbjob = SaltJob.get(jid="1")
+        trace = json.loads(dbjob.timings)
+        trace['stamps']['irc_delivered'] = 1.0
+        SaltJob.update(timings=json.dumps(trace)).execute()
+
+    def test_close_keeps_exchange_stamps(self):
+        assert_equal(SaltJob.get(jid="1").status, "partial")
+        self.stamp()
+        self.job.close()
+        dbjob = SaltJob.get(jid="1")
+        assert_equal(dbjob.status, "finished")
+        assert_equal(json.loads(dbjob.timings)['stamps']['irc_delivered'],
+                     1.0)
+
+    def test_cancel_keeps_exchange_stamps(self):
+        self.stamp()
+        self.job.cancel(False)
+        dbjob = SaltJob.get(jid="1")
+        assert_equal(dbjob.status, "cancelled")
+        assert_equal(json.loads(dbjob.timings)['stamps']['irc_delivered'],
+                     1.0)
+
+    def test_late_returns_reported_together(self):
+        self.job.store_return("b", {})
+        self.job.report_late()
+        assert_equal(self.sltrq.get_nowait(),
+                     ("salt_late_results", ("1", ["b"], [], 2, 4)))
+        # Too soon after the last report
+        self.job.store_return("c", {})
+        self.job.store_return("d", {})
+        self.job.report_late()
+        assert_true(self.sltrq.empty())
+        self.job.close()
+        assert_equal(self.sltrq.get_nowait(),
+                     ("salt_late_results", ("1", ["c", "d"], [], 4, 4)))
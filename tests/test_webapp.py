@@ -0,0 +1,143 @@
+import os
+import json
+import shutil
+import datetime
+import tempfile
+
+import mock
+from nose.tools import assert_equal, assert_true
+
+from saltbot import ingest
+from saltbot import webapp
+from saltbot.database import Database, SaltJob, SaltJobMinion
+
+
+class WebAppTest(object):
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cfg = {"database": {"engine": "sqlite",
+                                 "file": os.path.join(self.tmpdir, "db")},
+                    "web": {"per_page": 20, "profile": {"enabled": False}}}
+        self.db = Database(self.cfg)
+        self.db.create_tables()
+        self.db.connect()
+        webapp.app.config.update(self.cfg)
+        self.client = webapp.app.test_client()
+        self.start = datetime.datetime(2015, 1, 1)
+        self.jobs = 0
+
+    def teardown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def get(self, url):
+        resp = self.client.get(url)
+        assert_equal(resp.status_code, 200)
+        return json.loads(resp.data.decode("utf-8"))
+
+    def job(self, returns, status="finished"):
+        """A job whose minions returned after the given seconds, or None."""
+        self.jobs += 1
+        when = self.start + datetime.timedelta(hours=self.jobs)
+        job = SaltJob.create(jid=str(self.jobs), when=when, target="*",
+                             expr_form="glob", status=status,
+                             finished=when + datetime.timedelta(minutes=5))
+        for name, after in sorted(returns.items()):
+            returned = None
+            if after is not None:
+                returned = when + datetime.timedelta(seconds=after)
+            SaltJobMinion.create(job=job, minion=name, returned=returned,
+                                 status="returned" if returned else None)
+        return job
+
+
+class TestStragglers(WebAppTest):
+    def test_slow_minion_flagged(self):
+        for _ in range(5):
+            returns = dict(("m{}".format(i), i) for i in range(9))
+            returns["slow"] = 100
+            self.job(returns)
+        minions = self.get("/api/minions/stragglers")['minions']
+        assert_equal(minions[0]['minion'], "slow")
+        assert_true(minions[0]['flagged'])
+        assert_equal([m['minion'] for m in minions if m['flagged']],
+                     ["slow"])
+
+    def test_cancelled_and_small_jobs_ignored(self):
+        for _ in range(5):
+            self.job(dict(("m{}".format(i), i) for i in range(10)))
+            # Cancelled before m0 returned
+            self.job(dict(("m{}".format(i), None if i == 0 else i)
+                          for i in range(10)), status="cancelled")
+            # In a two minion job one of them is always last
+            self.job({"m0": 1, "m1": 2})
+        minions = self.get("/api/minions/stragglers")['minions']
+        assert_equal(len(minions), 10)
+        assert_equal(sum(m['missing'] for m in minions), 0)
+        assert_equal([m['minion'] for m in minions if m['flagged']], ["m9"])
+
+
+class TestPagination(WebAppTest):
+    def setup(self):
+        super(TestPagination, self).setup()
+        for _ in range(3):
+            job = self.job({"web": 1})
+            ingest.store_return(job.minions[0], {
+                "pkg_|-nginx_|-nginx_|-installed": {
+                    "result": True, "comment": "", "__run_num__": 1,
+                    "changes": {}},
+                "service_|-nginx_|-nginx_|-running": {
+                    "result": True, "comment": "", "__run_num__": 2,
+                    "changes": {}}})
+
+    def pages(self, url):
+        items, cursor = [], None
+        while True:
+            page = self.get(url + ("&before={}".format(cursor)
+                                   if cursor else ""))
+            items.extend(page.get('results') or page.get('jobs'))
+            cursor = page['next']
+            if cursor is None:
+                return items
+
+    def test_state_history_pages(self):
+        results = self.pages("/api/minions/web/states/nginx?limit=1")
+        assert_equal(len(results), 6)
+        assert_equal([r['jid'] for r in results],
+                     ["3", "3", "2", "2", "1", "1"])
+        assert_equal(len(set((r['jid'], r['key_state'])
+                             for r in results)), 6)
+
+    def test_minion_history_pages(self):
+        jobs = self.pages("/api/minions/web?limit=2")
+        assert_equal([j['jid'] for j in jobs], ["3", "2", "1"])
+        assert_equal([j['num_results'] for j in jobs], [2, 2, 2])
+
+    def test_bad_cursor(self):
+        resp = self.client.get("/api/minions/web/states/nginx?before=x")
+        assert_equal(resp.status_code, 400)
+
+
+class TestSearch(WebAppTest):
+    def store(self):
+        job = self.job({"web": 1})
+        ingest.store_return(job.minions[0], {
+            "pkg_|-nginx_|-nginx_|-installed": {
+                "result": False, "comment": "Package not found",
+                "__run_num__": 1, "changes": {}}})
+
+    def test_search(self):
+        self.store()
+        results = self.get("/api/search?q=not+found")['results']
+        assert_equal([r['key_id'] for r in results], ["nginx"])
+
+    def test_search_unavailable(self):
+        self.teardown()
+        # As if SQLite had no FTS5
+        with mock.patch("saltbot.database.SEARCH_SQLITE",
+                        ["CREATE VIRTUAL TABLE saltminionresult_fts "
+                         "USING no_such_module(output)"]):
+            self.setup()
+        self.store()
+        resp = self.client.get("/api/search?q=nginx")
+        assert_equal(resp.status_code, 501)